@@ -0,0 +1,1049 @@
+'''
+This script benchmarks the data processing utilities of the project.
+
+Usage: benchmark.py [-h] [-i [INPUT ...]] [-f FILES] [-n EPOCHS] [-r REPEAT] [-j CONCURRENCY] [-l LATENCY] {parse,store,ingest,lzw,download,pipeline,throttle,elements,kepler,memory}
+
+Options:
+  -h, --help            show this help message and exit
+  -i [INPUT ...], --input [INPUT ...]
+                        .Z-files to benchmark on (default: synthetic s6a data)
+  -f FILES, --files FILES
+                        number of synthetic .Z-files (default: 4)
+  -n EPOCHS, --epochs EPOCHS
+                        number of epochs per synthetic .Z-file (default: 10080, i.e. one week of 1-minute orbits)
+  -r REPEAT, --repeat REPEAT
+                        number of repetitions, the best time is reported (default: 3)
+  -j CONCURRENCY, --concurrency CONCURRENCY
+                        initial number of simultaneous downloads of dl_utils.download_Z_async (see dl_utils.RateLimiter) (default: 8)
+  -l LATENCY, --latency LATENCY
+                        response latency of the local HTTP server in seconds (default: 0.05)
+
+Benchmarks:
+parse : vectorised SP3 parser (df_utils.create_df) against the per-line regex parser (create_df_regex, previous df_utils.create_df),
+        and a multi satellite file against the single satellite files of its satellites
+store : file size and load time of .csv-files (LoadSats) against binary columnar files (LoadColumnar),
+        and load time of one satellite in a time window with filters pushed down into the read against loading all and filtering
+lzw : decompression throughput (MB/s) and peak memory of unlzw3 + decode + splitlines against lzw_utils
+ingest : throughput (files/s, MB/s) and speedup of the parallel ingest (df_utils.write_to_df_II) against a Manager().list hand-off of DataFrames,
+         for 1, 2, 4, ... processes up to 2*cpu_count()
+download : throughput and memory of dl_utils.download_Z_async against the process pool of dl_utils.download_Z_II, served by a local HTTP server
+pipeline : wall time of ingest_utils.ingest_pipeline against downloading all files first and parsing them afterwards, served by a local HTTP server
+           and bytes written to disk with temporary .Z-files against the in-memory pipeline (no tmp_path)
+elements : orbital elements of the (concatenated) files with kepler_utils.compute_elements against one kepler_utils function per element,
+           wall time and peak memory (tracemalloc) of compute_elements against compute_elements_chunked
+kepler : elements of a known orbit (Curtis, example 4.3), epochs/s of the vectorised Kepler solver (kepler_utils.solve_kepler, Newton and Halley) and of the conversion of
+         Keplerian elements to states (kepler_utils.elements_to_states), with round-trip errors against the element functions
+memory : peak resident memory of the preprocessing pipeline (DropDuplIdx, ConvertUnits, OrbitalElements) with copies against copy=False,
+         on the epochs of the .Z-files tiled to 2 million epochs
+throttle : downloads from a local HTTP server which answers 429 (Retry-After) above 4 simultaneous requests or 50 requests/s and 429/503
+           for every 5th request, with a fixed number of simultaneous downloads against the adaptive dl_utils.RateLimiter
+           (asserts retries, Retry-After pauses and that the adaptive concurrency shrank and recovered)
+
+If no input files are given, synthetic SP3-c files of a circular s6a-like orbit are written (LZW compressed) to a temporary directory.
+'''
+
+# IMPORTS
+import numpy as np
+import pandas as pd
+import sys
+import time
+import os
+import tempfile
+import re
+import tracemalloc
+import unlzw3
+import resource
+import requests
+import threading
+import shutil
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from functools import partial
+from multiprocessing import Manager, Process, cpu_count
+from multiprocessing.pool import Pool
+from pathlib import Path
+
+# IMPORT UTILITY FUNCIONS
+wd = str(Path(__file__).resolve().parents[1]) # working directory: /DORIS/
+
+sys.path.append(wd + '/src/')# append path to ../src/ for following imports
+
+import df_utils as dfu
+import kepler_utils as kutls
+import dl_utils as dlu
+import ingest_utils as ingu
+import lzw_utils as lzw
+import preprocessing_utils as preputls
+import store_utils as stu
+import sp3_utils as sp3
+from misc_utils import Metrics
+
+# CMD LINE (ARGUMENTS ARGPARSER IMPORT)
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+
+# SYNTHETIC DATA
+
+def compress_lzw(data:bytes, max_bits:int=16) -> bytes:
+    """
+    Compresses data in the format of the Unix compress utility (LZW compression, .Z-files).
+    Input: bytes; maximal code size in bits (Default = 16)
+    Output: bytes (contents of a .Z-file)
+    """
+
+    out = bytearray([0x1F, 0x9D, 0x80 | max_bits]) # magic bytes and block mode flag
+
+    if not data:
+        return bytes(out)
+
+    table = {bytes([k]): k for k in range(256)}
+    next_code = 257 # 256 = CLEAR code in block mode
+    max_code = (1 << max_bits) - 1
+
+    # BIT PACKING (LSB FIRST); CODES ARE WRITTEN IN GROUPS OF 8 CODES PER CODE SIZE
+    bits = 9
+    acc = 0 # bit accumulator
+    n_acc = 0 # number of bits in accumulator
+    n_codes = 0 # number of codes written with current code size
+    end = 256 # last table entry known to the decoder
+
+    def emit(code):
+        nonlocal acc, n_acc, n_codes
+        acc |= code << n_acc
+        n_acc += bits
+        n_codes += 1
+        while n_acc >= 8:
+            out.append(acc & 0xFF)
+            acc >>= 8
+            n_acc -= 8
+
+    codes = []
+    w = data[:1]
+    for k in range(1, len(data)):
+        wc = w + data[k:k+1]
+        if wc in table:
+            w = wc
+        else:
+            codes.append(table[w])
+            if next_code <= max_code:
+                table[wc] = next_code
+                next_code += 1
+            w = data[k:k+1]
+    codes.append(table[w])
+
+    emit(codes[0])
+    for code in codes[1:]:
+        if end >= (1 << bits) - 1 and bits < max_bits:
+            # FLUSH TO THE END OF THE CURRENT GROUP OF 8 CODES BEFORE INCREASING THE CODE SIZE
+            if n_codes % 8:
+                for _ in range(8 - n_codes % 8):
+                    emit(0)
+            if n_acc:
+                out.append(acc & 0xFF)
+            acc = n_acc = n_codes = 0
+            bits += 1
+        emit(code)
+        if end < (1 << bits) - 1:
+            end += 1
+
+    if n_acc:
+        out.append(acc & 0xFF)
+
+    return bytes(out)
+
+def synthetic_sp3(n_epochs:int, start:str='2024-01-01', interval:int=60, sat='L39', phase=0.) -> bytes:
+    """
+    Creates the contents of a SP3-c file of circular orbits (position in km, velocity in dm/s).
+    Input: number of epochs; first epoch; epoch interval in seconds; 3 character satellite id (or list of ids: multi satellite file);
+           initial phase of the orbits [rad] (one per satellite)
+    Output: bytes
+    """
+
+    sats = [sat] if isinstance(sat, str) else list(sat)
+    phases = np.broadcast_to(phase, (len(sats),))
+
+    t = pd.date_range(start, periods=n_epochs, freq=f'{interval}s')
+
+    # CIRCULAR ORBITS AT ~1336 km ALTITUDE WITH 66 DEG INCLINATION (SENTINEL-6A)
+    radius = 7714.4 # km
+    period = 6745.7 # s
+    inc = np.deg2rad(66.0)
+    phase = 2*np.pi*np.arange(n_epochs)[:,None]*interval / period + phases # (epoch, satellite)
+    speed = 2*np.pi*radius / period * 1E4 # dm/s
+
+    x = radius*np.cos(phase)
+    y = radius*np.sin(phase)*np.cos(inc)
+    z = radius*np.sin(phase)*np.sin(inc)
+    vx = -speed*np.sin(phase)
+    vy = speed*np.cos(phase)*np.cos(inc)
+    vz = speed*np.cos(phase)*np.sin(inc)
+
+    header = [f'#cV{t[0].year:4d} {t[0].month:2d} {t[0].day:2d} {t[0].hour:2d} {t[0].minute:2d} {t[0].second:11.8f} {n_epochs:7d} ORBIT IGS14 FIT  GSC']
+    header += [f'## 2295      0.00000000 {interval:14.8f} 60310 0.0000000000000']
+    header += [f'+  {len(sats):3d}   ' + ''.join(sats + ['  0']*(17-len(sats)))] + ['+          0  0  0  0  0  0  0  0  0  0  0  0  0  0  0  0  0']*4
+    header += ['++         0  0  0  0  0  0  0  0  0  0  0  0  0  0  0  0  0']*5
+    header += ['%c L  cc UTC ccc cccc cccc cccc cccc ccccc ccccc ccccc ccccc']*2
+    header += ['%f  0.0000000  0.000000000  0.00000000000  0.000000000000000']*2
+    header += ['%i    0    0    0    0      0      0      0      0         0']*2
+    header += ['/* SYNTHETIC DORIS ORBIT']*4
+
+    lines = header
+    for k in range(n_epochs):
+        lines.append(f'*  {t[k].year:4d} {t[k].month:2d} {t[k].day:2d} {t[k].hour:2d} {t[k].minute:2d} {t[k].second:11.8f}')
+        for j, sat in enumerate(sats):
+            lines.append(f'P{sat}{x[k,j]:14.6f}{y[k,j]:14.6f}{z[k,j]:14.6f} 999999.999999')
+            lines.append(f'V{sat}{vx[k,j]:14.7f}{vy[k,j]:14.7f}{vz[k,j]:14.7f} 999999.999999')
+    lines.append('EOF')
+
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+def synthetic_Z_files(directory:str, n_files:int, n_epochs:int, ctr_id:str='gsc', sat_id:str='s6a') -> list:
+    """
+    Writes synthetic weekly SP3-c .Z-files following the CDDIS naming convention (e.g. gscs6a24.b24001.e24007.DGS.sp3.001.Z).
+    Input: directory; number of files; number of epochs per file; 3-letter center and satellite id
+    Output: list of paths to .Z-files
+    """
+
+    paths = []
+    for k in range(n_files):
+        start = pd.Timestamp('2024-01-01') + pd.Timedelta(days=7*k)
+        stop = start + pd.Timedelta(minutes=n_epochs-1)
+        filename = f'{ctr_id}{sat_id}{start:%y}.b{start:%y%j}.e{stop:%y%j}.DGS.sp3.001.Z'
+
+        path = directory + filename
+        Path(path).write_bytes(compress_lzw(synthetic_sp3(n_epochs,start=str(start))))
+        paths.append(path)
+
+    return paths
+
+# REFERENCE PARSER
+
+def create_df_regex(path_to_file:str) -> pd.DataFrame:
+    """
+    Previous parser of df_utils.create_df: creates the pd.DataFrame of a .Z-file line by line using regular expressions
+    (reference for validation and benchmarks of the vectorised parser).
+    Input: .Z-file path
+    Output: pd.DataFrame
+    """
+
+    filename = path_to_file.split('/')[-1] # get filename from .Z-file path
+    stream = dfu.unzip(path_to_file)[22:]
+
+    # REGEX
+    num = re.compile(r'-?\d*\.\d*') # regex pattern to filter for number: needed since VL39-64263.5220048 -3451.1598196-26497.1339810 999999.999999 may happen (can't use split)
+    date = re.compile(r'\d*\d')
+
+    # LIST OF DATES
+    dates = [''.join(list(map(lambda s: s.zfill(2),re.findall(date,line)[:-1]))) for line in stream[:-1:3]]  # last entry = 'EOF'
+
+    time_ = list(map(lambda t: pd.to_datetime(t), dates))
+
+    positions = np.array([re.findall(num,line)[:-1] for line in stream[1::3]]).astype(float)
+    velocities = np.array([re.findall(num,line)[:-1] for line in stream[2::3]]).astype(float)
+
+    ctr_id = [filename[:3]]*len(positions)
+    sat_id = [filename[3:6]]*len(positions)
+
+    return pd.DataFrame({'ctr_id':ctr_id, 'sat_id':sat_id, 'time_stamp':time_,
+                         'x':positions[:,0], 'y':positions[:,1], 'z':positions[:,2],
+                         'vx':velocities[:,0], 'vy':velocities[:,1], 'vz':velocities[:,2]})
+
+# BENCHMARKS
+
+def best_of(func, repeat:int, *args):
+    """
+    Runs func(*args) *repeat* times.
+    Output: best wall time in seconds, result of the last run
+    """
+
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - t0)
+
+    return min(times), result
+
+def bench_parse(paths:list, repeat:int):
+    """
+    Benchmarks df_utils.create_df against the previous regex parser (create_df_regex).
+    Both paths are timed over the same stages: decompression (each with its own decompressor: unlzw3 + splitlines
+    for create_df_regex, lzw_utils.unlzw_into for create_df) plus parsing. The decompression of each path is timed
+    on its own as well, such that parsing = total - decompression is split the same way for both.
+    """
+
+    t_total = {'regex':0, 'vec':0}
+    t_unzip = {'regex':0, 'vec':0}
+    rows = 0
+    for path in paths:
+        dt_unzip_regex, _ = best_of(dfu.unzip, repeat, path)
+        dt_unzip_vec, _ = best_of(lzw.unlzw_into, repeat, path)
+        dt_regex, df_regex = best_of(create_df_regex, repeat, path)
+        dt_vec, df_vec = best_of(dfu.create_df, repeat, path)
+
+        pd.testing.assert_frame_equal(df_vec, df_regex, check_dtype=False) # same frame as before
+
+        t_unzip['regex'] += dt_unzip_regex
+        t_unzip['vec'] += dt_unzip_vec
+        t_total['regex'] += dt_regex
+        t_total['vec'] += dt_vec
+        rows += len(df_vec)
+
+    print(f'parsed {len(paths)} file(s), {rows} epochs')
+    print(f'{"":<16} {"total [s]":>10} {"decompress [s]":>15} {"parse [s]":>10} {"epochs/s":>12}')
+    for name, key in (('create_df_regex','regex'), ('create_df','vec')):
+        t_parse = t_total[key] - t_unzip[key]
+        print(f'{name:<16} {t_total[key]:>10.3f} {t_unzip[key]:>15.3f} {t_parse:>10.3f} {rows/t_total[key]:>12,.0f}')
+    print(f'speedup: {t_total["regex"]/t_total["vec"]:.1f}x total, '
+          f'{(t_total["regex"]-t_unzip["regex"])/(t_total["vec"]-t_unzip["vec"]):.1f}x parsing')
+
+def bench_parse_multi(paths:list, repeat:int, directory:str, n_sats:int=3):
+    """
+    Benchmarks df_utils.create_df on a synthetic multi satellite .Z-file (*n_sats* satellites, same epochs as the first file).
+    Every satellite of the file must give the same rows as its own single satellite file, in time major order;
+    record ids are mapped to the ids of the .Z-filenames learned from the single satellite files (sp3_utils.learn_sat_ids),
+    ids without single satellite file are kept.
+    """
+
+    sats = [f'L{39+k}' for k in range(n_sats)]
+    phases = 2*np.pi*np.arange(n_sats)/n_sats
+    n_epochs = len(dfu.create_df(paths[0]))
+
+    def Z_file(name, contents):
+        Path(directory + name).write_bytes(compress_lzw(contents))
+        return directory + name
+
+    multi = Z_file('gscmul24.b24001.e24007.DGS.sp3.001.Z', synthetic_sp3(n_epochs, sat=sats, phase=phases))
+    singles = [Z_file(f'gsc{sat.lower()}24.b24001.e24007.DGS.sp3.001.Z', synthetic_sp3(n_epochs, sat=sat, phase=phase)) for sat, phase in zip(sats, phases)]
+    sat_ids = {**sp3.learn_sat_ids(paths), **sp3.learn_sat_ids(singles[1:-1])} # L39: id of the input files, last satellite: record id
+
+    dt_multi, df = best_of(partial(dfu.create_df, sat_ids=sat_ids), repeat, multi)
+    dt_single, _ = best_of(lambda paths: [dfu.create_df(path) for path in paths], repeat, singles)
+
+    # SAME ROWS AS THE SINGLE SATELLITE FILES, ORDERED BY (TIME, SAT_ID)
+    assert df[['time_stamp','sat_id']].apply(tuple, axis=1).is_monotonic_increasing
+    for sat, single in zip(sats, singles):
+        expected = dfu.create_df(single).drop(columns='ctr_id')
+        rows = df[df['sat_id'] == sat_ids.get(sat, sat)].drop(columns='ctr_id').reset_index(drop=True)
+        pd.testing.assert_frame_equal(rows.drop(columns='sat_id'), expected.drop(columns='sat_id'))
+    batches = pd.concat(sp3.iter_sp3_batches(multi, batch_epochs=1000, sat_ids=sat_ids), ignore_index=True)
+    pd.testing.assert_frame_equal(batches, df)
+
+    print(f'\nmulti satellite file: {n_sats} satellites ({", ".join(f"{sat} -> {sat_ids.get(sat, sat)}" for sat in sats)}), {len(df)} rows')
+    print(f'create_df (1 file, {n_sats} satellites): {dt_multi:.3f}s ({len(df)/dt_multi:,.0f} rows/s)')
+    print(f'create_df ({n_sats} single satellite files): {dt_single:.3f}s ({len(df)/dt_single:,.0f} rows/s)')
+
+def bench_store(paths:list, repeat:int, directory:str):
+    """
+    Benchmarks file size and load time of the .csv output against the binary columnar formats.
+    """
+
+    df = pd.concat([dfu.create_df(path) for path in paths])
+
+    print(f'{len(df)} epochs')
+    print(f'{"format":<8} {"size [MB]":>10} {"load [s]":>10} {"load x,y,z [s]":>15}')
+
+    for fmt in ['csv'] + stu.STORE_FORMATS:
+        path = directory + 'sat.' + fmt
+        stu.save_df(df, path)
+
+        if fmt == 'csv':
+            dt, _ = best_of(preputls.LoadSats(path=path).transform, repeat, None)
+            dt_proj = dt # no column projection for .csv-files
+        else:
+            dt, _ = best_of(preputls.LoadColumnar(path=path).transform, repeat, None)
+            dt_proj, _ = best_of(preputls.LoadColumnar(path=path,columns=['x','y','z']).transform, repeat, None)
+
+        print(f'{fmt:<8} {Path(path).stat().st_size/1E6:>10.2f} {dt:>10.3f} {dt_proj:>15.3f}')
+
+    # PREDICATE PUSHDOWN: ONE SATELLITE (OF TWO), FIRST QUARTER OF THE EPOCHS, x,y,z
+    batches = [dfu.create_df(path) for path in paths]
+    batches += [batch.assign(sat_id='ja3') for batch in batches] # second satellite
+    start, end = df['time_stamp'].min(), df['time_stamp'].quantile(0.25)
+    expected = df.loc[df['time_stamp'].between(start, end)].set_index('time_stamp').sort_index()[['x','y','z']]
+
+    print(f'\n{2*len(df)} epochs of 2 satellites, s6a from {start} to {end}: {len(expected)} epochs')
+    print(f'{"format":<8} {"load all, filter [s]":>21} {"pushdown [s]":>13}')
+
+    for fmt in ['csv', 'parquet', stu.DATASET_FORMAT]:
+        path = directory + 'sats.' + fmt
+        if fmt == stu.DATASET_FORMAT:
+            for k, batch in enumerate(batches):
+                stu.write_partition(batch, path, f'part-{k}')
+        elif fmt == 'parquet':
+            stu.batches_to_store(iter(batches), path) # one row group per batch
+        else:
+            stu.save_df(pd.concat(batches, ignore_index=True), path)
+
+        def load_filter():
+            sat = preputls.LoadSats(path=path).transform(None)
+            return sat.loc[(sat['sat_id'] == 's6a') & (sat.index >= start) & (sat.index <= end), ['x','y','z']]
+
+        dt, _ = best_of(load_filter, repeat)
+        dt_push, result = best_of(preputls.LoadSats(path=path, sat_id='s6a', start=start, end=end, columns=['x','y','z']).transform, repeat, None)
+
+        assert np.array_equal(result.to_numpy(), expected.to_numpy()), fmt
+
+        print(f'{fmt:<8} {dt:>21.3f} {dt_push:>13.3f}')
+
+def manager_worker(Z_file:str, shared_list):
+    """
+    Worker of manager_ingest: appends the DataFrame of a .Z-file to a multiprocessing.Manager().list().
+    """
+
+    shared_list.append(dfu.create_df(Z_file))
+
+def manager_ingest(processes:int) -> pd.DataFrame:
+    """
+    Parallel ingest of ./tmp/*.Z handing off DataFrames through a multiprocessing.Manager().list() (previous write_to_df_II).
+    """
+
+    working_dir = os.getcwd() + '/tmp/'
+    Z_files = sorted([working_dir+file for file in os.listdir(working_dir) if file.endswith('.Z')])
+
+    with Manager() as manager:
+        dfs = manager.list()
+        with Pool(processes=processes) as pool:
+            pool.starmap(manager_worker, [(file, dfs) for file in Z_files])
+
+        return pd.concat(list(dfs))
+
+def bench_ingest(paths:list, repeat:int):
+    """
+    Benchmarks df_utils.write_to_df_II against manager_ingest on ./tmp/*.Z for 1, 2, 4, ... processes up to 2*cpu_count()
+    (more processes than CPUs show the cost of oversubscription). Throughput in MB/s of .Z-files as counted by the
+    metrics of write_to_df_II, speedup of write_to_df_II relative to 1 process.
+    """
+
+    size = sum(Path(path).stat().st_size for path in paths) / 1E6
+
+    def shards_ingest(processes):
+        metrics = Metrics(len(paths))
+        df = dfu.write_to_df_II(processes, metrics)
+        return df, metrics.counters()['bytes'] / 1E6
+
+    print(f'{len(paths)} file(s), {size:.1f} MB compressed, {cpu_count()} CPU(s)')
+    print(f'{"processes":>9} {"Manager().list [files/s]":>25} {"write_to_df_II [files/s]":>25} {"[MB/s]":>8} {"speedup":>8}')
+
+    base = None
+    for processes in sorted({2**k for k in range(int(np.log2(2*cpu_count()))+1)} | {cpu_count()}):
+        dt_manager, df_manager = best_of(manager_ingest, repeat, processes)
+        dt_shards, (df_shards, counted) = best_of(shards_ingest, repeat, processes)
+
+        ordered = lambda df: df.sort_values(['time_stamp','sat_id'], kind='stable').reset_index(drop=True)
+        pd.testing.assert_frame_equal(ordered(df_shards), ordered(df_manager)) # same rows as the DataFrame hand-off (which appends in completion order)
+        assert np.isclose(counted, size) # bytes counted by the metrics of write_to_df_II
+        base = base or dt_shards
+
+        print(f'{processes:>9} {len(paths)/dt_manager:>25.2f} {len(paths)/dt_shards:>25.2f} {counted/dt_shards:>8.2f} {base/dt_shards:>7.2f}x')
+
+def unlzw3_lines(path:str) -> list:
+    """
+    Previous decompression path: unlzw3.unlzw, utf-8 decoding and splitting into a list of lines.
+    """
+
+    return unlzw3.unlzw(Path(path)).decode('utf-8').splitlines()
+
+def peak_memory(func, *args) -> float:
+    """
+    Output: peak memory [MB] allocated by func(*args) (tracemalloc)
+    """
+
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return peak / 1E6
+
+def bench_lzw(paths:list, repeat:int):
+    """
+    Benchmarks decompression throughput [MB/s of decompressed data] and peak memory of the previous path (unlzw3_lines)
+    against lzw_utils.unlzw_into (reused buffer) and lzw_utils.unlzw_many (process pool).
+    """
+
+    size = sum(len(unlzw3.unlzw(Path(path))) for path in paths) / 1E6
+    buffer = bytearray()
+
+    def into_buffer(paths):
+        for path in paths:
+            with lzw.unlzw_into(path, buffer):
+                pass
+
+    dt_lines, _ = best_of(lambda paths: [unlzw3_lines(path) for path in paths], repeat, paths)
+    dt_into, _ = best_of(into_buffer, repeat, paths)
+    dt_many, _ = best_of(lambda paths: [len(data) for data in lzw.unlzw_many(paths)], repeat, paths)
+
+    print(f'{len(paths)} file(s), {size:.1f} MB decompressed')
+    print(f'{"path":<26} {"MB/s":>8} {"peak [MB]":>10}')
+    print(f'{"unlzw3 + splitlines":<26} {size/dt_lines:>8.2f} {peak_memory(unlzw3_lines, paths[0]):>10.1f}')
+    print(f'{"unlzw_into":<26} {size/dt_into:>8.2f} {peak_memory(into_buffer, paths[:1]):>10.1f}')
+    print(f'{f"unlzw_many ({cpu_count()} processes)":<26} {size/dt_many:>8.2f} {"-":>10}')
+
+class SlowHandler(SimpleHTTPRequestHandler):
+    """
+    Serves files of a directory (stand-in for CDDIS), answering each request after *latency* seconds.
+    """
+
+    latency = 0.05
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass # quiet
+
+class ThrottlingHandler(SlowHandler):
+    """
+    SlowHandler answering 429 Too Many Requests (Retry-After: 1) if more than *max_active* requests are served at the same time
+    or the request rate exceeds *rate* requests/s (token bucket), like a server protecting itself against aggressive clients.
+    In addition, a fixed *share* of all requests (every 1/share-th) is throttled, alternately with 429 (Retry-After: 1)
+    and 503 Service Unavailable (no Retry-After, i.e. exponential backoff of the client).
+    """
+
+    max_active = 4
+    rate = 50.0
+    share = 0.2
+    lock = threading.Lock()
+    active = 0
+    tokens = 0.0
+    updated = 0.0
+    requests = 0 # number of requests
+    throttled = 0 # number of 429/503 responses
+
+    def do_GET(self):
+        cls = type(self)
+
+        with cls.lock:
+            now = time.monotonic()
+            cls.tokens = min(cls.max_active, cls.tokens + (now - cls.updated)*cls.rate)
+            cls.updated = now
+            cls.requests += 1
+
+            every = round(1/cls.share) if cls.share else 0
+            forced = bool(every) and cls.requests % every == 0 # fixed share
+            status = 503 if forced and (cls.requests // every) % 2 else 429
+
+            accept = not forced and cls.active < cls.max_active and cls.tokens >= 1
+            if accept:
+                cls.active += 1
+                cls.tokens -= 1
+            else:
+                cls.throttled += 1
+
+        if not accept:
+            self.send_response(status)
+            if status == 429:
+                self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        try:
+            super().do_GET()
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+class TracingLimiter(dlu.RateLimiter):
+    """
+    dl_utils.RateLimiter recording its concurrency limit after every request (trace) and the number of Retry-After pauses (blocks).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.trace = [self.limit]
+        self.blocks = 0
+
+    def release(self, ok:bool=True):
+        with self.condition:
+            super().release(ok)
+            self.trace.append(self.limit)
+
+    def block(self, seconds:float):
+        with self.condition:
+            super().block(seconds)
+            self.blocks += 1
+
+def serve(directory:str, latency:float, handler=SlowHandler):
+    """
+    Starts a local (threading) HTTP server for *directory* in a background thread.
+    Output: server (call shutdown() to stop), base url
+    """
+
+    handler = type('Handler', (handler,), {'latency':latency})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(handler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f'http://127.0.0.1:{server.server_address[1]}/'
+
+def max_rss_children() -> float:
+    """
+    Output: peak resident memory [MB] of the largest terminated child process (resource.getrusage)
+    """
+
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    return rss / 1E6 if sys.platform == 'darwin' else rss / 1E3 # bytes on macOS, KiB on Linux
+
+def bench_download(paths:list, repeat:int, directory:str, concurrency:int, latency:float):
+    """
+    Benchmarks dl_utils.download_Z_async against dl_utils.download_Z_II (process pool of cpu_count() processes)
+    on a local HTTP server with a fixed response latency.
+    Memory: peak of the parent process (tracemalloc) plus, for the process pool, cpu_count() times the peak resident memory of a worker.
+    """
+
+    server, base = serve(str(Path(paths[0]).parent), latency)
+    urls = [base + Path(path).name for path in paths]
+    size = sum(Path(path).stat().st_size for path in paths) / 1E6
+
+    save_path = directory + 'download/'
+    Path(save_path).mkdir(exist_ok=True)
+
+    def clean():
+        shutil.rmtree(save_path, ignore_errors=True)
+        Path(save_path).mkdir() # download_Z_async skips files already present
+
+    def pool_download():
+        clean()
+        with requests.Session() as session:
+            dlu.download_Z_II(session, urls, save_path, False)
+
+    def async_download():
+        clean()
+        with requests.Session() as session:
+            assert not dlu.download_Z_async(session, urls, save_path, False, concurrency=concurrency, limiter=dlu.RateLimiter(rate=1E9, concurrency=concurrency)) # no rate limit (local server)
+
+    print(f'{len(paths)} file(s), {size:.1f} MB compressed, {latency*1E3:.0f} ms latency per request')
+
+    dt_pool, _ = best_of(pool_download, repeat)
+    mem_pool = peak_memory(pool_download) + cpu_count()*max_rss_children()
+    dt_async, _ = best_of(async_download, repeat)
+    mem_async = peak_memory(async_download)
+
+    for path in paths:
+        assert Path(save_path + Path(path).name).read_bytes() == Path(path).read_bytes()
+
+    server.shutdown()
+
+    print(f'\n{"engine":<36} {"files/s":>8} {"MB/s":>8} {"memory [MB]":>12}')
+    print(f'{f"download_Z_II ({cpu_count()} processes)":<36} {len(paths)/dt_pool:>8.1f} {size/dt_pool:>8.2f} {mem_pool:>12.1f}')
+    print(f'{f"download_Z_async (concurrency {concurrency})":<36} {len(paths)/dt_async:>8.1f} {size/dt_async:>8.2f} {mem_async:>12.1f}')
+
+def bench_pipeline(paths:list, repeat:int, directory:str, concurrency:int, latency:float):
+    """
+    Benchmarks ingest_utils.ingest_pipeline (with temporary .Z-files and in memory) against the phased ingest
+    (dl_utils.download_Z_async, then parsing and writing) on a local HTTP server with a fixed response latency.
+    All write a .parquet-file; the in-memory pipeline additionally appends to a partitioned dataset.
+    """
+
+    server, base = serve(str(Path(paths[0]).parent), latency)
+    urls = [base + Path(path).name for path in paths]
+
+    save_path = directory + 'download/'
+    Path(save_path).mkdir(exist_ok=True)
+
+    def download():
+        shutil.rmtree(save_path, ignore_errors=True)
+        Path(save_path).mkdir() # download_Z_async skips files already present
+        with requests.Session() as session:
+            assert not dlu.download_Z_async(session, urls, save_path, False, concurrency=concurrency, limiter=dlu.RateLimiter(rate=1E9, concurrency=concurrency)) # no rate limit (local server)
+
+    def parse():
+        files = [save_path + Path(path).name for path in paths]
+        rows = stu.batches_to_store((dfu.create_df(file) for file in files), directory + 'phased.parquet')
+        for file in files:
+            os.remove(file)
+        return rows
+
+    def pipeline():
+        with requests.Session() as session:
+            assert not ingu.ingest_pipeline(session, urls, save_path, directory + 'pipeline.parquet', download_workers=concurrency, limiter=dlu.RateLimiter(rate=1E9, concurrency=concurrency))
+
+    def in_memory(save:str):
+        shutil.rmtree(save, ignore_errors=True)
+        with requests.Session() as session:
+            assert not ingu.ingest_pipeline(session, urls, None, save, download_workers=concurrency, limiter=dlu.RateLimiter(rate=1E9, concurrency=concurrency))
+
+    dt_download, dt_parse = np.inf, np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        download()
+        t1 = time.perf_counter()
+        parse()
+        t2 = time.perf_counter()
+        dt_download, dt_parse = min(dt_download, t1 - t0), min(dt_parse, t2 - t1)
+
+    dt_pipeline, _ = best_of(pipeline, repeat)
+    dt_memory, _ = best_of(partial(in_memory, directory + 'memory.parquet'), repeat)
+
+    # BYTES WRITTEN BY THIS PROCESS (.Z-FILES AND OUTPUT; THE PARSE PROCESSES ONLY READ)
+    written = {}
+    for name, run in [('pipeline', pipeline), ('in memory', partial(in_memory, directory + 'memory.parquet')), ('in memory (dataset)', partial(in_memory, directory + 'memory.dataset'))]:
+        w0 = written_bytes()
+        run()
+        written[name] = written_bytes() - w0
+
+    server.shutdown()
+
+    phased = stu.read_store(directory + 'phased.parquet').sort_values(stu.TIME_COLUMN, ignore_index=True)
+    pipelined = stu.read_store(directory + 'pipeline.parquet').sort_values(stu.TIME_COLUMN, ignore_index=True)
+    pd.testing.assert_frame_equal(phased, pipelined)
+    pd.testing.assert_frame_equal(phased, stu.read_store(directory + 'memory.parquet').sort_values(stu.TIME_COLUMN, ignore_index=True))
+    pd.testing.assert_frame_equal(phased, stu.read_store(directory + 'memory.dataset')[phased.columns].sort_values(stu.TIME_COLUMN, ignore_index=True), check_dtype=False, check_categorical=False)
+
+    print(f'\n{len(paths)} file(s), {latency*1E3:.0f} ms latency per request, {concurrency} simultaneous downloads, {cpu_count()} parse process(es)')
+    print(f'phased:   {dt_download+dt_parse:.3f}s (download {dt_download:.3f}s + parse and write {dt_parse:.3f}s)')
+    print(f'pipeline: {dt_pipeline:.3f}s (max of stages: {max(dt_download, dt_parse):.3f}s)')
+    print(f'in memory: {dt_memory:.3f}s')
+    for name, n in written.items():
+        print(f'written to disk, {name}: {n/1E6:.1f} MB')
+
+def written_bytes() -> int:
+    """
+    Output: number of bytes written to storage by this process so far (Linux: /proc/self/io; sockets, e.g. of the local server, are not counted), 0 if unavailable
+    """
+
+    try:
+        with open('/proc/self/io') as file:
+            return next(int(line.split()[1]) for line in file if line.startswith('write_bytes'))
+    except (OSError, StopIteration):
+        return 0
+
+def bench_throttle(paths:list, directory:str, concurrency:int, latency:float, n_downloads:int=40):
+    """
+    Benchmarks downloads (dl_utils.download_Z_async) from a throttling local HTTP server (ThrottlingHandler):
+    *concurrency* simultaneous downloads without rate limit against the adaptive dl_utils.RateLimiter starting at the same concurrency.
+    The files are served under *n_downloads* names in total (links), such that enough requests are throttled.
+    Asserts that the throttled requests were retried (Retry-After pauses and backoff) and that the adaptive concurrency shrank and recovered.
+    """
+
+    # SERVE EACH FILE UNDER SEVERAL NAMES
+    served = directory + 'served/'
+    shutil.rmtree(served, ignore_errors=True)
+    Path(served).mkdir()
+    names = []
+    for k in range(max(n_downloads, len(paths))):
+        path = paths[k % len(paths)]
+        names.append(f'{k:04d}_' + Path(path).name)
+        os.symlink(Path(path).resolve(), served + names[-1])
+
+    size = sum(Path(served + name).stat().st_size for name in names) / 1E6
+
+    print(f'{len(names)} download(s) of {len(paths)} file(s), {size:.1f} MB compressed, {latency*1E3:.0f} ms latency per request')
+    print(f'server: at most {ThrottlingHandler.max_active} simultaneous requests and {ThrottlingHandler.rate:.0f} requests/s, else 429 (Retry-After: 1),')
+    print(f'        and every {round(1/ThrottlingHandler.share)}th request answered with 429 (Retry-After: 1) or 503 (no Retry-After)\n')
+
+    results = []
+
+    for name, limiter in [(f'fixed (concurrency {concurrency})', TracingLimiter(rate=1E9, concurrency=concurrency, adaptive=False)),
+                          (f'adaptive (start {concurrency}, {dlu.RATE:.0f} requests/s)', TracingLimiter(concurrency=concurrency))]:
+
+        server, base = serve(served, latency, ThrottlingHandler)
+        urls = [base + name_ for name_ in names]
+        save_path = directory + 'download/'
+        shutil.rmtree(save_path, ignore_errors=True)
+        Path(save_path).mkdir()
+
+        handler = server.RequestHandlerClass.func
+        handler.requests = 0
+        handler.throttled = 0
+        metrics = Metrics()
+
+        t0 = time.perf_counter()
+        with requests.Session() as session:
+            failed = dlu.download_Z_async(session, urls, save_path, False, concurrency=concurrency, limiter=limiter, metrics=metrics)
+        dt = time.perf_counter() - t0
+
+        server.shutdown()
+
+        counters = metrics.counters()
+        results.append((name, dt, handler.throttled, counters.get('retries', 0), limiter.blocks, len(failed), min(limiter.trace), limiter.limit))
+
+        # THROTTLING WAS HANDLED: RETRIES, RETRY-AFTER PAUSES
+        assert handler.throttled > 0 and counters.get('throttled', 0) > 0 and counters.get('retries', 0) > 0
+        assert limiter.blocks > 0
+
+        if limiter.adaptive:
+            assert not failed
+            for name_ in names:
+                assert Path(save_path + name_).read_bytes() == Path(served + name_).read_bytes()
+
+            # AIMD: THE CONCURRENCY SHRANK (MULTIPLICATIVE DECREASE) AND GREW AGAIN AFTERWARDS (ADDITIVE INCREASE)
+            low = int(np.argmin(limiter.trace))
+            assert limiter.trace[low] < limiter.trace[0]
+            assert max(limiter.trace[low:]) > limiter.trace[low]
+
+    print(f'\n{"limiter":<40} {"time [s]":>9} {"files/s":>8} {"429/503":>8} {"retries":>8} {"pauses":>7} {"failed":>7} {"min concurrency":>16} {"final concurrency":>18}')
+    for name, dt, throttled, retries, blocks, failed, low, limit in results:
+        print(f'{name:<40} {dt:>9.2f} {len(names)/dt:>8.1f} {throttled:>8} {retries:>8} {blocks:>7} {failed:>7} {low:>16.1f} {limit:>18.1f}')
+
+
+def load_states(paths:list) -> pd.DataFrame:
+    """
+    Output: states of the .Z-files in [m] and [m/s] (as after preprocessing_utils.ConvertUnits)
+    """
+
+    sat = pd.concat([dfu.create_df(path) for path in paths], ignore_index=True)
+
+    return preputls.ConvertUnits().transform(sat)
+
+def bench_elements(paths:list, repeat:int):
+    """
+    Benchmarks the fused evaluation of orbital elements (kepler_utils.compute_elements) against calling one
+    kepler_utils function per element, for each element set of preprocessing_utils.OrbitalElements. Results must be identical.
+    Subsets of elements only compute the intermediates they depend on (kepler_utils.schedule).
+    """
+
+    sat = load_states(paths)
+    r_vec, v_vec = sat[['x','y','z']].values, sat[['vx','vy','vz']].values
+
+    print(f'{len(sat)} epoch(s)\n')
+    print(f"{'elements':12s} {'per function [s]':>17s} {'fused [s]':>10s} {'speedup':>8s}")
+
+    with np.errstate(invalid='ignore', divide='ignore'): # degenerate elements (e.g. circular orbits) are nan
+        for name, elements in kutls.ELEMENT_SETS.items():
+            dt_function, expected = best_of(lambda: {elem:getattr(kutls, elem)(sat) for elem in elements}, repeat)
+            dt_fused, result = best_of(kutls.compute_elements, repeat, r_vec, v_vec, elements)
+            expected_all = result
+
+            for elem in elements:
+                if expected[elem].shape == result[elem].shape: # degenerate f, g, q1, q2 of the functions have N*6 rows
+                    assert np.array_equal(expected[elem], result[elem], equal_nan=True), elem
+
+            print(f'{name:12s} {dt_function:17.3f} {dt_fused:10.3f} {dt_function/dt_fused:7.1f}x')
+
+        # DEPENDENCY GRAPH: SUBSETS ONLY COMPUTE WHAT THEY NEED
+        print(f"\n{'elements':16s} {'quantities':>10s} {'time [s]':>9s} {'of all':>7s}")
+
+        for elements in [kutls.ELEMENT_SETS['all'], ['p','q1'], ['a','i'], ['u']]:
+            dt, result = best_of(kutls.compute_elements, repeat, r_vec, v_vec, elements)
+            if len(elements) == len(kutls.ELEMENT_SETS['all']):
+                dt_all = dt
+
+            for elem in elements:
+                assert np.array_equal(result[elem], expected_all.get(elem, result[elem]), equal_nan=True), elem
+
+            print(f"{','.join(elements) if len(elements) < 6 else 'all':16s} {len(kutls.schedule(elements)):10d} {dt:9.3f} {dt/dt_all:6.0%}")
+
+        # BOUNDED TEMPORARIES: PEAK MEMORY OF WHOLE-ARRAY AGAINST CHUNKED EVALUATION
+        elements = kutls.ELEMENT_SETS['all']
+        output = len(elements) * len(sat) * 8 / 1E6
+
+        print(f"\n{'all elements':24s} {'time [s]':>9s} {'peak memory [MB]':>17s} (output: {output:.1f} MB)")
+
+        for label, func in [('compute_elements', partial(kutls.compute_elements, sat, elements=elements))] + \
+                           [(f'chunked ({chunk_size})', partial(kutls.compute_elements_chunked, sat, elements=elements, chunk_size=chunk_size)) for chunk_size in [1 << 12, kutls.CHUNK_SIZE, 1 << 18]]:
+            dt, _ = best_of(func, repeat)
+
+            tracemalloc.start()
+            result = func()
+            peak = tracemalloc.get_traced_memory()[1] / 1E6
+            tracemalloc.stop()
+
+            for elem in elements:
+                assert np.array_equal(result[elem].reshape(-1), expected_all[elem].reshape(-1), equal_nan=True), elem
+
+            print(f'{label:24s} {dt:9.3f} {peak:17.1f}')
+
+def resident_memory() -> tuple:
+    """
+    Output: current and peak resident memory [bytes] of this process (Linux: /proc/self/status), (0, 0) if unavailable
+    """
+
+    try:
+        with open('/proc/self/status') as file:
+            status = dict(line.split(':', 1) for line in file)
+        return int(status['VmRSS'].split()[0]) * 1024, int(status['VmHWM'].split()[0]) * 1024
+    except (OSError, KeyError):
+        return 0, 0
+
+def preprocess(sat:pd.DataFrame, copy:bool) -> pd.DataFrame:
+    """
+    Preprocessing pipeline of the notebooks: drop duplicated time stamps, convert units, add Keplerian elements
+    """
+
+    for transformer in [preputls.DropDuplIdx(copy=copy), preputls.ConvertUnits(copy=copy), preputls.OrbitalElements('kepler', copy=copy)]:
+        sat = transformer.fit_transform(sat)
+
+    return sat
+
+def memory_worker(sat:pd.DataFrame, n_rows:int, copy:bool, duplicates:bool, results):
+    """
+    Worker function (own process) of bench_memory() method: peak resident memory of the preprocessing pipeline on n_rows epochs
+    """
+
+    # TILE THE EPOCHS OF THE .Z-FILES (CONSECUTIVE TIME STAMPS, OPTIONALLY ONE DUPLICATE PER WEEK AS AT THE BOUNDARIES OF THE FILES)
+    index = pd.date_range(sat.index[0], periods=n_rows, freq='min', name='time_stamp')
+    if duplicates:
+        index = index[np.minimum(np.arange(n_rows) + (np.arange(n_rows) % 10080 == 10079), n_rows - 1)]
+    data = pd.DataFrame({col:np.resize(sat[col].to_numpy(), n_rows) for col in sat.columns}, index=index)
+
+    data_bytes = data.memory_usage(deep=True).sum()
+    rss, _ = resident_memory()
+
+    with open('/proc/self/clear_refs', 'w') as file:
+        file.write('5') # reset peak resident memory
+
+    t0 = time.perf_counter()
+    data = preprocess(data, copy)
+    dt = time.perf_counter() - t0
+
+    results.put((data_bytes, data.memory_usage(deep=True).sum(), resident_memory()[1] - rss, dt))
+
+def bench_memory(paths:list, n_rows:int=2_000_000):
+    """
+    Benchmarks the peak resident memory of the preprocessing pipeline (DropDuplIdx, ConvertUnits, OrbitalElements) with copies
+    (default) against copy=False, each in its own process, on the epochs of the .Z-files tiled to n_rows epochs. Results must be identical.
+    The peak is reported relative to the output (input plus element columns), the least any pipeline has to hold.
+    Duplicated time stamps cost one copy of the kept rows in any case (the input is still referenced by the caller).
+    Asserts that copy=False without duplicates peaks at most 1.2x the output.
+    """
+
+    sat = preputls.LoadSats(paths).transform(None)
+    pd.testing.assert_frame_equal(preprocess(sat.copy(), True), preprocess(sat.copy(), False))
+
+    print(f'{n_rows} epoch(s)\n')
+    print(f"{'pipeline':10s} {'duplicates':>10s} {'input [MB]':>11s} {'output [MB]':>12s} {'peak [MB]':>10s} {'x output':>9s} {'time [s]':>9s}")
+
+    results = Manager().Queue()
+
+    for duplicates in [False, True]:
+        for label, copy in [('copy', True), ('copy=False', False)]:
+            worker = Process(target=memory_worker, args=(sat, n_rows, copy, duplicates, results))
+            worker.start()
+            worker.join()
+
+            data_bytes, output_bytes, peak, dt = results.get()
+            peak += data_bytes # resident input plus peak above it
+
+            print(f'{label:10s} {str(duplicates):>10s} {data_bytes/1E6:11.1f} {output_bytes/1E6:12.1f} {peak/1E6:10.1f} {peak/output_bytes:9.2f} {dt:9.3f}')
+
+            if not copy and not duplicates:
+                assert peak <= 1.2 * output_bytes, f'copy=False holds {peak/output_bytes:.2f}x the output' # input and element columns only
+
+def angle_error(x:np.array, y:np.array) -> float:
+    """
+    Output: maximal absolute difference of two arrays of angles [rad] (modulo 2 pi)
+    """
+
+    return np.abs((np.ravel(x) - np.ravel(y) + np.pi) % (2*np.pi) - np.pi).max()
+
+def reference_orbit():
+    """
+    Checks the elements of kepler_utils against a known orbit: example 4.3 of H. D. Curtis, Orbital Mechanics for Engineering Students
+    (r = (-6045, -3490, 2500) km, v = (-3.457, 6.618, 2.533) km/s). E, M and n follow from the published e, nu and a.
+    """
+
+    X = np.array([[-6045E3, -3490E3, 2500E3, -3.457E3, 6.618E3, 2.533E3]])
+    deg = np.deg2rad
+
+    e, nu, a = 0.1712, deg(28.45), 8788E3
+    E = 2*np.arctan(np.sqrt((1 - e)/(1 + e))*np.tan(nu/2))
+    expected = {'h':58310E6, 'e':e, 'i':deg(153.2), 'Omega':deg(255.3), 'omega':deg(20.07), 'nu':nu, 'a':a,
+                'E':E, 'M':E - e*np.sin(E), 'n':np.sqrt(kutls.mu/a**3)}
+    tolerance = {'h':1E-4, 'e':1E-3, 'a':1E-4, 'n':1E-4} # relative (published digits), angles: 0.05 deg
+
+    result = kutls.compute_elements(X, elements=list(expected))
+
+    for elem, value in expected.items():
+        rtol = tolerance.get(elem)
+        assert np.isclose(result[elem].item(), value, rtol=rtol or 0, atol=0 if rtol else deg(0.05)), (elem, result[elem].item(), value)
+
+    print(f'reference orbit (Curtis, example 4.3): {", ".join(expected)} agree')
+
+def bench_kepler(paths:list, repeat:int, n_epochs:int=1_000_000):
+    """
+    Benchmarks the vectorised Kepler solver and the conversion of Keplerian elements to states on random elliptic orbits,
+    and validates the round trip elements -> states -> elements (a, e, i, Omega, omega, nu) and states -> elements -> states
+    (states of the .Z-files).
+    """
+
+    reference_orbit()
+
+    rng = np.random.default_rng(0)
+
+    a = rng.uniform(6.8E6, 4.2E7, n_epochs) # LEO ... GEO [m]
+    e = rng.uniform(1E-3, 0.9, n_epochs)
+    i = rng.uniform(0.05, np.pi - 0.05, n_epochs) # not equatorial
+    Omega, omega, M = rng.uniform(0, 2*np.pi, (3, n_epochs))
+
+    print(f'{n_epochs} random orbit(s), 0.001 <= e <= 0.9\n')
+    print(f"{'':28s} {'time [s]':>9s} {'epochs/s':>12s} {'max |M - E + e sin E|':>22s}")
+
+    for method in ['newton', 'halley']:
+        dt, E = best_of(partial(kutls.solve_kepler, M, e, method), repeat)
+        print(f"{'solve_kepler (' + method + ')':28s} {dt:9.3f} {n_epochs/dt:12.0f} {np.abs(M - E + e*np.sin(E)).max():22.2e}")
+
+    dt, X = best_of(partial(kutls.elements_to_states, a, e, i, Omega, omega, M=M), repeat)
+    print(f"{'elements_to_states (M)':28s} {dt:9.3f} {n_epochs/dt:12.0f}")
+
+    # ROUND TRIP: ELEMENTS -> STATES -> ELEMENTS
+    nu = kutls.true_anomaly(kutls.solve_kepler(M, e), e)
+    with np.errstate(invalid='ignore'):
+        elements = kutls.compute_elements(X, elements=['a','e','i','Omega','omega','nu','M'])
+
+    print('\nround trip elements -> states -> elements (max error):')
+    print(f"a {np.abs(elements['a'].ravel()/a - 1).max():.1e} (relative), e {np.abs(elements['e'].ravel() - e).max():.1e}, "
+          f"i {angle_error(elements['i'], i):.1e}, Omega {angle_error(elements['Omega'], Omega):.1e}, omega {angle_error(elements['omega'], omega):.1e}, "
+          f"nu {angle_error(elements['nu'], nu):.1e}, M {angle_error(elements['M'], M):.1e} rad")
+
+    # ROUND TRIP: STATES -> ELEMENTS -> STATES (.Z-FILES)
+    sat = load_states(paths)
+    X = sat[['x','y','z','vx','vy','vz']].to_numpy()
+    with np.errstate(invalid='ignore'):
+        elements = kutls.compute_elements(X, elements=['a','e','i','Omega','omega','nu'])
+    error = np.abs(kutls.elements_to_states(*elements.values()) - X).max(axis=0)
+
+    print(f'\nround trip states -> elements -> states ({len(X)} epochs of the .Z-files, max error):')
+    print(f'position {error[:3].max()*1E3:.3f} mm, velocity {error[3:].max()*1E3:.3f} mm/s')
+
+if __name__ == "__main__":
+    # PARSE CMD LINE ARGUMENTSS
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('benchmark', choices=['parse','store','ingest','lzw','download','pipeline','throttle','elements','kepler','memory'], help='benchmark to run')
+    parser.add_argument('-i', '--input', default=[], nargs='*', type=str, help='.Z-files to benchmark on (default: synthetic s6a data)')
+    parser.add_argument('-f', '--files', default=4, type=int, help='number of synthetic .Z-files')
+    parser.add_argument('-n', '--epochs', default=10080, type=int, help='number of epochs per synthetic .Z-file')
+    parser.add_argument('-r', '--repeat', default=3, type=int, help='number of repetitions, the best time is reported')
+    parser.add_argument('-j', '--concurrency', default=dlu.DEFAULT_CONCURRENCY, type=int, help='initial number of simultaneous downloads of dl_utils.download_Z_async (see dl_utils.RateLimiter)')
+    parser.add_argument('-l', '--latency', default=0.05, type=float, help='response latency of the local HTTP server in seconds')
+    args = vars(parser.parse_args())
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        Path(tmp + '/tmp/').mkdir() # data directory as used by download_DORIS_data.py
+
+        if args['input']:
+            paths = []
+            for path in sorted(args['input']):
+                paths.append(tmp + '/tmp/' + Path(path).name)
+                os.symlink(Path(path).resolve(), paths[-1])
+        else:
+            print('Writing synthetic data ... ', end='', flush=True)
+            paths = synthetic_Z_files(tmp + '/tmp/', args['files'], args['epochs'])
+            print('done.\n')
+
+        os.chdir(tmp)
+
+        if args['benchmark'] == 'parse':
+            bench_parse(paths, args['repeat'])
+            bench_parse_multi(paths, args['repeat'], tmp + '/')
+        elif args['benchmark'] == 'store':
+            bench_store(paths, args['repeat'], tmp + '/')
+        elif args['benchmark'] == 'lzw':
+            bench_lzw(paths, args['repeat'])
+        elif args['benchmark'] == 'ingest':
+            bench_ingest(paths, args['repeat'])
+        elif args['benchmark'] == 'download':
+            bench_download(paths, args['repeat'], tmp + '/', args['concurrency'], args['latency'])
+        elif args['benchmark'] == 'pipeline':
+            bench_pipeline(paths, args['repeat'], tmp + '/', args['concurrency'], args['latency'])
+        elif args['benchmark'] == 'throttle':
+            bench_throttle(paths, tmp + '/', args['concurrency'], args['latency'])
+        elif args['benchmark'] == 'elements':
+            bench_elements(paths, args['repeat'])
+        elif args['benchmark'] == 'kepler':
+            bench_kepler(paths, args['repeat'])
+        elif args['benchmark'] == 'memory':
+            bench_memory(paths)
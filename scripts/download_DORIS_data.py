@@ -1,7 +1,7 @@
 '''
 This script downloads specified IDS DORIS data from https://cddis.nasa.gov/archive/doris/products/orbits/. 
 
-Usage: download_IDS_DORIS.py [-h] [-v VERBOSE] [-c [CENTER ...]] [-s [SAT ...]] [-b BEGIN] [-e END]
+Usage: download_IDS_DORIS.py [-h] [-v VERBOSE] [-c [CENTER ...]] [-s [SAT ...]] [-b BEGIN] [-e END] [-o PATH] [-fn FILENAME] [-fmt FORMAT] [-be BATCH_EPOCHS] [-j CONCURRENCY] [-rt RATE] [-ca CACHE] [-nc] [-p] [-pw PARSE_WORKERS] [-m] [-mt METRICS]
 
 Options:
   -h, --help            show this help message and exit
@@ -19,11 +19,34 @@ Options:
                         path to save .csv file(s)
   -fn FILENAME, --filename FILENAME
                         filename of .csv file
+  -fmt FORMAT, --format FORMAT
+                        output format: csv, binary columnar parquet, feather, npz, memory-mapped epoch store epochs or incremental partitioned dataset (extension of FILENAME is replaced accordingly) (default: csv)
+  -be BATCH_EPOCHS, --batch_epochs BATCH_EPOCHS
+                        write .csv file batch by batch with bounded memory (number of epochs per batch; 0 = build single DataFrame in parallel) (default: 0)
+  -j CONCURRENCY, --concurrency CONCURRENCY
+                        initial number of simultaneous downloads and directory listing requests (adapts up to dl_utils.MAX_CONCURRENCY requests in flight, see dl_utils.RateLimiter) (default: 8)
+  -rt RATE, --rate RATE
+                        maximal number of requests per second (shared by all downloads; the number of simultaneous downloads adapts to latency and errors) (default: 20.0)
+  -ca CACHE, --cache CACHE
+                        file to cache the directory listings in (revalidated on every run) (default: .cache/listings.json)
+  -nc, --no_cache       do not cache the directory listings (default: False)
+  -p, --pipeline        download, parse and save files in a pipeline of concurrent stages (instead of one phase after the other) (default: False)
+  -pw PARSE_WORKERS, --parse_workers PARSE_WORKERS
+                        number of parse processes of the pipeline (0 = cpu_count()) (default: 0)
+  -m, --in_memory       pipeline without temporary .Z-files: downloads are decompressed and parsed in memory (implies --pipeline) (default: False)
+  -mt METRICS, --metrics METRICS
+                        .json-file to write the download/ingest metrics to (throughput, latency histograms per stage, retries, queue depths) (default: None)
 
 Strategy:
 The script connects to https://cddis.nasa.gov/archive/doris/products/orbits/ using predefined authentification data.
-It then loops through the specified subdirectories of analysis centers and specified subdirectories storing the satellite data.
-It downloads the satellite data into an io.BytesIO stream which is read into a pd.DataFrame which is ultimately written to a .csv-file at a specified/predefined path.
+It then retrieves the listings of the specified subdirectories of analysis centers and satellites concurrently; the listings are cached (see --cache)
+and only downloaded again if the server reports a change, such that repeated runs find the files almost instantly.
+It downloads the satellite data into an io.BytesIO stream which is read into a pd.DataFrame which is ultimately written to a .csv-file (or a binary columnar file, see --format) at a specified/predefined path.
+With --in_memory, no .Z-file is written to disk: each download is decompressed, parsed and written (e.g. appended to a dataset) straight from memory.
+Progress is shown live with throughput (files/s, MB/s), median latency per stage (http, decompress, parse, write), retries and queue depths;
+--metrics writes the full metrics (incl. latency histograms) to a .json-file to find the bottleneck stage.
+With --format dataset, the output is a partitioned dataset with a manifest of ingested .Z-files: reruns only download and parse new or changed files and append them to the dataset
+(changed: the published hash differs from the one recorded at ingestion; files without published hash are identified by name only).
 
 Analysis centers:
 grg : Center for Space Researchgrg : CNES/GRGSs
@@ -54,7 +77,6 @@ swo : Swot
 # SCARPING WEB DATA IMPORTS
 import requests
 from bs4 import BeautifulSoup
-import re
 import sys
 import os
 from pathlib import Path
@@ -68,6 +90,8 @@ sys.path.append(wd + '/src/')# append path to ../src/ for following imports
 
 import dl_utils  as dlu
 import df_utils as dfu
+import store_utils as stu
+import ingest_utils as ingu
 import misc_utils as misc 
 
 
@@ -87,6 +111,16 @@ if __name__ == "__main__":
     parser.add_argument('-e', '--end', default=0, type=int, help='last 2 digits of year of last position (inlusive in search)')
     parser.add_argument('-o', '--path', default=wd+'/sat/', type=str, help='(create) directory to save .csv-file')
     parser.add_argument('-fn', '--filename', default='sat.csv', type=str, help='filename.csv (including extension)')
+    parser.add_argument('-fmt', '--format', default='csv', choices=['csv','parquet','feather','npz','epochs','dataset'], type=str, help='output format: csv, binary columnar, memory-mapped epoch store or incremental partitioned dataset (extension of filename is replaced accordingly)')
+    parser.add_argument('-be', '--batch_epochs', default=0, type=int, help='write .csv-file batch by batch with bounded memory (number of epochs per batch; 0 = build single DataFrame in parallel)')
+    parser.add_argument('-j', '--concurrency', default=dlu.DEFAULT_CONCURRENCY, type=int, help='initial number of simultaneous downloads and directory listing requests (adapts up to dl_utils.MAX_CONCURRENCY requests in flight, see dl_utils.RateLimiter)')
+    parser.add_argument('-rt', '--rate', default=dlu.RATE, type=float, help='maximal number of requests per second (shared by all downloads; the number of simultaneous downloads adapts to latency and errors)')
+    parser.add_argument('-ca', '--cache', default=wd+'/.cache/listings.json', type=str, help='file to cache the directory listings in (revalidated on every run)')
+    parser.add_argument('-nc', '--no_cache', action='store_true', help='do not cache the directory listings')
+    parser.add_argument('-p', '--pipeline', action='store_true', help='download, parse and save files in a pipeline of concurrent stages (instead of one phase after the other)')
+    parser.add_argument('-pw', '--parse_workers', default=0, type=int, help='number of parse processes of the pipeline (0 = cpu_count())')
+    parser.add_argument('-m', '--in_memory', action='store_true', help='pipeline without temporary .Z-files: downloads are decompressed and parsed in memory (implies --pipeline)')
+    parser.add_argument('-mt', '--metrics', default=None, type=str, help='.json-file to write the download/ingest metrics to (throughput, latency histograms per stage, retries, queue depths)')
     args = vars(parser.parse_args())
 
     verbose = args['verbose']
@@ -105,11 +139,6 @@ if __name__ == "__main__":
     begin = args['begin']
     end = args['end']
 
-    # REGEX PATTERN TO FILTER TIME FRAME
-    # pattern for bYY... where begin <= YY <= end
-    b = re.compile(r'.*b([0-9][0-9]).*'.format(t=begin))
-    e = re.compile(r'.*e([0-9][0-9]).*'.format(t=begin))
-
     # SETUP
     Path(wd + '/tmp/').mkdir(parents=True, exist_ok=True) # create DORIS/tmp folder if not existing
     Path(args['path']).mkdir(parents=True, exist_ok=True) # creates folder (including parents) of indicated paths if not existing
@@ -117,7 +146,8 @@ if __name__ == "__main__":
     PATH_TMP = wd + '/tmp/'
     PATH = args['path']+args['filename']
 
-    MAX_RETRIES = 10
+    if args['format'] != 'csv':
+        PATH = str(Path(PATH).with_suffix('.'+args['format'])) # binary columnar output (see store_utils)
 
     SCHEME ='https://'
     BASE = 'cddis.nasa.gov/archive/doris/products/orbits'
@@ -130,8 +160,8 @@ if __name__ == "__main__":
 
     files = [] # name of downloaded files
 
-    # START A SESSION (FOR PERSISTANT COOKIES)
-    with requests.Session() as session:
+    # START A SESSION (FOR PERSISTANT COOKIES AND POOLED CONNECTIONS, SHARED BY ALL DOWNLOADS)
+    with dlu.pooled_session(requests.Session(),args['concurrency']) as session:
 
         # SAVE AUTHENTICATION DATA IN SESSION ATTRIBUTE FOR REUSAGE
         session.auth=(USERNAME, PASSWORD)
@@ -149,123 +179,124 @@ if __name__ == "__main__":
         if r0.ok:
             print('\nLogin successful.\n')
             
-            # LEVEL 1: CONTAINS SUB-DIRECTORIES OF ANALYSIS-CENTERS - LOOP OVER  CENTERS
             t_init = time.time() # starting time
 
             print(f'Retrieving links...\n',flush=True)
-            LINKS = []
 
-            for cID in ctr_id:
-                URL1 = r0.url+cID
+            # LISTINGS OF ALL SATELLITE DIRECTORIES (CONCURRENT REQUESTS, CACHED ON DISK AND REVALIDATED)
+            CACHE = dlu.ListingCache(None if args['no_cache'] else args['cache'])
 
-                for i in range(MAX_RETRIES): # try to get URL1
-                    
-                    try: 
-                        r1 = session.get(URL1)
-            
-                        # print(f'{cID} -> ',end='',flush=True)
-                        if r1.ok:
-
-                            for satID in sat_id:
-                                URL2 = r1.url + satID
-                                
-                                for j in range(MAX_RETRIES): # try to get URL2
-
-                                    try: 
-                                        r2 = session.get(URL2)
-                
-                                        # LEVEL 2: CONTAINS SUB-DIRECTORIEES OF SATELLITES - LOOP OVER SATS 
-                                        print(f'{cID} -> {satID} -> ',end='',flush=True)
-                                        if r2.ok:
-
-                                            # FILTER LINKS FOR THOSE STARTING WITH cccsss... (3-letter center id)(3-letter sat id) AND SPECIFIED TIME FRAME
-                                            p = re.compile(r'^{s}.*'.format(s = cID+satID))
-
-                                            # CHECK IF YEAR WAS SPECIFIED
-                                            if begin == 0 and end == 0:
-                                                LINKS += [s for s in dlu.retrieve_zip_urls(r2) if p.match(s.split('/')[-1])]
-
-                                            elif begin !=0 and end==0:
-                                                LINKS += [b.match(p).group(0) for p in dlu.retrieve_zip_urls(r2) if b.match(p.split('/')[-1]) and (begin <= int(b.match(p.split('/')[-1]).group(1)))] 
-                                                # LINKS += [s for s in retrieve_zip_urls(r2) if p.match(s.split('/')[-1]) and b.match(s.split('/')[-1])]
-
-                                            elif begin == 0 and end != 0:
-                                                LINKS += [b.match(p).group(0) for p in dlu.retrieve_zip_urls(r2) if b.match(p.split('/')[-1]) and (int(b.match(p.split('/')[-1]).group(1)) <= end)] 
-                                                # LINKS += [s for s in retrieve_zip_urls(r2) if p.match(s.split('/')[-1]) and e.match(s.split('/')[-1])]
-
-                                            else:
-                                                LINKS += [b.match(p).group(0) for p in dlu.retrieve_zip_urls(r2) if b.match(p.split('/')[-1]) and (begin <= int(b.match(p.split('/')[-1]).group(1)) <= end)] 
-
-                                                # LINKS += [s for s in retrieve_zip_urls(r2) if p.match(s.split('/')[-1]) and ((b.match(s.split('/')[-1]) or e.match(s.split('/')[-1])))]
-                                                
-                                            print('done.',flush=True)
-
-                                            # SET LINKS WHICH ARE ALREADY DOWNLOADED CTR FOR LATER USE: IF CONNECTION TIMES OUT, RESTART WITH LINKS WHICH ARE NOT YET DOWNLOADED.
-                                            # currupt_links = []
-
-                                            if len(LINKS) == 0:
-                                                print(f'{cID} has no data for {satID} for specified time frame.\n')
-                                                
-                                            r2.close() # close response
-                                            break # break out of MAX_RETRIES loop
-
-                                        else:
-                                            print(f'failed: {r2.status_code}')
-                                            r2.close()
-                                            break # break out of MAX_RETRIES loop
-
-                                    except requests.exceptions.ConnectionError:
-                                        print(f'Connection lost. Reconnecting.')
-                                        time.sleep(1)
-
-                                    if j == MAX_RETRIES-1:
-                                        print('Maximal number of retries exceeded. ')
-                                        exit()
-                        else:
-                            print(f'failed: {r1.status_code}')
-                            
-                        r1.close() # close response
-                        break # break out of MAX_RETRIES loop
-                        
-                    except requests.exceptions.ConnectionError:
-                        print(f'Connection lost. Reconnecting.')
-                        time.sleep(1)
-
-                    if i == MAX_RETRIES-1:
-                        print('Maximal number of retries exceeded. ')
-                        exit()
+            # RATE LIMITER SHARED BY ALL REQUESTS: TOKEN BUCKET, BACKOFF WITH JITTER, RETRY-AFTER, ADAPTIVE CONCURRENCY
+            LIMITER = dlu.RateLimiter(rate=args['rate'],concurrency=args['concurrency'])
+
+            listings = dlu.crawl(session,r0.url,ctr_id,sat_id,cache=CACHE,limiter=LIMITER)
+
+            # INDEX OF ALL .Z-FILES: FILTER FOR SPECIFIED TIME FRAME
+            INDEX = dlu.file_index(listings)
+            LINKS = dlu.select_urls(INDEX,begin,end)
+
+            # HASH FILES OF THE SATELLITE DIRECTORIES (TO VERIFY THE DOWNLOADS)
+            HASH_URLS = [url for links in listings.values() for url in links if dlu.is_hash_file(url)]
+
+            selected = INDEX[INDEX['url'].isin(LINKS)]
+            for cID, satID in listings:
+                n = int(((selected['ctr_id'] == cID) & (selected['sat_id'] == satID)).sum())
+                if n == 0:
+                    print(f'{cID} has no data for {satID} for specified time frame.')
+                elif verbose:
+                    print(f'{cID} -> {satID} -> {n} file(s)')
 
             print('\n... complete.\n')
 
+            # PUBLISHED HASHES OF THE .Z-FILES
+            HASHES = dlu.retrieve_hashes(session,HASH_URLS,LIMITER)
+
+            print(f'{len(HASHES)} published hash(es) retrieved.\n')
+
+            if args['format'] == 'dataset':
+                # SKIP FILES ALREADY INGESTED INTO THE DATASET AND UNCHANGED ON THE SERVER (SAME PUBLISHED HASH, see ingest_utils.Manifest.is_current)
+                manifest = ingu.manifest_of(PATH)
+                LINKS = [link for link in LINKS if not manifest.is_current(link.split('/')[-1],HASHES.get(link.split('/')[-1]))]
+
+                print(f'{len(manifest)} file(s) already ingested into {PATH}.\n')
+
             #  COLLECT FILENAMES
             files = list(map(lambda s: PATH_TMP + s.split('/')[-1],LINKS)) # add filenames
 
-            # PARALLEL DONWLOAD
+            if args['pipeline'] or args['in_memory']:
+                # PIPELINED DOWNLOAD, PARSING AND WRITING (NETWORK AND CPUS BUSY AT THE SAME TIME)
+                print(f'Starting pipeline ({len(LINKS)} files): downloading, parsing and saving to {PATH} ...\n')
+
+                METRICS = misc.Metrics(len(LINKS))
+
+                failed = ingu.ingest_pipeline(session,LINKS,None if args['in_memory'] else PATH_TMP,PATH,download_workers=args['concurrency'],parse_workers=args['parse_workers'] or None,hashes=HASHES,limiter=LIMITER,metrics=METRICS)
+
+                if failed:
+                    print(f'\nCould not ingest {len(failed)} file(s):')
+                    for url in failed:
+                        print(url)
+
+                print(f'\n... done. Total time: {time.time()-t_init}s\n')
+
+                files = [file for file in files if os.path.exists(file)] # the parse workers remove processed .Z-files
+
+            else:
+                # PARALLEL DONWLOAD
             
-            print(f'Starting download ({len(LINKS)} files).\n')
+                print(f'Starting download ({len(LINKS)} files).\n')
 
-            t0 = time.time()
+                t0 = time.time()
             
-            dlu.download_Z_II(session,LINKS,PATH_TMP,verbose)
+                METRICS = misc.Metrics()
+
+                failed = dlu.download_Z_async(session,LINKS,PATH_TMP,verbose,concurrency=args['concurrency'],hashes=HASHES,limiter=LIMITER,metrics=METRICS) # resumes interrupted downloads, skips valid files in tmp/
+
+                if failed:
+                    print(f'\nCould not download {len(failed)} file(s):')
+                    for url in failed:
+                        print(url)
+                    failed_names = [url.split('/')[-1] for url in failed]
+                    files = [file for file in files if file.split('/')[-1] not in failed_names] # process the downloaded files only
+
+                print('\n\nDonwload complete.')
+
+                # PRINT TOTAL DOWNLOAD TIME
+                print(f'Total downlad time: {time.time()-t_init}s\n')
+
+                if args['format'] == 'dataset':
+                    # APPEND NEW FILES TO DATASET
+                    print(f'Ingesting into {PATH} ...\n')
+
+                    ingu.ingest_Z_files(files,PATH,hashes=HASHES)
+
+                    print('\n... done.\n')
+
+                elif args['batch_epochs'] > 0:
+                    # STREAM BATCHES OF EPOCHS TO .CSV
+                    print(f'Creating DataFrames and saving to {PATH} ...\n')
+
+                    dfu.write_to_dfs(save_path=PATH,batch_epochs=args['batch_epochs'])
 
-            print('\n\nDonwload complete.')
+                    print('\n... done.\n')
 
-            # PRINT TOTAL DOWNLOAD TIME
-            print(f'Total downlad time: {time.time()-t_init}s\n')
+                else:
+                    # CREATE DATA FRAMES
+                    print('Creating DataFrames ...\n')
 
-            # CREATE DATA FRAMES
-            print('Creating DataFrames ...\n')
+                    # Z_to_csv_II(files, PATH)
+                    df = dfu.write_to_df_II() 
 
-            # Z_to_csv_II(files, PATH)
-            df = dfu.write_to_df_II() 
+                    print('\n... done.\n')
 
-            print('\n... done.\n')
+                    print(f'Saving to {PATH} ... ', end = '')
 
-            print(f'Saving to {PATH} ... ', end = '')
+                    stu.save_df(df,PATH)
 
-            df.to_csv(PATH)
+                    print('done.\n')
 
-            print('done.\n')
+            if args['metrics']:
+                METRICS.save(args['metrics'])
+                print(f"Metrics written to {args['metrics']}.\n")
 
             print('Cleaning up ...')
             for i, file in enumerate(files):
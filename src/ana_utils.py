@@ -50,7 +50,8 @@ def detect_outliers(Idot : pd.Series,
                     n_sigma : int = 3,
                     method : str = 'harmonic',
                     period : float = 60,
-                    n_harmonics : int = 5
+                    n_harmonics : int = 5,
+                    baseline : pd.Series = None
                     # p0 = [1,2*np.pi/60,0,0]
                     )->pd.DataFrame:
     """
@@ -59,13 +60,21 @@ def detect_outliers(Idot : pd.Series,
     * window_size : int -- size of rolling window in minutes (optional, default = 120 minutes)
     * step_size : int -- size of stride in minutes (optional, default = 90 minutes)
     * n_sigma : int -- n-sigma level of confidence 
-    * method : str -- which method (function) is used to plot (optional, default = 'harmonics')
+    * method : str -- which method (function) is used to plot (optional, default = 'harmonics'); 
+                      'baseline': no curve fitting, the residuals are Idot - baseline
     * period : float -- period of the time series data
     * n_harmonics : int -- number of harmonics (optional, default = 5)
+    * baseline : pandas.Series -- physical baseline subtracted from Idot before fitting, e.g. derived from kepler_utils.j2_baseline
+                                  in the same way (time derivative, normalisation) as Idot (optional, default = None)
 
     output: pandas.DataFrame of dates (start and end date) of outliers (maneuvers)
     """
 
+    if baseline is not None:
+        Idot = (Idot - baseline.reindex(Idot.index)).rename(Idot.name) # the fits only need to capture what the model does not
+    elif method == 'baseline':
+        raise ValueError("method 'baseline' requires a baseline")
+
     window_size_ = timedelta(minutes=window_size)
     step_size_ = timedelta(minutes=step_size)
               
@@ -79,6 +88,8 @@ def detect_outliers(Idot : pd.Series,
         p0 = np.array([Idot.loc[start_date,2*np.pi/period,1,0]])
     elif method == 'harmonic':
         p0 = np.array([Idot.loc[start_date],2*np.pi/period]+list(np.zeros(2*n_harmonics)))
+    else:
+        p0 = np.array([]) # no fit
 
     p0_tmp = p0.copy()
 
@@ -93,15 +104,18 @@ def detect_outliers(Idot : pd.Series,
         x = np.arange(len(y))
 
         try:
-            if method == 'harmonic':
+            if method == 'baseline':
+                baseline_ = pd.Series(0.,name='baseline',index=y.index) # already subtracted
+
+            elif method == 'harmonic':
                 fit = curve_fit(harmonics, xdata=x, ydata=y.values,p0=p0_tmp)
-                baseline = pd.Series(harmonics(x,*fit[0]),name='baseline',index=y.index)
+                baseline_ = pd.Series(harmonics(x,*fit[0]),name='baseline',index=y.index)
                 p0_tmp = fit[0]
                 p0_tmp[-1] = harmonics(step_size,*fit[0]) # set guees_intercept to value f(new start = step size)
             
             elif method == 'sin':
                 fit = curve_fit(f, xdata=x, ydata=y.values,p0=p0_tmp)
-                baseline = pd.Series(f(x,*fit[0]),name='baseline',index=y.index)
+                baseline_ = pd.Series(f(x,*fit[0]),name='baseline',index=y.index)
                 p0_tmp = fit[0]
                 p0_tmp[-1] = f(step_size,*fit[0]) # set guees_intercept to value f(new start = step size)
 
@@ -109,11 +123,11 @@ def detect_outliers(Idot : pd.Series,
         except Exception as e:
             print(f'Error in window {start} - {end}. Using previous fit data. -- {e}')
             if method == 'harmonic':
-                baseline = pd.Series(harmonics(x,*fit[0]),name='baseline',index=y.index)
+                baseline_ = pd.Series(harmonics(x,*fit[0]),name='baseline',index=y.index)
             elif method == 'sin':
-                baseline = pd.Series(f(x,*fit[0]),name='baseline',index=y.index)
+                baseline_ = pd.Series(f(x,*fit[0]),name='baseline',index=y.index)
 
-        residuals = y - baseline
+        residuals = y - baseline_
 
         z_score = ( residuals - residuals.mean() ) / residuals.std()
         outliers = z_score[np.abs(z_score) > n_sigma]
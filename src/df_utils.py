@@ -6,7 +6,7 @@ import re
 import os
 
 # PROGRESS BAR IMPORTS
-# import time
+import time
 # import sys
 
 
@@ -17,10 +17,16 @@ from pathlib import Path
 # MULTIPROCESSING IMPORTS
 from multiprocessing import cpu_count 
 from multiprocessing.pool import Pool
-from multiprocessing import Lock, Value, Manager
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing import resource_tracker
+from functools import partial
+from contextlib import nullcontext
 
 # MISC
-from misc_utils import globalise, progress_bar, progress_bar_II
+from misc_utils import Metrics, progress_bar
+import sp3_utils as sp3
+import lzw_utils as lzw
+import store_utils as stu
 
 def unzip(path_zip_file:str):
     """
@@ -42,157 +48,53 @@ def to_df(path_to_file:str='',from_stream:bool=False,stream=[],filename=''):
 
     # CREATE pd.DataFrame WITH COLUMNS
     #  analysis center id (ctr_id) | satellite id (sat_id) | time_stamp | x position (x) | y position (y) | z position (z) | x-momentum (px) | y-momentum (py) | z-momentum (pz)
-    
-    time = []
-    x = []
-    y = []
-    z = []
-    vx = []
-    vy = []
-    vz =[]
 
-    
     if from_stream:
-        filename = filename
-        stream = stream[22:]
-    else:
-        filename = path_to_file.split('/')[-1] # get filename from .Z-file path
-        stream = unzip(path_to_file)[22:]
-
-    for line in stream: # omits header of .Z-file; can be addapted if more documentation is added
-        # split = line.split()
-        num = re.compile(r'-?\d*\.\d*') # regex pattern to filter for number: needed since VL39-64263.5220048 -3451.1598196-26497.1339810 999999.999999 may happen (can't use split)
-        date = re.compile(r'\d*\d')
-
-        # CHECK FIRST CHARACTER OF EACH LINE: 
-        # * -> TIME
-        # P -> POSITION
-        # V -> VELOCITY 
-        if bool(re.search(r'^\*',line)):
-            time.append(
-                pd.to_datetime(
-                    ''.join(
-                        list(
-                            map(lambda s: s.zfill(2),re.findall(date,line)[:-1])
-                            )
-                        )
-                    )
-                )
-        elif bool(re.search(r'^P.*',line)):
-            split = re.findall(num,line)
-            x.append(float(split[0]))
-            y.append(float(split[1]))
-            z.append(float(split[2]))
-        elif bool(re.search(r'^V.*',line)):
-            split = re.findall(num,line)
-            vx.append(float(split[1]))
-            vy.append(float(split[2]))
-            vz.append(float(split[3]))
-        else:
-            pass
-        # if bool(re.search(r'^\*',split[0])):
-        #     time.append(
-        #         pd.to_datetime(
-        #             split[1] + split[2].zfill(2) + split[3].zfill(2) + split[4].zfill(2) + split[5].zfill(2)
-        #             )
-        #         )
-        # elif bool(re.search(r'^P.*',split[0])):
-        #     x.append(float(split[1]))
-        #     y.append(float(split[2]))
-        #     z.append(float(split[3]))
-        # elif bool(re.search(r'^V.*',line[0])):
-        #     vx.append(float(split[1]))
-        #     vy.append(float(split[2]))
-        #     vz.append(float(split[3]))
-        # else:
-        #     pass
-
-
-    ctr_id = [filename[:3]]*len(x)
-    sat_id = [filename[3:6]]*len(x)
-
-    return pd.DataFrame({'ctr_id':ctr_id, 'sat_id':sat_id,'time_stamp':time, 'x':x, 'y':y, 'z':z, 'vx':vx, 'vy':vy, 'vz':vz})
-
-def create_df(path_to_file:str=''):
-    """
-    CREATES pd.DataFrame form .Z-file of stream (decoded in utf-8).
-    Input: .Z-file path; optional: stream, from_stream flag, filename -> used in stream_to_csv
-    Output: pd.DataFrame
-    """
-
-    # CREATE pd.DataFrame WITH COLUMNS
-    #  analysis center id (ctr_id) | satellite id (sat_id) | time_stamp | x position (x) | y position (y) | z position (z) | x-momentum (px) | y-momentum (py) | z-momentum (pz)
-    
-    time = []
-    x = []
-    y = []
-    z = []
-    vx = []
-    vy = []
-    vz =[]
+        data = '\n'.join(stream).encode('utf-8') # re-join list of strings into a single buffer
+        return sp3.parse_sp3(data,filename)
 
     filename = path_to_file.split('/')[-1] # get filename from .Z-file path
-    stream = unzip(path_to_file)[22:]
-
-    # REGEX 
-    num = re.compile(r'-?\d*\.\d*') # regex pattern to filter for number: needed since VL39-64263.5220048 -3451.1598196-26497.1339810 999999.999999 may happen (can't use split)
-    date = re.compile(r'\d*\d')
-
-    # LIST OF DATES
-    dates = [''.join(list(map(lambda s: s.zfill(2),re.findall(date,line)[:-1]))) for line in stream[:-1:3]]  # last entry = 'EOF'
 
-    time = list(map( lambda t: pd.to_datetime(t),  dates ) )
+    with lzw.unlzw_into(path_to_file) as data: # release the buffer once the pd.DataFrame is built
+        return sp3.parse_sp3(data,filename)
 
-    positions=[re.findall(num,line)[:-1] for line in stream[1::3]]
-    x = np.array(positions)[:,0].astype(float)
-    y = np.array(positions)[:,1].astype(float)
-    z = np.array(positions)[:,2].astype(float)
-
-    velocities =[re.findall(num,line)[:-1] for line in stream[2::3]]
-    vx = np.array(velocities)[:,0].astype(float)
-    vy = np.array(velocities)[:,1].astype(float)
-    vz = np.array(velocities)[:,2].astype(float)
-
-    ctr_id = [filename[:3]]*len(x)
-    sat_id = [filename[3:6]]*len(x)
-
-    # time = list(map(
-    #     lambda t: pd.to_datetime(' '.join( list(map(lambda s: s.zfill(2), t.split()[1:-1])) ),format='%Y %m %d %H %M'), stream[:-1:3] # last entry = 'EOF'
-    #     ))
-    # positions = list(map(lambda pos : pos.split()[1:-1], stream[1::3]))
-    # x = np.array(positions)[:,0].astype(float)
-    # y = np.array(positions)[:,1].astype(float)
-    # z = np.array(positions)[:,2].astype(float)
-
-    # velocities = list(map(lambda pos : pos.split()[1:-1], stream[2::3]))
-    # vx = np.array(velocities)[:,0].astype(float)
-    # vy = np.array(velocities)[:,1].astype(float)
-    # vz = np.array(velocities)[:,2].astype(float)
+def create_df(path_to_file:str='',buffer:bytearray=None,time_system:str=None,sat_ids:dict=None):
+    """
+    CREATES pd.DataFrame form .Z-file using the vectorised SP3 parser (sp3_utils.parse_sp3).
+    The .Z-file is decompressed into a byte buffer which is parsed directly (no str or list of lines).
+    Input: .Z-file path; optional: bytearray to decompress into (reused over several calls),
+           time system of the time stamps ('UTC', 'GPS', ...; Default = None, i.e. as given in the file header),
+           satellite ids of multi satellite files (see sp3_utils.parse_sp3; Default = None, i.e. SP3 record ids)
+    Output: pd.DataFrame
+    """
 
-    # ctr_id = [filename[:3]]*len(x)
-    # sat_id = [filename[3:6]]*len(x)
+    filename = path_to_file.split('/')[-1] # get filename from .Z-file path
 
-    return pd.DataFrame({'ctr_id':ctr_id, 'sat_id':sat_id,'time_stamp':time, 'x':x, 'y':y, 'z':z, 'vx':vx, 'vy':vy, 'vz':vz})
+    with lzw.unlzw_into(path_to_file,buffer) as data:
+        return sp3.parse_sp3(data,filename,time_system,sat_ids=sat_ids)
 
-def Z_to_csv(path_to_file:str,save_path:str,progress_bar_len=None):
+def Z_to_csv(path_to_file:str,save_path:str,fmt:str='csv'):
 
     """
     Writes .Z-file to .csv-file.
     Input: .Z-file path; path to save .csv-file.
+    Optional: output format fmt ('csv' or binary columnar 'parquet', 'feather', 'npz' -> see store_utils)
+    Output: size of .Z-file [bytes], time spent parsing and writing [s] (dict stage -> seconds, see misc_utils.Metrics)
     """
     
     filename = path_to_file.split('/')[-1] # get filename
 
+    t0 = time.perf_counter()
     try:
         df = create_df(path_to_file)
     except Exception as e:
         print(f'error in {path_to_file}: {e}')
         exit()
+    t1 = time.perf_counter()
 
-    df.to_csv(save_path+filename+'.csv')
+    stu.save_df(df,save_path+filename+'.'+fmt)
 
-    if progress_bar_len:
-        progress_bar_II(progress_bar_len)
+    return os.path.getsize(path_to_file), {'parse':t1-t0,'write':time.perf_counter()-t1}
 
 def Z_to_csv_II(*args):
     """
@@ -202,23 +104,51 @@ def Z_to_csv_II(*args):
     # UNPACK ARGUMENTS 
     paths_to_files = args[0]
     save_path = args[1]
+    fmt = args[2] if len(args) > 2 else 'csv' # output format
 
-    shared = Value('i', 0)
-    lock = Lock()
-    nb_files = len(paths_to_files)
+    metrics = Metrics(len(paths_to_files))
 
+    with Pool(processes=cpus) as pool, metrics.live():
 
-    with Pool(processes=cpus,initializer=globalise, initargs=[shared, lock]) as pool:
+        # PROGRESS IS RECORDED BY THE PARENT PROCESS ONLY (NO SHARED COUNTER, NO LOCK)
+        for size, timings in pool.imap_unordered(partial(Z_to_csv,save_path=save_path,fmt=fmt),paths_to_files):
+            metrics.count('files')
+            metrics.count('bytes',size)
+            for stage, seconds in timings.items():
+                metrics.observe(stage,seconds)
 
-        pool.starmap_async(Z_to_csv,[(path,save_path,nb_files) for path in paths_to_files])
-    
-        pool.close()
-        pool.join()
+    return metrics
 
-def write_to_dfs():
+def batches_to_csv(batches,save_path:str,mode:str='w'):
+    """
+    Writes DataFrame batches (e.g. from sp3_utils.iter_sp3_batches) one after another to a single .csv-file.
+    Input: iterable of pd.DataFrames; path to .csv-file; mode: 'w' (new file with header) or 'a' (append to existing file)
+    Output: number of written rows
+    """
+
+    rows = 0
+    for batch in batches:
+        batch.index += rows # continue index over batches
+
+        if rows == 0:
+            batch.to_csv(save_path,mode=mode,header=(mode == 'w'))
+        else:
+            batch.to_csv(save_path,mode='a',header=False)
+
+        rows += len(batch)
+
+    return rows
+
+def write_to_dfs(save_path:str=None,batch_epochs:int=1440):
     """
     Creates single big DataFrame (from .Z-file in ./tmp/ directory) and wirtes it to .csv-file.
-    Input: Path to save .csv-file (save_path) including the output filename with .csv-extension. 
+    Input: Path to save .csv-file (save_path) including the output filename with .csv-extension
+    (or .parquet/.feather/.npz-extension for a binary columnar file, see store_utils).
+    Optional: number of epochs per batch (batch_epochs) when writing to save_path
+    Output: DataFrame if no save_path is given, else number of written rows
+
+    If save_path is given, the .Z-files are decompressed, parsed and written batch by batch (sp3_utils.iter_sp3_batches),
+    such that memory stays bounded independent of the number and size of the files.
     """
 
     try:
@@ -228,10 +158,22 @@ def write_to_dfs():
         Z_files = sorted([working_dir+file for file in Z_file_names if file.endswith('.Z')]) # sort to detect overlap in observation date  
         total = len(Z_files) # total number of files
 
+        if save_path:
+            def batches():
+                for i,file in enumerate(Z_files):
+                    yield from sp3.iter_sp3_batches(file,batch_epochs=batch_epochs)
+                    progress_bar(i,total)
+
+            if stu.store_format(save_path) == 'csv':
+                return batches_to_csv(batches(),save_path)
+            else:
+                return stu.batches_to_store(batches(),save_path)
+
         dfs = [] # list of DataFrames 
+        buffer = bytearray() # decompression buffer reused for all files
         
         for i,file in enumerate(Z_files):
-            dfs.append(create_df(file))
+            dfs.append(create_df(file,buffer))
             progress_bar(i,total)
 
         return pd.concat(dfs)
@@ -240,32 +182,70 @@ def write_to_dfs():
         print(f'An error occured: {e}')
         exit()
 
-def write_to_dfs_II_worker(Z_file,shared_list,progress_bar_len=None):
+def shard_columns(buffer,n:int) -> dict:
+    """
+    Columns of a shard of write_to_df_II in one buffer (e.g. shared memory): time stamps [ns] (int64), FLOAT_COLUMNS (float64)
+    and local satellite codes (int32), each *n* rows.
+    Input: buffer of at least SHARD_ROW_BYTES*n bytes, number of rows
+    Output: dict column -> np.array (view of buffer)
+    """
+
+    columns = {stu.TIME_COLUMN:np.ndarray(n,dtype=np.int64,buffer=buffer)}
+    for k,col in enumerate(stu.FLOAT_COLUMNS):
+        columns[col] = np.ndarray(n,dtype=np.float64,buffer=buffer,offset=8*n*(k+1))
+    columns['sat_id'] = np.ndarray(n,dtype=np.int32,buffer=buffer,offset=8*n*(len(stu.FLOAT_COLUMNS)+1))
+
+    return columns
+
+SHARD_ROW_BYTES = 8*(len(stu.FLOAT_COLUMNS)+1) + 4 # bytes per row of a shard (see shard_columns)
+
+def write_to_dfs_II_worker(Z_file):
     """
     Worker function for write_to_dfs_II() method
-    Creates single big DataFrame (from .Z-file in ./tmp/ directory) and wirtes it to .csv-file.
-    Input: Z_file, shared list among processes ( multiprocessing.Manager().list() ) 
-    Optional: number of processes for progress bar (progress_bar_len)
-    Output: DataFrame from .Z-file
+    Parses .Z-file and copies its columns into a shared memory block (see shard_columns),
+    such that only the name of the block (and not the DataFrame) is sent back to the parent process, which unlinks it.
+    Input: Z_file
+    Output: name of the shared memory block, center id, satellite ids (multi-satellite files: codes of each row are in the shard),
+            number of epochs, size of the .Z-file [bytes], time spent parsing and writing [s] (dict stage -> seconds, see misc_utils.Metrics)
     """
 
     try:
-        shared_list.append(create_df(Z_file))
+        filename = Z_file.split('/')[-1]
+        t0 = time.perf_counter()
+        df = create_df(Z_file)
+        t1 = time.perf_counter()
+
+        n = len(df)
+        shm = SharedMemory(create=True,size=max(SHARD_ROW_BYTES*n,1))
+        resource_tracker.unregister(shm._name,'shared_memory') # owned (unlinked) by the parent process
 
-        if progress_bar_len:
-            progress_bar_II(progress_bar_len)
+        columns = shard_columns(shm.buf,n)
+        columns[stu.TIME_COLUMN][:] = df[stu.TIME_COLUMN].values.astype('datetime64[ns]').view(np.int64)
+        for col in stu.FLOAT_COLUMNS:
+            columns[col][:] = df[col].values
+
+        sats, codes = np.unique(df['sat_id'].values.astype(str),return_inverse=True)
+        columns['sat_id'][:] = codes
+
+        del columns # release the exports of shm.buf
+        shm.close()
+
+        return shm.name, filename[:3], sats.tolist(), n, os.path.getsize(Z_file), {'parse':t1-t0,'write':time.perf_counter()-t1}
         
     except Exception as e:
-        print(f'An error occured: {e}')
-        exit()
+        print(f'An error occured in {Z_file}: {e}')
+        raise
 
-def write_to_df_II():
+def write_to_df_II(processes:int=None,metrics:Metrics=None):
     """
     Multiprocess version of write_to_dfs() method.
 
     Creates single big DataFrame (from .Z-file in ./tmp/ directory) and wirtes it to .csv-file.
-    Input: Path to save .csv-file (save_path) including the output filename with .csv-extension.
-    Output: (unordered) DataFrame
+    The workers hand their columns over in shared memory (see write_to_dfs_II_worker), which is copied once into
+    preallocated columns, in sorted file order. The shards of all files are held in memory until the last file is parsed.
+    Optional: number of processes (Default = cpu_count()); metrics (files, bytes of .Z-files, parse and write timings;
+              Default = None, i.e. new Metrics shown live)
+    Output: DataFrame (same rows, order and dtypes as write_to_dfs())
     """
 
     # GET WORKING DIRECTORY AND LIST 
@@ -275,21 +255,54 @@ def write_to_df_II():
 
     nb_files = len(Z_files)
 
-    cpus  = cpu_count()
-
-    manager = Manager()
-    dfs = manager.list()
-
-    shared = Value('i', 0)
-    lock = Lock()
+    cpus  = processes or cpu_count()
 
+    live = metrics is None
+    metrics = metrics or Metrics(nb_files)
 
-    with Pool(processes=cpus,initializer=globalise, initargs=[shared, lock]) as pool:
-
-        pool.starmap_async(write_to_dfs_II_worker,[(file,dfs,nb_files) for file in Z_files])
-    
-        pool.close()
-        pool.join()
-
-        return pd.concat(dfs)
-
+    shards = []
+    try:
+        with Pool(processes=cpus) as pool, metrics.live() if live else nullcontext():
+
+            for name, *info, size, timings in pool.imap(write_to_dfs_II_worker,Z_files): # results in order of Z_files
+                shards.append((SharedMemory(name=name),*info))
+                metrics.count('files')
+                metrics.count('bytes',size)
+                for stage, seconds in timings.items():
+                    metrics.observe(stage,seconds)
+
+        # ASSEMBLE COLUMNS
+        lengths = np.array([n for _,_,_,n in shards],dtype=np.int64)
+        offsets = np.concatenate(([0],np.cumsum(lengths)))
+        total = int(offsets[-1])
+
+        time = np.empty(total,dtype=np.int64)
+        columns = {col:np.empty(total,dtype=np.float64) for col in stu.FLOAT_COLUMNS}
+
+        # SATELLITE IDS: LOCAL CODES OF EACH SHARD -> CODES OF ALL SATELLITES
+        sat_categories = np.unique(np.concatenate([sats for _,_,sats,_ in shards]).astype(str))
+        sat_codes = np.empty(total,dtype=np.int32)
+
+        for k,(shm,_,sats,n) in enumerate(shards):
+            rows = slice(offsets[k],offsets[k+1])
+            shard = shard_columns(shm.buf,n)
+            time[rows] = shard[stu.TIME_COLUMN]
+            for col,values in columns.items():
+                values[rows] = shard[col]
+            sat_codes[rows] = np.searchsorted(sat_categories,sats)[shard['sat_id']]
+            del shard
+
+    finally:
+        shard = None # release the exports of the last shard
+        for shm,*_ in shards:
+            shm.close()
+            shm.unlink()
+
+    # CENTER IDS ARE CONSTANT PER FILE
+    categories, codes = np.unique([shard[1] for shard in shards],return_inverse=True)
+    ids = {'ctr_id':pd.Series(categories[np.repeat(codes,lengths)],dtype=str).values,
+           'sat_id':pd.Series(sat_categories[sat_codes],dtype=str).values} # same dtype as create_df
+
+    index = np.arange(total) - np.repeat(offsets[:-1],lengths) # index restarts for each file (as pd.concat of create_df)
+
+    return pd.DataFrame({**ids,stu.TIME_COLUMN:time.view('datetime64[ns]'),**columns},index=index)
@@ -1,28 +1,261 @@
 # SCARPING WEB DATA IMPORTS
 from bs4 import BeautifulSoup
 import io
+import os
+import re
+import json
+import hashlib
 import time
+import random
+import email.utils
+import threading
+from contextlib import contextmanager, nullcontext
+import pandas as pd
+from pathlib import Path
 from time import sleep
+import requests
+from requests.adapters import HTTPAdapter
 
 
 
 # PARALLELISM
 from multiprocessing import cpu_count 
 from multiprocessing.pool import Pool
-from multiprocessing import Lock, Value
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 
 # MISC
-from misc_utils import progress_bar_II, globalise
+from misc_utils import Metrics, file_digest
+from df_utils import batches_to_csv, to_df
+from sp3_utils import iter_sp3_batches
+from store_utils import save_df
+
+DEFAULT_CONCURRENCY = 8 # number of simultaneous downloads (what the server tolerates, independent of the number of cpus)
+MAX_RETRIES = 3 # number of download rounds for failed urls
+PART_SUFFIX = '.part' # suffix of incomplete downloads (resumed with HTTP range requests)
+
+# HASH FILES OF THE CDDIS ARCHIVE (E.G. MD5SUMS, SHA512SUMS): LINES OF '<hex digest>  <filename>'
+HASH_FILE = re.compile(r'(?i).*(md5|sha[0-9]*)sums?(\.txt)?$')
+HASH_ALGORITHMS = {32:'md5', 40:'sha1', 64:'sha256', 128:'sha512'} # length of hex digest -> hashlib algorithm
+
+# RATE LIMITING AND RETRIES
+RATE = 20.0 # requests per second (token bucket shared by all downloads)
+MAX_CONCURRENCY = 32 # upper bound of the adaptive number of simultaneous requests
+BACKOFF_BASE = 0.5 # first backoff [s], doubled with every retry (full jitter)
+BACKOFF_CAP = 30.0 # maximal backoff [s]
+LATENCY_TOLERANCE = 2.0 # latencies above LATENCY_TOLERANCE x baseline latency reduce the concurrency
+THROTTLE_CODES = (429, 503) # too many requests, service unavailable (Retry-After)
+
+# CDDIS FILENAMES: cccsssYY.bYYDDD.eYYDDD.... (center id, satellite id, first and last day of observations)
+BEGIN_YEAR = re.compile(r'.*\.b([0-9][0-9])')
+
+class Throttled(Exception):
+    """
+    Raised if the server asks to slow down (429 Too Many Requests, 503 Service Unavailable).
+    """
+
+    def __init__(self, url:str, status:int, wait:float=None):
+        super().__init__(f'{status} for url: {url}')
+        self.wait = wait # seconds from Retry-After header (None if not given)
+
+class RateLimiter:
+    """
+    Shared (thread-safe) limiter of the requests of all download threads:
+    a token bucket bounds the request rate, an adaptive limit bounds the number of simultaneous requests.
+    The limit grows by one per *limit* successful requests and is halved on errors, throttling (429/503)
+    or latencies above LATENCY_TOLERANCE times the baseline (additive increase, multiplicative decrease).
+    Retry-After pauses all requests.
+    """
+
+    def __init__(self, rate:float=RATE, burst:int=None, concurrency:int=DEFAULT_CONCURRENCY, max_concurrency:int=MAX_CONCURRENCY, adaptive:bool=True):
+        self.rate = rate
+        self.burst = burst or max(1, concurrency)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+        self.limit = float(concurrency)
+        self.max_concurrency = max(max_concurrency, concurrency) if adaptive else concurrency
+        self.adaptive = adaptive
+        self.active = 0
+
+        self.blocked_until = 0.0 # no requests before (Retry-After)
+        self.baseline = None # smallest observed latency [s]
+
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Waits for a token and a free request slot.
+        """
+
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated)*self.rate)
+                self.updated = now
+
+                if self.active >= int(self.limit):
+                    self.condition.wait() # woken up by release()
+                elif now < self.blocked_until:
+                    self.condition.wait(self.blocked_until - now)
+                elif self.tokens < 1:
+                    self.condition.wait((1 - self.tokens) / self.rate)
+                else:
+                    self.tokens -= 1
+                    self.active += 1
+                    return
+
+    def release(self, ok:bool=True):
+        """
+        Frees a request slot and adapts the limit: additive increase if ok, else multiplicative decrease.
+        """
+
+        with self.condition:
+            self.active -= 1
+
+            if self.adaptive:
+                if ok:
+                    self.limit = min(self.max_concurrency, self.limit + 1/self.limit)
+                else:
+                    self.limit = max(1.0, self.limit/2)
+
+            self.condition.notify_all()
+
+    def observe(self, latency:float):
+        """
+        Records the latency (time to response headers) of a request; latencies far above the baseline reduce the limit.
+        """
+
+        with self.condition:
+            self.baseline = latency if self.baseline is None else min(self.baseline, latency)
+
+            if self.adaptive and latency > LATENCY_TOLERANCE*self.baseline + 0.01: # 10 ms slack for very fast servers
+                self.limit = max(1.0, self.limit*0.9)
+
+    def block(self, seconds:float):
+        """
+        Pauses all requests for *seconds* (Retry-After).
+        """
+
+        with self.condition:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    @contextmanager
+    def slot(self):
+        """
+        Context manager: acquire() on enter, release() on exit (ok, unless an exception was raised).
+        """
+
+        self.acquire()
+        try:
+            yield self
+        except BaseException as e:
+            self.release(ok=not congested(e))
+            raise
+        else:
+            self.release(ok=True)
+
+def congested(e:BaseException) -> bool:
+    """
+    Output: True if the exception indicates an overloaded server or connection (throttling, server error, connection error),
+    False for client errors like 404 Not Found
+    """
+
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is None or e.response.status_code >= 500
+
+    return isinstance(e, (Throttled, requests.exceptions.RequestException, OSError))
+
+def backoff(attempt:int) -> float:
+    """
+    Output: random waiting time [s] before retry number *attempt* (exponential backoff with full jitter)
+    """
+
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+
+def retry_after(response) -> float:
+    """
+    Output: seconds to wait as given by the Retry-After header (seconds or HTTP date), None if not given
+    """
+
+    value = response.headers.get('Retry-After')
+
+    if value is None:
+        return None
 
-def get_url(session,url):
     try:
-        return session.get(url)
-    
-    except Exception as e:
-        print(f'An error occured: {e}')
-        print('retrying...')
-        time.sleep(1)
-        get_url(session,url)
+        return max(0.0, float(value))
+    except ValueError:
+        date = email.utils.parsedate_to_datetime(value)
+        return max(0.0, date.timestamp() - time.time())
+
+def check(response):
+    """
+    Raises Throttled for 429/503 responses and requests.HTTPError for other error responses (closing the response).
+    """
+
+    if response.status_code in THROTTLE_CODES:
+        response.close()
+        raise Throttled(response.url, response.status_code, retry_after(response))
+
+    if response.status_code >= 400:
+        response.close()
+        response.raise_for_status()
+
+def retrying(func, limiter:RateLimiter=None, max_retries:int=MAX_RETRIES, metrics:Metrics=None):
+    """
+    Calls func() in a slot of the limiter and retries on connection errors, server errors (5xx) and throttling,
+    waiting Retry-After seconds (all threads of the limiter) or an exponential backoff with jitter.
+    Other client errors (4xx, e.g. 404) are raised immediately.
+    Input: function performing the request(s); optional: rate limiter (Default = None, i.e. no limit); maximal number of retries;
+           metrics to count the retries ('retries', 'throttled') in
+    Output: result of func()
+    """
+
+    for attempt in range(max_retries+1):
+        try:
+            with limiter.slot() if limiter else nullcontext():
+                return func()
+
+        except Throttled as e:
+            if attempt == max_retries:
+                raise
+            wait = e.wait if e.wait is not None else backoff(attempt)
+            if limiter:
+                limiter.block(wait)
+            if metrics:
+                metrics.count('throttled')
+
+        except requests.exceptions.HTTPError as e:
+            if attempt == max_retries or e.response is None or e.response.status_code < 500:
+                raise
+            wait = backoff(attempt)
+
+        except (requests.exceptions.RequestException, OSError):
+            if attempt == max_retries:
+                raise
+            wait = backoff(attempt)
+
+        if metrics:
+            metrics.count('retries')
+        sleep(wait)
+
+def get_url(session,url,limiter:RateLimiter=None,max_retries:int=MAX_RETRIES,**kwargs):
+    """
+    GET request with rate limiting and retries (see retrying).
+    Input: current session for authentication; url; optional: rate limiter; maximal number of retries; keyword arguments of session.get
+    Output: requests response object (status < 400)
+    """
+
+    def get():
+        t0 = time.monotonic()
+        response = session.get(url,**kwargs)
+        if limiter:
+            limiter.observe(time.monotonic() - t0)
+        check(response)
+        return response
+
+    return retrying(get,limiter,max_retries)
 
 def retrieve_dir(response):
     """
@@ -80,23 +313,23 @@ def downlaod_to_csv(session,url_zip_file:str,save_path:str):
     if response.ok:
         print(f'Downloading and processing {url_zip_file} ... ',end='')
         
-        stream = io.BytesIO(response.content).getvalue() # read contents of .Z-file as bytes-stream
-        uncompressed_data = unlzw3.unlzw(stream).decode('utf-8').splitlines() # unpack using unlzw3 into list of strings (decode using utf-8)
+        batches = iter_sp3_batches(response.content,filename=filename) # decompress and parse contents of .Z-file batch by batch
       
-        stream_to_csv(uncompressed_data,save_path,filename) # write to .csv
+        batches_to_csv(batches,save_path+filename+'.csv') # write to .csv
         
         print('done.')
        
     else:
         print(f'Could not download {url_zip_file}')
 
-def stream_to_csv(stream,save_path:str,filename:str):
+def stream_to_csv(stream,save_path:str,filename:str,fmt:str='csv'):
     """
     Writes contents of stream to .csv-file.
     Input: stream (io.BytesIO object); path to save .csv-file; filename;
+    Optional: output format fmt ('csv' or binary columnar 'parquet', 'feather', 'npz' -> see store_utils)
     """
     df = to_df(stream=stream,from_stream=True,filename=filename)
-    df.to_csv(save_path+filename+'.csv')
+    save_df(df,save_path+filename+'.'+fmt)
 
 
 def downlaod_to_csv_parallel(session,url_zip_file:str,save_path:str,verbose:bool):
@@ -107,24 +340,21 @@ def downlaod_to_csv_parallel(session,url_zip_file:str,save_path:str,verbose:bool
 
     filename = url_zip_file.split('/')[-1][:-2]
    
-    response = session.get(url_zip_file)
-          
-    if response.ok:
-        t0 = time.time() 
- 
-        stream = io.BytesIO(response.content).getvalue()
-        uncompressed_data = unlzw3.unlzw(stream).decode('utf-8').splitlines()
-      
-        stream_to_csv(uncompressed_data,save_path,filename)
-        response.close() # close response explicitly
-        
-        if verbose:
-            print(f'Download {url_zip_file} done: {time.time()-t0:.3f}s')
-        sleep(0.2) # sleep for 200ms to avoid that server blocks us
-        response.close()
-    else:
-        print(f'Could not download {url_zip_file}')
-        response.close()
+    try:
+        response = get_url(session,url_zip_file) # retries with backoff (and Retry-After) instead of fixed sleeps
+    except Exception as e:
+        print(f'Could not download {url_zip_file}: {e}')
+        return
+
+    t0 = time.time() 
+
+    batches = iter_sp3_batches(response.content,filename=filename)
+  
+    batches_to_csv(batches,save_path+filename+'.csv')
+    response.close() # close response explicitly
+    
+    if verbose:
+        print(f'Download {url_zip_file} done: {time.time()-t0:.3f}s')
 
     return url_zip_file # return the .Z-file url when file was downloaded correctly - this ensures that one can restart the download at last successfully downloaded file
 
@@ -146,46 +376,34 @@ def download_to_csv_II(*args):
     with Pool(cpus) as pool:
         pool.starmap(downlaod_to_csv_parallel,zip([session]*len(url_zip_file),url_zip_file,[save_path]*len(url_zip_file),[verbose]*len(url_zip_file))) # need to create list of tuples (session, .Z-file url, save_path) where only the 2nd argument varies
             
-def downlaod_Z(session,url_zip_file:str,save_path:str,verbose,progress_bar_len:int=None,chunk_size=1024):
+def downlaod_Z(session,url_zip_file:str,save_path:str,verbose,chunk_size=1024):
     """
-    Downloads .Z-file and wirtes contents to *save_path*.
-    Input: current session for authentication; urlz of .Z-file; path to save (write) .Z-file (contents); chunk size (Default = 128)
+    Downloads .Z-file and wirtes contents to *save_path* (see fetch_Z: an incomplete download is resumed).
+    Input: current session for authentication; urlz of .Z-file; path to save (write) .Z-file (contents); chunk size (Default = 1024)
+    Output: url of .Z-file, None if downloaded (else the error message), file size [bytes], download time [s]
     """
 
-    filename = url_zip_file.split('/')[-1] # get file name from .Z-file path
-   
-    response = session.get(url_zip_file,stream=True) 
-          
-    if response.ok:
-        t0 = time.time() 
+    t0 = time.time() 
 
-        try:
-            with open(save_path+filename, 'wb') as file: # create new file if not already existing
-                for chunk in response.iter_content(chunk_size=chunk_size):
-                    file.write(chunk)
+    try:
+        nbytes = fetch_Z(session,url_zip_file,save_path,chunk_size)
 
-            if verbose:
-                print(f'Download {url_zip_file} done: {time.time()-t0:.3f}s')
-            else:
-                progress_bar_II(progress_bar_len)
+    except Exception as e: # catch timeout exceptions or any other currupt downloads
+        if verbose:
+            print(f'Could not download {url_zip_file}: {e}')
+        return url_zip_file, str(e), 0, time.time()-t0 # return the error when file could not be downloaded correctly
 
-            response.close()
-            sleep(0.1)
-            
-        except Exception: # catch timeout exceptions or any other currupt downloads
-            # print(f'\nConnection lost. Continue download.\n')
-            response.close()
-            return url_zip_file # return the .Z-file url when file could not be downloaded correctly
-    
-    else:
-        print(f'Could not download {url_zip_file}')
-        response.close()
+    if verbose:
+        print(f'Download {url_zip_file} done: {time.time()-t0:.3f}s')
+
+    return url_zip_file, None, nbytes, time.time()-t0
         
     
 def download_Z_II(*args):
     """
     Download .Z-files in parallel. Uses *donwload_Z_parallel*.
-    Input: *args = (current session for authentification, .Z-file url, path to save .Z-file)
+    Input: *args = (current session for authentification, .Z-file url, path to save .Z-file, verbose)
+    Output: list of urls which could not be downloaded within MAX_RETRIES rounds
     """
     cpus = cpu_count()  # get number of cpus to use in parallel download
 
@@ -196,30 +414,464 @@ def download_Z_II(*args):
     verbose = args[3]
     currupt_urls = []
 
-    # PARALLEL DOWNLOAD: USE starmap TO HANDLE MULTIPLE INPUTS
-    shared = Value('i', 0)
-    lock = Lock()
-    progress_bar_len = len(url_zip_file)
+    for k in range(MAX_RETRIES):
+        metrics = Metrics(len(url_zip_file))
+        currupt_urls = []
 
-    with Pool(processes=cpus,initializer=globalise, initargs=[shared, lock]) as pool:
+        with Pool(processes=cpus) as pool, (nullcontext() if verbose else metrics.live()):
 
-        jobs = pool.starmap_async(downlaod_Z,[(session,url,save_path,verbose,progress_bar_len) for url in url_zip_file])
-    
-        pool.close()
-        pool.join()
+            # PROGRESS IS RECORDED BY THE PARENT PROCESS ONLY (NO SHARED COUNTER, NO LOCK)
+            for url, error, nbytes, seconds in pool.imap_unordered(partial(downlaod_Z,session,save_path=save_path,verbose=verbose),url_zip_file):
+                if error:
+                    currupt_urls.append(url)
+                    metrics.count('failed')
+                else:
+                    metrics.count('files')
+                    metrics.count('bytes',nbytes)
+                    metrics.observe('http',seconds)
 
-        # jobs = pool.starmap(downlaod_Z,[(session,url,save_path,verbose) for url in url_zip_file]) # create list of tuples (session, .Z-file url, save_path, verbose) where only the 2nd argument varies
-        currupt_urls = [currupt_url for currupt_url in jobs.get() if currupt_url]
+        # RESTART DOWNLOAD IF THERE ARE CURRUPT DOWNLOADS (RESUMED WHERE THEY STOPPED)
+        if len(currupt_urls) == 0 or k == MAX_RETRIES-1:
+            break
 
-    # RESTART DOWNLOAD IF THERE ARE CURRUPT DOWNLOADS 
-    if len(currupt_urls) !=0:
         print(f'\n{len(currupt_urls)} currupt download(s) encountered:\n')
-        # for currupt_url in currupt_urls:
-        #     print(currupt_url.split('/')[-1])
         print('Attempting to download missing files...')
-        sleep(1)
-        download_Z_II(session,currupt_urls,save_path,verbose)
-    else:
+        sleep(backoff(k))
+        url_zip_file = currupt_urls
+
+    return currupt_urls
+
+def pooled_session(session=None,concurrency:int=DEFAULT_CONCURRENCY):
+    """
+    Mounts a connection pool large enough for *concurrency* simultaneous requests on a (authenticated) session,
+    such that cookies and keep-alive connections are shared by all downloads.
+    Input: optional: requests.Session (Default = None, i.e. new session); number of simultaneous requests
+    Output: requests.Session
+    """
+
+    session = session or requests.Session()
+
+    adapter = HTTPAdapter(pool_connections=concurrency,pool_maxsize=concurrency)
+    session.mount('https://',adapter)
+    session.mount('http://',adapter)
+
+    return session
+
+def validator(response) -> str:
+    """
+    Returns the validator of a response for If-Range requests: the strong ETag, else Last-Modified (None if neither is sent).
+    """
+
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'): # weak ETags are not allowed in If-Range
+        return etag
+
+    return response.headers.get('Last-Modified')
+
+def complete_size(response) -> int:
+    """
+    Returns the file size of a 416 (range not satisfiable) response, i.e. <size> of 'Content-Range: bytes */<size>' (None if unknown).
+    """
+
+    match = re.fullmatch(r'bytes \*/(\d+)',response.headers.get('Content-Range','').strip())
+
+    return int(match.group(1)) if match else None
+
+def fetch_Z(session,url_zip_file:str,save_path:str,chunk_size:int=1<<16,limiter:RateLimiter=None,max_retries:int=MAX_RETRIES,metrics:Metrics=None) -> int:
+    """
+    Downloads .Z-file (streamed in chunks) and writes contents to *save_path*.
+    The contents are written to <filename>.part, which is renamed once the download is complete. The validator of the first response
+    (ETag, else Last-Modified) is kept in <filename>.part.validator. If a .part-file exists (interrupted download), only the missing
+    bytes are requested (HTTP range request with If-Range): a server sends the whole file instead if the file changed meanwhile or
+    if it ignores the range. A .part-file without validator is downloaded again. A 416 response (range not satisfiable) completes
+    the download only if the .part-file has the size in Content-Range, else the download is restarted.
+    Failed transfers are retried (and resumed) with backoff, see retrying.
+    Input: current session for authentication; url of .Z-file; path to save (write) .Z-file (contents); chunk size (Default = 64 KiB)
+    Optional: rate limiter shared by all downloads; maximal number of retries; metrics ('http' latency of every transfer, 'bytes', retries)
+    Output: size of the downloaded file [bytes]
+    """
+
+    filename = url_zip_file.split('/')[-1] # get file name from .Z-file path
+    part = save_path + filename + PART_SUFFIX
+    part_validator = part + '.validator'
+
+    def restart():
+        for path in (part,part_validator):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def transfer():
+        if os.path.isfile(part) and not os.path.isfile(part_validator): # cannot tell whether the .part-file is still current
+            restart()
+
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        headers = {}
+        if offset:
+            with open(part_validator) as file:
+                headers = {'Range':f'bytes={offset}-','If-Range':file.read()}
+        nbytes = 0
+
+        t0 = time.monotonic()
+        with session.get(url_zip_file,stream=True,headers=headers) as response:
+            if limiter:
+                limiter.observe(time.monotonic() - t0)
+
+            if offset and response.status_code == 416: # range not satisfiable: .part-file complete or longer than the file
+                complete = complete_size(response) == offset
+                if not complete:
+                    restart()
+
+            else:
+                check(response)
+                complete = True
+
+                if response.status_code == 206: # partial content (resume)
+                    mode = 'ab'
+                else: # 200: whole file (new download, file changed or range ignored)
+                    mode = 'wb'
+                    restart()
+                    tag = validator(response)
+                    if tag:
+                        with open(part_validator,'w') as file:
+                            file.write(tag)
+
+                with open(part,mode) as file:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        nbytes += file.write(chunk)
+
+        if metrics:
+            metrics.observe('http',time.monotonic() - t0)
+            metrics.count('bytes',nbytes)
+
+        return complete
+
+    while not retrying(transfer,limiter,max_retries,metrics): # restart after a 416 not matching the .part-file
         pass
 
+    os.replace(part,save_path+filename)
+    restart() # remove the validator
+
+    return os.path.getsize(save_path+filename)
+
+def fetch_bytes(session,url_zip_file:str,limiter:RateLimiter=None,max_retries:int=MAX_RETRIES,metrics:Metrics=None) -> bytes:
+    """
+    Downloads .Z-file into memory (no file is written). Failed transfers are retried with backoff, see retrying.
+    Input: current session for authentication; url of .Z-file; optional: rate limiter shared by all downloads; maximal number of retries;
+           metrics ('http' latency of every transfer, 'bytes', retries)
+    Output: contents of .Z-file (bytes)
+    """
+
+    def transfer():
+        t0 = time.monotonic()
+        with session.get(url_zip_file) as response:
+            if limiter:
+                limiter.observe(time.monotonic() - t0)
+            check(response)
+            data = response.content
+
+        if metrics:
+            metrics.observe('http',time.monotonic() - t0)
+            metrics.count('bytes',len(data))
+
+        return data
+
+    return retrying(transfer,limiter,max_retries,metrics)
+
+def is_hash_file(url:str) -> bool:
+    """
+    Output: True if url points to a hash file (e.g. MD5SUMS, SHA512SUMS)
+    """
+
+    return bool(HASH_FILE.match(url.split('/')[-1]))
+
+def parse_hashes(text:str) -> dict:
+    """
+    Parses the contents of a hash file: lines of '<hex digest>  <filename>' (as written by md5sum, sha512sum, ...).
+    The hash algorithm is inferred from the length of the digest.
+    Input: contents of hash file
+    Output: dict filename -> (algorithm, hex digest)
+    """
+
+    hashes = {}
+
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) < 2 or len(fields[0]) not in HASH_ALGORITHMS:
+            continue # blank or comment line
+
+        digest, filename = fields[0].lower(), fields[-1].lstrip('*') # '*': binary mode marker
+        hashes[filename] = (HASH_ALGORITHMS[len(digest)], digest)
+
+    return hashes
+
+def retrieve_hashes(session,hash_urls:list,limiter:RateLimiter=None) -> dict:
+    """
+    Downloads and parses hash files. If a file is listed in several hash files, the longest digest (strongest algorithm) is kept.
+    Input: current session for authentication; list of hash file urls; optional: rate limiter
+    Output: dict filename -> (algorithm, hex digest)
+    """
+
+    hashes = {}
+
+    for url in hash_urls:
+        try:
+            with get_url(session,url,limiter) as response:
+                for filename, (algorithm, digest) in parse_hashes(response.text).items():
+                    if filename not in hashes or len(digest) > len(hashes[filename][1]):
+                        hashes[filename] = (algorithm, digest)
+
+        except Exception as e:
+            print(f'Could not retrieve hash file {url}: {e}')
+
+    return hashes
+
+def verify_bytes(data:bytes,filename:str,hashes:dict) -> bool:
+    """
+    Checks (downloaded) contents against the published hash of *filename*.
+    Input: contents; filename; dict filename -> (algorithm, hex digest) (see retrieve_hashes)
+    Output: True (valid), False (corrupt) or None (no published hash)
+    """
+
+    expected = hashes.get(filename)
+    if expected is None:
+        return None
+
+    algorithm, digest = expected
+    return hashlib.new(algorithm,data).hexdigest() == digest
+
+def verify_files(paths:list,hashes:dict,workers:int=DEFAULT_CONCURRENCY) -> list:
+    """
+    Checks files against their published hashes, in parallel (hashlib releases the GIL, i.e. threads hash concurrently).
+    Input: list of paths; dict filename -> (algorithm, hex digest) (see retrieve_hashes); number of threads
+    Output: list of True (valid), False (corrupt) or None (no published hash), in order of *paths*
+    """
+
+    def verify(path):
+        expected = hashes.get(path.split('/')[-1])
+        if expected is None:
+            return None
+        algorithm, digest = expected
+        return file_digest(path,algorithm) == digest
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(verify,paths))
+
+def download_Z_round(session,urls:list,save_path:str,verbose:bool,limiter:RateLimiter,metrics:Metrics) -> list:
+    """
+    One round of download_Z_async: downloads all urls in a thread pool of limiter.max_concurrency threads sharing the
+    connection pool of *session*. The requests in flight are bounded by the rate limiter (limiter.limit, which starts at
+    its concurrency and adapts between 1 and limiter.max_concurrency, see RateLimiter): threads without a free slot wait.
+    Input: current session for authentication; list of .Z-file urls; path to save .Z-files; verbose; rate limiter;
+           metrics (progress: 'files', 'failed')
+    Output: list of urls which could not be downloaded
+    """
+
+    def download(url):
+        t0 = time.time()
+        try:
+            nbytes = fetch_Z(session,url,save_path,limiter=limiter,metrics=metrics)
+        except Exception as e:
+            if verbose:
+                metrics.log(f'Could not download {url}: {e}')
+            return url
+
+        if verbose:
+            metrics.log(f'Download {url} done: {time.time()-t0:.3f}s ({nbytes/1E6:.2f} MB)')
+
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=limiter.max_concurrency) as executor:
+        for task in as_completed([executor.submit(download,url) for url in urls]):
+            url = task.result()
+            if url:
+                failed.append(url)
+            metrics.count('failed' if url else 'files') # counted by this thread only
+
+    return failed
+
+def download_Z_async(session,url_zip_file:list,save_path:str,verbose:bool=False,concurrency:int=DEFAULT_CONCURRENCY,max_retries:int=MAX_RETRIES,hashes:dict=None,limiter:RateLimiter=None,metrics:Metrics=None) -> list:
+    """
+    Downloads .Z-files concurrently in a thread pool of blocking requests (replaces the process pool of download_Z_II, see download_Z_round).
+    A single pooled session (see pooled_session) and a rate limiter are shared by all downloads: the number of requests in flight
+    starts at *concurrency* and adapts to latency and errors, up to limiter.max_concurrency (see RateLimiter), which is also
+    the number of threads. Failed transfers are retried with backoff
+    and resumed (see fetch_Z); urls which still fail are downloaded again in up to *max_retries* rounds.
+    If hashes are given, files already present in save_path are only skipped if valid, and every downloaded file is verified;
+    corrupt files are removed and downloaded again.
+    Input: current session for authentication; list of .Z-file urls; path to save .Z-files
+    Optional: verbose; number of simultaneous downloads (Default = 8); maximal number of download rounds (Default = 3);
+              dict filename -> (algorithm, hex digest) (see retrieve_hashes); rate limiter (Default = None, i.e. RateLimiter(concurrency=concurrency));
+              metrics (Default = None, i.e. new misc_utils.Metrics; shown live unless verbose)
+    Output: list of urls which could not be downloaded (or verified)
+    """
+
+    limiter = limiter or RateLimiter(concurrency=concurrency)
+    session = pooled_session(session,limiter.max_concurrency)
+    hashes = hashes or {}
+
+    def corrupt(urls):
+        paths = [save_path+url.split('/')[-1] for url in urls]
+        bad = [url for url, path, valid in zip(urls,paths,verify_files(paths,hashes,concurrency)) if valid is False]
+        for url in bad:
+            os.remove(save_path+url.split('/')[-1])
+        return bad
+
+    # SKIP FILES WHICH ARE ALREADY PRESENT AND VALID
+    present = [url for url in url_zip_file if os.path.isfile(save_path+url.split('/')[-1])]
+    bad = corrupt(present)
+    skip = set(present) - set(bad)
+
+    if skip:
+        print(f'{len(skip)} file(s) already downloaded.')
+    if bad:
+        print(f'{len(bad)} corrupt file(s) removed.')
+
+    urls = [url for url in url_zip_file if url not in skip]
+
+    metrics = metrics if metrics is not None else Metrics()
+    if metrics.total is None:
+        metrics.total = len(urls)
+
+    for k in range(max_retries):
+        if not urls:
+            break
+
+        if k > 0:
+            print(f'\n{len(urls)} currupt download(s) encountered. Attempting to download missing files...')
+            sleep(backoff(k))
+
+        with nullcontext() if verbose else metrics.live():
+            failed = download_Z_round(session,urls,save_path,verbose,limiter,metrics)
+        failed_ = set(failed)
+        downloaded = [url for url in urls if url not in failed_]
+        urls = failed + corrupt(downloaded)
+
+    return urls
+
+class ListingCache:
+    """
+    On-disk cache of parsed directory listings (url -> links), revalidated with conditional requests:
+    a listing is only downloaded and parsed again if the server reports a change (ETag/Last-Modified, else 304 Not Modified).
+    """
+
+    def __init__(self, path:str=None):
+        self.path = Path(path) if path else None
+        self.entries = {}
+
+        if self.path and self.path.is_file():
+            with open(self.path) as file:
+                self.entries = json.load(file)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def links(self, session, url:str, limiter:RateLimiter=None) -> list:
+        """
+        Links of a directory listing (see retrieve_zip_urls), from the cache if unchanged.
+        Input: current session for authentication; url of directory; optional: rate limiter (see get_url)
+        Output: list of urls; empty if the directory does not exist
+        """
+
+        entry = self.entries.get(url)
+
+        headers = {}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            response = get_url(session,url,limiter,headers=headers)
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return [] # no such directory
+            raise
+
+        with response:
+
+            if response.status_code == 304 and entry:
+                return entry['links']
+
+            links = retrieve_zip_urls(response)
+
+            self.entries[url] = {'etag':response.headers.get('ETag'), 'last_modified':response.headers.get('Last-Modified'), 'links':links}
+
+        return links
+
+    def save(self):
+        """
+        Writes the cache (atomically: write to temporary file, then rename).
+        """
+
+        if self.path is None:
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp,'w') as file:
+            json.dump(self.entries, file)
+
+        os.replace(tmp, self.path)
+
+def crawl(session,base_url:str,ctr_ids:list,sat_ids:list,cache:ListingCache=None,concurrency:int=DEFAULT_CONCURRENCY,limiter:RateLimiter=None) -> dict:
+    """
+    Retrieves the listings of all satellite directories base_url/<ctr_id>/<sat_id>/ concurrently.
+    Input: current session for authentication; url of archive (e.g. .../doris/products/orbits/); list of center ids; list of satellite ids
+    Optional: listing cache (Default = None, i.e. no cache); number of simultaneous requests (Default = 8);
+              rate limiter (Default = None, i.e. RateLimiter(concurrency=concurrency))
+    Output: dict (ctr_id, sat_id) -> list of urls in the satellite directory
+    """
+
+    if cache is None:
+        cache = ListingCache() # no cache file
+    limiter = limiter or RateLimiter(concurrency=concurrency)
+    base_url = base_url.rstrip('/') + '/'
+
+    def listing(ids):
+        return cache.links(session,base_url + ids[0] + '/' + ids[1] + '/',limiter) # retries with backoff, see get_url
+
+    dirs = [(ctr_id,sat_id) for ctr_id in ctr_ids for sat_id in sat_ids]
+
+    with ThreadPoolExecutor(max_workers=limiter.max_concurrency) as executor:
+        listings = dict(zip(dirs, executor.map(listing,dirs)))
+
+    cache.save()
+
+    return listings
+
+def file_index(listings:dict) -> pd.DataFrame:
+    """
+    Index of the .Z-files in directory listings (see crawl), used to filter files by satellite and time frame.
+    Input: dict (ctr_id, sat_id) -> list of urls
+    Output: pd.DataFrame with columns ctr_id | sat_id | filename | url | begin (last 2 digits of the year of the first observation; -1 if unknown)
+    """
+
+    rows = []
+
+    for (ctr_id,sat_id), links in listings.items():
+        for url in links:
+            filename = url.split('/')[-1]
+            if not filename.startswith(ctr_id+sat_id) or is_hash_file(url):
+                continue # only files cccsss... (3-letter center id)(3-letter sat id)
+
+            match = BEGIN_YEAR.match(filename)
+            rows.append((ctr_id, sat_id, filename, url, int(match.group(1)) if match else -1))
+
+    return pd.DataFrame(rows, columns=['ctr_id','sat_id','filename','url','begin'])
+
+def select_urls(index:pd.DataFrame,begin:int=0,end:int=0) -> list:
+    """
+    Selects the urls of the files observed from year *begin* to *end* (last 2 digits, inclusive) from a file index.
+    Input: file index (see file_index); optional: first year (0 = no lower bound), last year (0 = no upper bound)
+    Output: list of urls (sorted by filename)
+    """
+
+    keep = pd.Series(True, index=index.index)
+
+    if begin != 0:
+        keep &= (index['begin'] >= begin)
+    if end != 0:
+        keep &= (index['begin'] >= 0) & (index['begin'] <= end)
 
+    return index.loc[keep].sort_values('filename')['url'].tolist()
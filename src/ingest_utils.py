@@ -0,0 +1,378 @@
+# PROCESSING DATA IMPORTS
+import json
+import os
+import hashlib
+import time
+from pathlib import Path
+from functools import partial
+
+# MULTIPROCESSING IMPORTS
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool
+from concurrent.futures import ProcessPoolExecutor
+import queue
+import threading
+
+# MISC
+from misc_utils import Metrics, file_digest
+import df_utils as dfu
+import dl_utils as dlu
+import lzw_utils as lzw
+import sp3_utils as sp3
+import store_utils as stu
+
+MANIFEST_NAME = '_manifest.json' # leading '_': ignored when reading the dataset
+
+QUEUE_SIZE = 8 # maximal number of files waiting between two stages of the pipeline
+STOP = None # end of stream marker passed through the queues of the pipeline
+
+class Manifest:
+    """
+    Persistent record of the .Z-files already ingested into a dataset, keyed by filename,
+    with size, modification time and content hash (sha256) of each file and the number of ingested epochs.
+    """
+
+    def __init__(self, path:str):
+        self.path = Path(path)
+
+        if self.path.is_file():
+            with open(self.path) as file:
+                self.files = json.load(file)
+        else:
+            self.files = {}
+
+    def __contains__(self, filename:str) -> bool:
+        return filename in self.files
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def is_ingested(self, filename:str, size:int=None, digest:str=None) -> bool:
+        """
+        Checks if a file is already ingested. Size and content hash are compared if given.
+        Input: filename; optional: size [bytes], sha256 hex digest
+        Output: bool
+        """
+
+        entry = self.files.get(filename)
+
+        if entry is None:
+            return False
+        if size is not None and entry['size'] != size:
+            return False
+        if digest is not None and entry['sha256'] != digest:
+            return False
+
+        return True
+
+    def is_current(self, filename:str, published:tuple=None) -> bool:
+        """
+        Checks before downloading if a file is ingested and unchanged on the server: the published hash (see dl_utils.retrieve_hashes)
+        must match the one recorded when the file was ingested (or, for sha256, the content hash of the ingested file).
+        A file is changed if its published hash differs or, for entries recorded without published hash, cannot be compared.
+        Without published hash, only the filename is known before downloading: ingested files are considered unchanged.
+        Input: filename; optional: published (algorithm, hex digest)
+        Output: bool
+        """
+
+        entry = self.files.get(filename)
+
+        if entry is None:
+            return False
+        if published is None:
+            return True
+
+        algorithm, digest = published
+        if entry.get('published') is not None:
+            return tuple(entry['published']) == (algorithm, digest)
+
+        return algorithm == 'sha256' and entry['sha256'] == digest
+
+    def is_unmodified(self, filename:str, size:int, mtime:int) -> bool:
+        """
+        Checks without reading the file if it is ingested and neither its size nor its modification time changed since.
+        Input: filename; size [bytes]; modification time [ns] (os.stat_result.st_mtime_ns)
+        Output: bool
+        """
+
+        entry = self.files.get(filename)
+
+        return entry is not None and entry['size'] == size and entry.get('mtime') == mtime
+
+    def record(self, filename:str, size:int, digest:str, rows:int, published:tuple=None, mtime:int=None):
+        """
+        Records an ingested file.
+        Input: filename; size [bytes]; sha256 hex digest; number of ingested epochs; optional: published (algorithm, hex digest),
+               modification time [ns] (see is_unmodified; None for files ingested from memory)
+        """
+
+        self.files[filename] = {'size':size, 'sha256':digest, 'rows':rows, 'published':published, 'mtime':mtime, 'ingested':time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+    def save(self):
+        """
+        Writes the manifest (atomically: write to temporary file, then rename).
+        """
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp,'w') as file:
+            json.dump(self.files, file, indent=1, sort_keys=True)
+
+        os.replace(tmp, self.path)
+
+def manifest_of(root:str) -> Manifest:
+    """
+    Output: manifest of the dataset at *root*
+    """
+
+    return Manifest(Path(root) / MANIFEST_NAME)
+
+def ingest_Z_file(task:tuple, root:str):
+    """
+    Worker function for ingest_Z_files() method
+    Hashes .Z-file and, unless its content hash is the one already ingested, parses it and writes it as part (named after the .Z-file)
+    into the dataset at root.
+    Input: tuple (path to .Z-file, sha256 hex digest of the ingested file of the same name and size or None); path to dataset directory
+    Output: filename, size [bytes], modification time [ns], sha256 hex digest, number of epochs (None if unchanged, i.e. not written)
+    """
+
+    Z_file, ingested = task
+    filename = Path(Z_file).name
+    stat = Path(Z_file).stat()
+    digest = file_digest(Z_file)
+
+    if digest == ingested:
+        return filename, stat.st_size, stat.st_mtime_ns, digest, None
+
+    rows = stu.write_partition(dfu.create_df(Z_file), root, filename)
+
+    return filename, stat.st_size, stat.st_mtime_ns, digest, rows
+
+def ingest_Z_files(Z_files:list, root:str, processes:int=None, hashes:dict=None, metrics:Metrics=None) -> int:
+    """
+    Incrementally ingests .Z-files into the partitioned dataset at root (see store_utils.write_partition).
+    A file is changed if its size or content hash (sha256) differs from the manifest entry of the same name. Files whose size
+    and modification time match the manifest are skipped without reading them (see Manifest.is_unmodified); all other files are
+    hashed once, by the parallel workers, which only parse and (over)write the parts of new or changed files.
+    The manifest is saved after every file, such that an interrupted ingest resumes where it stopped.
+    Input: list of paths to .Z-files; path to dataset directory; optional: number of processes (Default = cpu_count()),
+           dict filename -> published (algorithm, hex digest) to record (see dl_utils.retrieve_hashes, Manifest.is_current);
+           metrics, shown live while the files are hashed and parsed ('files', 'bytes'; Default = None, i.e. new misc_utils.Metrics)
+    Output: number of ingested (new or changed) files
+    """
+
+    manifest = manifest_of(root)
+    hashes = hashes or {}
+
+    todo = []
+    for Z_file in sorted(Z_files):
+        filename = Path(Z_file).name
+        stat = Path(Z_file).stat()
+        if not manifest.is_unmodified(filename, stat.st_size, stat.st_mtime_ns):
+            entry = manifest.files.get(filename)
+            todo.append((Z_file, entry['sha256'] if entry and entry['size'] == stat.st_size else None))
+        elif filename in hashes:
+            manifest.files[filename]['published'] = hashes[filename] # same contents: remember the published hash for Manifest.is_current
+
+    if hashes:
+        manifest.save()
+
+    if not todo:
+        return 0
+
+    metrics = metrics if metrics is not None else Metrics()
+    metrics.total = len(todo)
+    ingested = 0
+
+    with Pool(processes=processes or cpu_count()) as pool, metrics.live():
+
+        for filename, size, mtime, digest, rows in pool.imap(partial(ingest_Z_file, root=root), todo): # results in order of todo
+            if rows is None: # same contents: keep the part
+                manifest.files[filename].update(mtime=mtime, **({'published':hashes[filename]} if filename in hashes else {}))
+            else:
+                manifest.record(filename, size, digest, rows, hashes.get(filename), mtime)
+                ingested += 1
+            manifest.save()
+            metrics.count('files')
+            metrics.count('bytes', size)
+
+    return ingested
+
+def parse_Z(source, filename:str):
+    """
+    Decompresses and parses a .Z-file (as dfu.create_df), timing both stages.
+    Input: path to .Z-file or bytes-like contents; filename of .Z-file
+    Output: pd.DataFrame, dict stage -> seconds ('decompress', 'parse'; see misc_utils.Metrics)
+    """
+
+    t0 = time.perf_counter()
+    with lzw.unlzw_into(source) as view:
+        t1 = time.perf_counter()
+        df = sp3.parse_sp3(view, filename)
+
+    return df, {'decompress':t1-t0, 'parse':time.perf_counter()-t1}
+
+def parse_Z_file(Z_file:str, remove:bool=True):
+    """
+    Worker function of the parse stage of ingest_pipeline() method
+    Decompresses and parses a downloaded .Z-file, which is removed afterwards.
+    Input: path to .Z-file; optional: remove .Z-file (Default = True)
+    Output: filename, size [bytes], sha256 hex digest, pd.DataFrame, dict stage -> seconds
+    """
+
+    path = Path(Z_file)
+    size, digest = path.stat().st_size, file_digest(Z_file)
+
+    df, timings = parse_Z(Z_file, path.name)
+
+    if remove:
+        path.unlink()
+
+    return path.name, size, digest, df, timings
+
+def parse_Z_bytes(data:bytes, filename:str):
+    """
+    Worker function of the parse stage of ingest_pipeline() method (in memory)
+    Decompresses and parses the contents of a .Z-file, without writing it to disk.
+    Input: contents of .Z-file; filename of .Z-file
+    Output: filename, size [bytes], sha256 hex digest, pd.DataFrame, dict stage -> seconds
+    """
+
+    df, timings = parse_Z(data, filename)
+
+    return filename, len(data), hashlib.sha256(data).hexdigest(), df, timings
+
+def ingest_pipeline(session, urls:list, tmp_path:str, save_path:str, download_workers:int=dlu.DEFAULT_CONCURRENCY, parse_workers:int=None, queue_size:int=QUEUE_SIZE, keep_files:bool=False, hashes:dict=None, limiter:dlu.RateLimiter=None, metrics:Metrics=None) -> list:
+    """
+    Downloads, parses and writes .Z-files in a pipeline of three concurrent stages connected by bounded queues:
+        download (threads, dl_utils.fetch_Z) -> decompress and parse (processes, parse_Z_file) -> write (this thread)
+    A file is parsed as soon as its download is complete and written as soon as it is parsed, such that network and cpus
+    are busy at the same time. Full queues block the previous stage, i.e. at most *queue_size* downloaded files wait on disk
+    and at most *queue_size* parsed DataFrames wait in memory.
+    Without tmp_path, the downloads are kept in memory (dl_utils.fetch_bytes, parse_Z_bytes): no .Z-file is written to disk,
+    at most *queue_size* compressed files wait in memory.
+    Input: current session for authentication; list of .Z-file urls; path to save .Z-files to (temporarily; None: in memory);
+           path to output file (.csv, binary columnar file or dataset, see store_utils.save_df)
+    Optional: number of simultaneous downloads (Default = 8, adapted by the rate limiter); number of parse processes (Default = cpu_count());
+              queue size (Default = 8); keep downloaded .Z-files (Default = False);
+              dict filename -> (algorithm, hex digest) to verify the downloads against (see dl_utils.retrieve_hashes);
+              rate limiter shared by the downloads (Default = None, i.e. dl_utils.RateLimiter(concurrency=download_workers));
+              metrics, shown live while the pipeline runs (Default = None, i.e. new misc_utils.Metrics)
+    Output: list of urls which could not be downloaded, verified or parsed
+
+    The metrics record the latency of every stage ('http' per request in the download threads, 'decompress' and 'parse' timed
+    by the parse processes and returned with their results, 'write' in this thread), downloaded bytes, written files, retries
+    and the depths of both queues. Save them with metrics.save(path) to find the bottleneck stage.
+
+    Files are written in the order in which their downloads complete (loaders sort by time stamp).
+    For datasets, every written file is recorded in the manifest (see ingest_Z_files).
+    """
+
+    urls = list(urls)
+    if not urls:
+        return []
+
+    metrics = metrics if metrics is not None else Metrics()
+    if metrics.total is None:
+        metrics.total = len(urls)
+
+    limiter = limiter or dlu.RateLimiter(concurrency=download_workers)
+    session = dlu.pooled_session(session, limiter.max_concurrency)
+    url_of = {url.split('/')[-1]:url for url in urls}
+
+    todo = queue.Queue() # urls to download
+    downloaded = queue.Queue(maxsize=queue_size) # (filename, path or contents) of downloaded .Z-files
+    parsing = queue.Queue(maxsize=queue_size) # futures of parse workers (in order of completed downloads)
+    failed = []
+
+    metrics.watch('downloaded', downloaded)
+    metrics.watch('parsing', parsing)
+
+    for url in urls:
+        todo.put(url)
+    for _ in range(limiter.max_concurrency):
+        todo.put(STOP)
+
+    # STAGE 1: DOWNLOAD
+    def download():
+        while (url := todo.get()) is not STOP:
+            filename = url.split('/')[-1]
+            try:
+                if tmp_path is None:
+                    data = dlu.fetch_bytes(session, url, limiter=limiter, metrics=metrics)
+
+                    if hashes and dlu.verify_bytes(data, filename, hashes) is False:
+                        raise ValueError('hash mismatch')
+
+                    downloaded.put((filename, data))
+                else:
+                    dlu.fetch_Z(session, url, tmp_path, limiter=limiter, metrics=metrics)
+                    Z_file = tmp_path + filename
+
+                    if hashes and dlu.verify_files([Z_file], hashes) == [False]:
+                        os.remove(Z_file)
+                        raise ValueError('hash mismatch')
+
+                    downloaded.put((filename, Z_file))
+            except Exception as e:
+                metrics.log(f'Could not download {url}: {e}')
+                failed.append(url)
+                metrics.count('failed')
+
+    downloaders = [threading.Thread(target=download, daemon=True) for _ in range(limiter.max_concurrency)]
+
+    def close_downloads():
+        for thread in downloaders:
+            thread.join()
+        downloaded.put(STOP)
+
+    # STAGE 2: DECOMPRESS AND PARSE
+    def dispatch(pool):
+        while (item := downloaded.get()) is not STOP:
+            filename, source = item
+            if tmp_path is None:
+                parsing.put((filename, pool.submit(parse_Z_bytes, source, filename)))
+            else:
+                parsing.put((filename, pool.submit(parse_Z_file, source, not keep_files)))
+        parsing.put(STOP)
+
+    # STAGE 3: WRITE
+    def parsed():
+        while (item := parsing.get()) is not STOP:
+            metrics.sample()
+            filename, future = item
+            try:
+                *result, timings = future.result()
+            except Exception as e:
+                metrics.log(f'An error occured in {filename}: {e}')
+                failed.append(url_of[filename])
+                metrics.count('failed')
+                continue
+
+            for stage, seconds in timings.items():
+                metrics.observe(stage, seconds)
+
+            t0 = time.perf_counter()
+            yield result # written while the generator is suspended
+            metrics.observe('write', time.perf_counter() - t0)
+            metrics.count('files')
+
+    with ProcessPoolExecutor(max_workers=parse_workers or cpu_count()) as pool, metrics.live():
+
+        for thread in downloaders + [threading.Thread(target=close_downloads, daemon=True), threading.Thread(target=dispatch, args=(pool,), daemon=True)]:
+            thread.start()
+
+        fmt = stu.store_format(save_path)
+
+        if fmt == stu.DATASET_FORMAT:
+            manifest = manifest_of(save_path)
+            for filename, size, digest, df in parsed():
+                manifest.record(filename, size, digest, stu.write_partition(df, save_path, filename), (hashes or {}).get(filename))
+                manifest.save()
+        elif fmt == 'csv':
+            dfu.batches_to_csv((df for *_, df in parsed()), save_path)
+        else:
+            stu.batches_to_store((df for *_, df in parsed()), save_path)
+
+    return failed
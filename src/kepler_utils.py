@@ -1,11 +1,39 @@
 import pandas as pd
 import numpy as np
 import scipy.constants
+from functools import cached_property
 
 # CONSTANTS 
 M_earth = 5.972E24 # earth mass [kg]
 G = scipy.constants.G # grav constant [m^3 s^{-2} kg^{-1}]
 mu = G*M_earth # standard grav parameter for m (mass moving object) << M_earth [m^3 s^{-2}] 
+R_earth = 6378137.0 # equatorial radius of the earth [m] (WGS84)
+J2 = 1.08262668E-3 # second zonal harmonic of the earth's gravity field (oblateness)
+
+# ELEMENTS (see compute_elements)
+ELEMENT_SETS = {'kepler':['a','e','i','nu','omega','Omega'],
+                'equinoctial':['p','f','g','q1','q2','L'],
+                'all':['a','e','i','nu','omega','Omega','p','f','g','q1','q2','L','E','M','n']}
+ELEMENTS = ['vrad','vperp','H','h','a','e','i','Omega','omega','nu','u','E','M','n','p','f','g','q1','q2','L'] # extended by register_element
+FLAGS = ('i_degenerate','e_degenerate','Omega_nan') # flags of all states, switching the formula of the elements depending on them
+DEPENDENCIES = {# STATES
+                'r_vec':[], 'v_vec':[],
+                # INTERMEDIATES
+                'r':['r_vec'], 'v':['v_vec'], 'h_vec':['r_vec','v_vec'], 'e_vec':['r_vec','v_vec','h_vec','r'], 'e_hat':['e_vec'],
+                'N_vec':['h_vec'], 'N_hat':['N_vec'], 'zeros':['r_vec'],
+                # FLAGS
+                'i_degenerate':['i'], 'e_degenerate':['e'], 'Omega_nan':['Omega'],
+                # ELEMENTS
+                'vrad':['r_vec','v_vec','r'], 'vperp':['v','vrad'],
+                'H':['v','r'], 'h':['h_vec'], 'a':['H'], 'e':['H','h'], 'i':['h_vec','h'], 'Omega':['N_hat'],
+                'omega':['i_degenerate','e_vec','e_hat','N_hat'], 'nu':['e_hat','r_vec','r','vrad'], 'u':['i_degenerate','r_vec','N_hat','r'],
+                'E':['e','nu'], 'M':['E','e'], 'n':['a','e','h'],
+                'p':['a','e'], 'f':['e_degenerate','Omega_nan','zeros','e','omega','Omega'], 'g':['e_degenerate','Omega_nan','zeros','e','omega','Omega'],
+                'q1':['i_degenerate','zeros','i','Omega'], 'q2':['i_degenerate','zeros','i','Omega'], 'L':['Omega','omega','nu']} # quantity -> quantities its formula (see Orbit) uses
+CUSTOM = {} # registered element -> function of its dependencies (see register_element)
+CHUNK_SIZE = 1 << 15 # epochs per chunk of compute_elements_chunked (temporaries of a few MB)
+KEPLER_TOL = 1E-12 # convergence tolerance of solve_kepler [rad]
+KEPLER_MAX_ITER = 50 # maximal number of iterations of solve_kepler
 
 
 # LINEAR ALGEBRA 
@@ -22,267 +50,709 @@ def hat(x:np.array) -> np.array:
     """
     return (x / norm(x))
 
-# r AND v VECTORS
-def rvec(df)->np.array:
+# STATES
+
+def states(X, v_vec:np.array=None):
     """
-    Computes norm of radial position vector $r$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Extracts positions and velocities once, as float64 arrays (no copy if X already is one).
+    Input: DataFrame containing position (x,y,z) and velocity (vx,vy,vz), (N,6) state array [x,y,z,vx,vy,vz],
+           or (N,3) position array and (N,3) velocity array v_vec
+    Output: position and velocity arrays of shape (N,3) (views of the state array)
     """
-    r_vec = df[['x','y','z']].values.reshape(-1,3)
 
-    return r_vec
+    if v_vec is not None:
+        return np.asarray(X,dtype=np.float64).reshape(-1,3), np.asarray(v_vec,dtype=np.float64).reshape(-1,3)
+
+    if isinstance(X,pd.DataFrame):
+        X = X[['x','y','z','vx','vy','vz']].to_numpy(dtype=np.float64)
+
+    X = np.asarray(X,dtype=np.float64).reshape(-1,6)
+
+    return X[:,:3], X[:,3:]
+
+# The functions below accept the states in any form supported by states() (X: DataFrame or (N,6) array,
+# or X, v_vec: (N,3) arrays) and evaluate a single quantity with Orbit. Use compute_elements() for several elements.
+
+# r AND v VECTORS
+def rvec(X, v_vec:np.array=None)->np.array:
+    """
+    Returns the position vectors $r$, shape (N,3)
+    """
+    return states(X,v_vec)[0]
 
-def vvec(df)->np.array:
+def vvec(X, v_vec:np.array=None)->np.array:
     """
-    Computes norm of radial position vector $r$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Returns the velocity vectors $v$, shape (N,3)
     """
-    v_vec = df[['vx','vy','vz']].values.reshape(-1,3)
+    return states(X,v_vec)[1]
 
-    return v_vec
+def vrad(X, v_vec:np.array=None)->np.array:
+    """
+    Computes radial velocity
+    """
+    return Orbit(*states(X,v_vec)).vrad
 
-def vrad(df)->np.array:
+def vperp(X, v_vec:np.array=None)->np.array:
     """
-    Computes radial velocity from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Computes angular velocity
     """
-    v_vec = vvec(df)
-    r_vec = rvec(df)
+    return Orbit(*states(X,v_vec)).vperp
 
-    r = norm(r_vec)
+# CLASSICAL ORBITAL ELEMENTS
 
-    v_rad = np.sum(v_vec*r_vec,axis=1).reshape(-1,1) / r
+def H(X, v_vec:np.array=None)->np.array:
+    """
+    Computes mechanical energy $H$
+    """
+    return Orbit(*states(X,v_vec)).H
+
+def hvec(X, v_vec:np.array=None)->np.array:
+    """
+    Computes orbital momentum $h$
+    """
+    return Orbit(*states(X,v_vec)).h_vec
 
-    return v_rad
+def h(X, v_vec:np.array=None) -> np.array:
+    """
+    Computes norm of orbital momentum $|h|$
+    """
+    return Orbit(*states(X,v_vec)).h
 
-def vperp(df)->np.array:
+def a(X, v_vec:np.array=None):
     """
-    Computes angular velocity from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Computes semi-major axis $a$
     """
-    v_vec = vvec(df)
-    v = norm(v_vec)
-    v_rad = vrad(df)
+    return Orbit(*states(X,v_vec)).a
 
-    v_perp = np.sqrt(v**2 - v_rad**2)
+def Avec(X, v_vec:np.array=None):
+    """
+    Computes the (scaled) Runge-Lenz vector $A$ (eccentricity vector)
+    """
+    return Orbit(*states(X,v_vec)).e_vec
 
-    return v_perp
+def e(X, v_vec:np.array=None):
+    """
+    Computes eccentricity $e$
+    """
+    return Orbit(*states(X,v_vec)).e
 
-# CLASSICAL ORBITAL ELEMENTS
+def i(X, v_vec:np.array=None):
+    """
+    Computes inclanatio $i$
+    """
+    return Orbit(*states(X,v_vec)).i
 
-def H(df)->np.array:
+def RAAN_vec(X, v_vec:np.array=None):
     """
-    Computes mechanical energy $H$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Computes the the Right Ascension of the Ascending Node $N$
     """
-    r_vec = df[['x','y','z']].values.reshape(-1,3)
-    v_vec = df[['vx','vy','vz']].values.reshape(-1,3)
+    return Orbit(*states(X,v_vec)).N_vec
 
-    # idx = r_vec.index
+def Omega(X, v_vec:np.array=None):
+    """
+    Computes the longitude of the ascending node $\Omega$
+    """
+    return Orbit(*states(X,v_vec)).Omega
 
-    r = norm(r_vec)
-    v = norm(v_vec)
-    
-    return v**2 / 2 - G*M_earth / r
+def omega(X, v_vec:np.array=None):
+    """
+    Computes the argument of periapsis $\omega$
+    """
+    return Orbit(*states(X,v_vec)).omega
 
-def hvec(df)->np.array:
+def nu(X, v_vec:np.array=None):
     """
-    Computes orbital momentum $h$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Computes the true anomaly $\nu$
     """
-    r_vec = df[['x','y','z']].values.reshape(-1,3)
-    v_vec = df[['vx','vy','vz']].values.reshape(-1,3)
+    return Orbit(*states(X,v_vec)).nu
 
-    return np.cross(r_vec,v_vec)
 
-def h(df) -> np.array:
+def u(X, v_vec:np.array=None):
     """
-    Computes norm of orbital momentum $|h|$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Computes the argument of latitude $u = \omega + \nu$ (well defined for circular orbits)
     """
-    h_vec = hvec(df)
+    return Orbit(*states(X,v_vec)).u
 
-    return norm(h_vec)
 
-def a(df):
+# MEAN ORBITAL ELEMENTS
+   
+def E(X, v_vec:np.array=None):
     """
-    Computes semi-major axis $a$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Computes the mean eccentric anomaly $E$
     """
+    return Orbit(*states(X,v_vec)).E
 
-    return - (G*M_earth) / (2 * H(df))
+def M(X, v_vec:np.array=None):
+    """
+    Computes the mean anomaly $M$
+    """
+    return Orbit(*states(X,v_vec)).M
 
-def Avec(df):
+def n(X, v_vec:np.array=None):
     """
-    Computes the (scaled) Runge-Lenz vector $A$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Computes the mean motion $n$
     """
-    r_vec = df[['x','y','z']].values.reshape(-1,3)
-    v_vec = df[['vx','vy','vz']].values.reshape(-1,3)
-    h_vec = hvec(df)
+    return Orbit(*states(X,v_vec)).n
+
+#  MODIFIED EQUINOCTIAL ORBITAL ELEMENTS (better behaved for i = 0, e = 0)
 
-    A_vec = np.cross(v_vec,h_vec) / mu - hat(r_vec)
-    return A_vec
+def p(X, v_vec:np.array=None):
+    """
+    Computes semi-latus rectum $p$
+    """
+    return Orbit(*states(X,v_vec)).p
 
-def e(df): # df.values.shape = (-1,)
-    e_sq = 1 + 2 * H(df) * h(df)**2 / (G*M_earth)**2
+def f(X, v_vec:np.array=None):
+    """
+    Computes $f = e \cos(\omega + \Omega)$
+    """
+    return Orbit(*states(X,v_vec)).f
 
-    return np.sqrt(e_sq)
+def g(X, v_vec:np.array=None):
+    """
+    Computes $g = e \sin(\omega + \Omega)$
+    """
+    return Orbit(*states(X,v_vec)).g
 
-def i(df):
+def q1(X, v_vec:np.array=None):
     """
-    Computes inclanatio $i$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Computes $q_1 =  \tan(i / 2) \cos(\Omega)$
     """
-    h_hat_z = hat(hvec(df))[:,-1]
+    return Orbit(*states(X,v_vec)).q1
 
-    return np.arccos(h_hat_z).reshape(-1,1)
+def q2(X, v_vec:np.array=None):
+    """
+    Computes $q_2 =  \tan(i / 2) \sin(\Omega)$
+    """
+    return Orbit(*states(X,v_vec)).q2
 
-def RAAN_vec(df):
+def L(X, v_vec:np.array=None):
     """
-    Computes the the Right Ascension of the Ascending Node $N$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Computes $L =  \Omega + \omega + nu$
     """
-    h_vec = hvec(df)
+    return Orbit(*states(X,v_vec)).L
 
-    N_vec =  np.cross([[0,0,1]]*h_vec.shape[0],h_vec)
 
-    return N_vec
+# ELEMENT REGISTRY
 
-def Omega(df):
+def register_element(name:str, func, depends_on:list):
     """
-    Computes the longitude of the ascending node $\Omega$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Registers a custom element, which can then be requested like the built-in ones (compute_elements, compute_elements_chunked,
+    preprocessing_utils.OrbitalElements), sharing their intermediates.
+    Input: name of element; function returning the element (array of length N) from its dependencies, passed as keyword arguments;
+           names of the quantities it depends on (see DEPENDENCIES, e.g. ['a','e'] for func = lambda a, e: a*(1 - e))
     """
-    N_hat = hat(RAAN_vec(df))
-    N_hat_x = N_hat[:,0]
-    N_hat_y = N_hat[:,1]
 
-    Omega_ = np.zeros_like(N_hat_x) # create Omega data frame of same length as N
-    Omega_[(N_hat_y < 0)] = 2*np.pi - np.arccos(N_hat_x[(N_hat_y < 0)]) # populate Omega where Ny < 0
-    Omega_[(N_hat_y >= 0)] = np.arccos(N_hat_x[(N_hat_y >= 0)]) # populate Omega where Ny >= 0
+    if name in DEPENDENCIES and name not in CUSTOM:
+        raise ValueError(f'{name} is a built-in quantity')
 
-    return Omega_.reshape(-1,1)
+    unknown = set(depends_on) - set(DEPENDENCIES)
+    if unknown:
+        raise ValueError(f'Unknown dependencies of {name}: {sorted(unknown)}') # dependencies exist already: no cycles
 
-def omega(df):
+    DEPENDENCIES[name] = list(depends_on)
+    CUSTOM[name] = func
+    if name not in ELEMENTS:
+        ELEMENTS.append(name)
+
+def schedule(elements) -> list:
     """
-    Computes the argument of periapsis $\omega$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Resolves the quantities needed to compute elements (see DEPENDENCIES), each once.
+    Input: names of elements (see ELEMENTS)
+    Output: list of names of quantities (states, intermediates, flags and elements) in evaluation order, dependencies first
     """
-    r_vec = df[['x','y','z']].values.reshape(-1,3)
-    v_vec = df[['vx','vy','vz']].values.reshape(-1,3)
 
-    e_hat = hat(np.cross(v_vec,hvec(df)) / (G*M_earth) - hat(r_vec))
+    unknown = set(elements) - set(ELEMENTS)
+    if unknown:
+        raise ValueError(f'Unknown element(s): {sorted(unknown)}')
+
+    order, seen = [], set()
 
-    if any(i(df) < 1E-9):
-        e_vec = Avec(df)
-        ex = e_vec[:,1]
-        ey = e_vec[:,2]
-        arg_eN = np.arctan(ey/ex)
-    else:
-        N_hat = hat(RAAN_vec(df))
+    def visit(name):
+        if name in seen:
+            return
+        seen.add(name)
+        for dep in DEPENDENCIES[name]:
+            visit(dep)
+        order.append(name)
 
-        arg_eN = np.sum(e_hat*N_hat,axis=1) # arg_eN = arccos( e*N / |e| |N| ) = angle between e and N
+    for elem in elements:
+        visit(elem)
 
-    this_omega = np.zeros_like(arg_eN) # create omega data frame of same length as e
+    return order
 
-    this_omega[(e_hat[:,-1]<0)] = 2*np.pi - arg_eN[(e_hat[:,-1]<0)] # populate omega where ez < 0
-    this_omega[(e_hat[:,-1]>=0)] = arg_eN[(e_hat[:,-1]>=0)] # populate omega where ez >= 0
 
-    return this_omega.reshape(-1,1)
+# FUSED EVALUATION
 
-def nu(df):
+class Orbit:
     """
-    Computes the true anomaly $\nu$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Lazily evaluated orbital elements of the states (r_vec, v_vec): every quantity (|r|, |v|, h, H, eccentricity vector,
+    node vector N, ..., elements) is an attribute which is computed on first access only, from the quantities it depends on,
+    and then kept. The functions of this module are thin wrappers returning a single attribute.
+    Some formulas switch for all states at once (see FLAGS): *known* presets these flags, e.g. when evaluating a chunk of the states.
     """
-    r_vec = df[['x','y','z']].values.reshape(-1,3)
 
-    return np.arccos(p(df) / norm(r_vec) - 1)
+    def __init__(self, r_vec:np.array, v_vec:np.array, known:dict=None):
+        self.r_vec = r_vec # position [m], shape (N,3)
+        self.v_vec = v_vec # velocity [m/s], shape (N,3)
+        self.__dict__.update(known or {}) # preset (cached) attributes
 
+    def __getattr__(self, name):
+        # CUSTOM ELEMENTS (see register_element), CACHED LIKE THE BUILT-IN ONES
+        if name not in CUSTOM:
+            raise AttributeError(name)
 
-# MEAN ORBITAL ELEMENTS
-   
-def E(df):
+        value = np.asarray(CUSTOM[name](**{dep:getattr(self,dep) for dep in DEPENDENCIES[name]})).reshape(-1,1)
+        self.__dict__[name] = value
+
+        return value
+
+    # INTERMEDIATES
+    @cached_property
+    def r(self):
+        return norm(self.r_vec)
+
+    @cached_property
+    def v(self):
+        return norm(self.v_vec)
+
+    @cached_property
+    def h_vec(self):
+        return np.cross(self.r_vec,self.v_vec)
+
+    @cached_property
+    def e_vec(self):
+        return np.cross(self.v_vec,self.h_vec) / mu - self.r_vec / self.r # (scaled) Runge-Lenz vector, see Avec
+
+    @cached_property
+    def e_hat(self):
+        return hat(self.e_vec)
+
+    @cached_property
+    def N_vec(self):
+        return np.cross([0,0,1],self.h_vec) # node vector: z x h
+
+    @cached_property
+    def N_hat(self):
+        return hat(self.N_vec)
+
+    @cached_property
+    def zeros(self):
+        return np.zeros((self.r_vec.shape[0],1))
+
+    # FLAGS (OF ALL STATES)
+    @cached_property
+    def i_degenerate(self):
+        return bool(np.any(self.i < 1E-9)) # equatorial orbit
+
+    @cached_property
+    def e_degenerate(self):
+        return bool(np.any(self.e < 1E-9)) # circular orbit
+
+    @cached_property
+    def Omega_nan(self):
+        return bool(np.any(np.isnan(self.Omega)))
+
+    # VELOCITIES
+    @cached_property
+    def vrad(self):
+        return np.sum(self.v_vec*self.r_vec,axis=1).reshape(-1,1) / self.r
+
+    @cached_property
+    def vperp(self):
+        return np.sqrt(self.v**2 - self.vrad**2)
+
+    # CLASSICAL ORBITAL ELEMENTS
+    @cached_property
+    def H(self):
+        return self.v**2 / 2 - G*M_earth / self.r
+
+    @cached_property
+    def h(self):
+        return norm(self.h_vec)
+
+    @cached_property
+    def a(self):
+        return - (G*M_earth) / (2 * self.H)
+
+    @cached_property
+    def e(self):
+        return np.sqrt(1 + 2 * self.H * self.h**2 / (G*M_earth)**2)
+
+    @cached_property
+    def i(self):
+        return np.arccos((self.h_vec / self.h)[:,-1]).reshape(-1,1)
+
+    @cached_property
+    def Omega(self):
+        N_hat_x = self.N_hat[:,0]
+        N_hat_y = self.N_hat[:,1]
+
+        Omega_ = np.zeros_like(N_hat_x)
+        Omega_[(N_hat_y < 0)] = 2*np.pi - np.arccos(N_hat_x[(N_hat_y < 0)])
+        Omega_[(N_hat_y >= 0)] = np.arccos(N_hat_x[(N_hat_y >= 0)])
+
+        return Omega_.reshape(-1,1)
+
+    @cached_property
+    def omega(self):
+        e_hat = self.e_hat
+
+        if self.i_degenerate:
+            # EQUATORIAL ORBIT: NO NODE, LONGITUDE OF PERIAPSIS
+            return (np.arctan2(self.e_vec[:,1],self.e_vec[:,0]) % (2*np.pi)).reshape(-1,1)
+
+        arg_eN = np.arccos(np.clip(np.sum(e_hat*self.N_hat,axis=1),-1,1)) # angle between e and N
+
+        omega_ = np.zeros_like(arg_eN)
+        omega_[(e_hat[:,-1]<0)] = 2*np.pi - arg_eN[(e_hat[:,-1]<0)] # populate omega where ez < 0
+        omega_[(e_hat[:,-1]>=0)] = arg_eN[(e_hat[:,-1]>=0)] # populate omega where ez >= 0
+
+        return omega_.reshape(-1,1)
+
+    @cached_property
+    def nu(self):
+        cos_nu = np.clip(np.sum(self.e_hat*self.r_vec,axis=1).reshape(-1,1) / self.r,-1,1) # angle between e and r
+
+        return np.where(self.vrad < 0,2*np.pi - np.arccos(cos_nu),np.arccos(cos_nu)) # moving towards periapsis: nu > pi
+
+    @cached_property
+    def u(self):
+        if self.i_degenerate:
+            # EQUATORIAL ORBIT: NO NODE, TRUE LONGITUDE
+            return (np.arctan2(self.r_vec[:,1],self.r_vec[:,0]) % (2*np.pi)).reshape(-1,1)
+
+        cos_u = np.clip(np.sum(self.N_hat*self.r_vec,axis=1).reshape(-1,1) / self.r,-1,1) # angle between N and r
+
+        return np.where(self.r_vec[:,2:] < 0,2*np.pi - np.arccos(cos_u),np.arccos(cos_u)) # below the equator: u > pi
+
+    # MEAN ORBITAL ELEMENTS
+    @cached_property
+    def E(self):
+        return 2*np.arctan2(np.sqrt(1 - self.e)*np.sin(0.5*self.nu),np.sqrt(1 + self.e)*np.cos(0.5*self.nu)) # in [0, 2 pi]
+
+    @cached_property
+    def M(self):
+        return self.E - self.e*np.sin(self.E)
+
+    @cached_property
+    def n(self):
+        b_ = self.a*np.sqrt(1 - self.e**2) # semi-minor axis
+
+        return self.h / (self.a*b_)
+
+    # MODIFIED EQUINOCTIAL ORBITAL ELEMENTS
+    @cached_property
+    def p(self):
+        return self.a*(1 - self.e**2)
+
+    @cached_property
+    def f(self):
+        if self.e_degenerate:
+            return self.zeros
+        if self.Omega_nan:
+            return self.e*np.cos(self.omega)
+        return self.e*np.cos(self.omega + self.Omega)
+
+    @cached_property
+    def g(self):
+        if self.e_degenerate:
+            return self.zeros
+        if self.Omega_nan:
+            return self.e*np.sin(self.omega)
+        return self.e*np.sin(self.omega + self.Omega)
+
+    @cached_property
+    def q1(self):
+        if self.i_degenerate:
+            return self.zeros
+        return np.tan( self.i / 2 ) * np.cos(self.Omega)
+
+    @cached_property
+    def q2(self):
+        if self.i_degenerate:
+            return self.zeros
+        return np.tan( self.i / 2 ) * np.sin(self.Omega)
+
+    @cached_property
+    def L(self):
+        return self.Omega + self.omega + self.nu
+
+def compute_elements(X, v_vec:np.array=None, elements=ELEMENT_SETS['all']) -> dict:
     """
-    Computes the mean eccentric anomaly $E$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Computes several orbital elements in a single pass: only the intermediates (|r|, |v|, h, H, eccentricity vector, N, ...)
+    the requested elements depend on are computed, each once, in the order given by schedule. Intermediates are released
+    after their last use.
+    Input: states [m], [m/s] (DataFrame, (N,6) state array or (N,3) positions and velocities v_vec, see states);
+           names of elements (see ELEMENTS, Default = ELEMENT_SETS['all'])
+    Output: dict element -> np.array of shape (N,1)
     """
 
-    return np.arctan(2*np.sqrt(((1 - e(df)) / (1 + e(df))))*np.tan(0.5*nu(df)))
+    order = schedule(elements)
+    last_use = {dep:k for k, name in enumerate(order) for dep in DEPENDENCIES[name]}
+    keep = set(elements) | set(FLAGS) | {'r_vec','v_vec'}
 
+    orbit = Orbit(*states(X,v_vec))
 
-def M(df):
+    for k, name in enumerate(order):
+        getattr(orbit,name)
+        for dep in DEPENDENCIES[name]:
+            if last_use[dep] == k and dep not in keep:
+                orbit.__dict__.pop(dep,None)
+
+    return {elem:getattr(orbit,elem) for elem in elements}
+
+def state_reader(X, v_vec:np.array=None):
     """
-    Computes the mean anomaly $M$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Random access to chunks of the states without copying the whole states.
+    Input: states (see states)
+    Output: number of epochs, function read(lo, hi, buffer) -> (r_vec, v_vec) of the epochs lo:hi: views of the state array(s),
+            or, for DataFrames, views of *buffer* (float64 array of shape (>= hi-lo, 6)) which the columns are copied into
     """
-    E_ = E(df) # mean eccentric anomaly
 
-    return E_ - e(df)*np.sin(E_)
+    if v_vec is not None or not isinstance(X,pd.DataFrame):
+        r_vec, v_vec = states(X,v_vec)
+        return len(r_vec), lambda lo, hi, buffer=None: (r_vec[lo:hi], v_vec[lo:hi])
+
+    columns = [X[col].to_numpy() for col in ['x','y','z','vx','vy','vz']] # no copy of float64 columns
+
+    def read(lo, hi, buffer):
+        chunk = buffer[:hi-lo]
+        for k, values in enumerate(columns):
+            np.copyto(chunk[:,k],values[lo:hi],casting='unsafe')
+        return chunk[:,:3], chunk[:,3:]
+
+    return len(X), read
 
-def n(df):
+def compute_elements_chunked(X, v_vec:np.array=None, elements=ELEMENT_SETS['all'], chunk_size:int=CHUNK_SIZE, out:dict=None) -> dict:
     """
-    Computes the mean motion $n$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Computes several orbital elements chunk by chunk (see compute_elements), writing into preallocated output columns:
+    the temporaries (cross products, norms, ...) only ever exist for one chunk, i.e. the peak memory is the output
+    plus O(chunk_size), independent of the number of epochs. The results are identical to compute_elements:
+    elements depending on flags of all states (see FLAGS, schedule) are recomputed for the chunks whose own flags differ.
+    Input: states (see states); names of elements (see ELEMENTS, Default = ELEMENT_SETS['all']);
+           number of epochs per chunk (Default = 32768); optional: dict element -> 1D np.array of length N to write into
+    Output: dict element -> np.array of shape (N,)
     """
-    a_ = a(df) # semi-major axis
-    e_ = e(df) # eccentricity 
-    b_ = np.sqrt(a_**2 - e_**2) # semi-minor axis
-    h_ = h(df) # norm of orbital momentum
 
-    return h_ / (a_*b_)
+    n_epochs, read = state_reader(X,v_vec)
 
-#  MODIFIED EQUINOCTIAL ORBITAL ELEMENTS (better behaved for i = 0, e = 0)
+    out = {} if out is None else out
+    for elem in elements:
+        if elem not in out:
+            out[elem] = np.empty(n_epochs)
+
+    evaluate_chunks(read,n_epochs,elements,chunk_size,out)
 
-def p(df):
+    return out
+
+def evaluate_chunks(read, n_epochs:int, elements:list, chunk_size:int, out:dict) -> dict:
     """
-    Computes semi-latus rectum $p$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Worker function of compute_elements_chunked() method
+    Evaluates the elements chunk by chunk into out (see compute_elements_chunked).
+    Input: number of epochs and read function (see state_reader); names of elements; number of epochs per chunk;
+           dict element -> 1D np.array of length n_epochs to write into
+    Output: dict flag -> bool, the flags of all states the elements were computed with (see FLAGS)
     """
-    return a(df)*(1 - e(df)**2)
 
-def f(df):
+    order = schedule(elements)
+
+    flags = [name for name in order if name in FLAGS]
+    flagged = [elem for elem in elements if set(FLAGS) & set(schedule([elem]))] # elements whose formula depends on flags
+    spans = [(lo,min(lo + chunk_size,n_epochs)) for lo in range(0,n_epochs,chunk_size)]
+    buffer = np.empty((min(chunk_size,n_epochs),6))
+
+    def evaluate(span, elements=elements, known=None):
+        lo, hi = span
+        orbit = Orbit(*read(lo,hi,buffer),known=known)
+        for elem in elements:
+            np.copyto(out[elem][lo:hi],getattr(orbit,elem).reshape(-1))
+
+        return {flag:getattr(orbit,flag) for flag in flags}
+
+    # SINGLE PASS, EVERY CHUNK WITH ITS OWN FLAGS
+    chunk_flags = [evaluate(span) for span in spans]
+
+    # FLAGS OF ALL STATES: RECOMPUTE THE AFFECTED ELEMENTS OF CHUNKS WHOSE FLAGS DIFFER (DEGENERATE ORBITS ONLY)
+    known = {flag:any(chunk[flag] for chunk in chunk_flags) for flag in flags}
+    for span, used in zip(spans,chunk_flags):
+        if used != known:
+            evaluate(span,flagged,known)
+
+    return known
+
+
+# KEPLERIAN ELEMENTS -> STATES
+
+def solve_kepler(M:np.array, e:np.array, method:str='halley', tol:float=KEPLER_TOL, max_iter:int=KEPLER_MAX_ITER) -> np.array:
     """
-    Computes $f = e \cos(\omega + \Omega)$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Solves Kepler's equation M = E - e sin(E) for the eccentric anomaly E of elliptic orbits (0 <= e < 1), all epochs at once:
+    every iteration updates only the epochs which have not converged yet (|dE| > tol).
+    Input: mean anomalies [rad]; eccentricities (arrays of the same shape or scalars);
+           method: 'newton' (quadratic) or 'halley' (cubic convergence, Default); tolerance [rad]; maximal number of iterations
+    Output: eccentric anomalies [rad], in the shape of M (M in [0, 2 pi) -> E in [0, 2 pi))
     """
-    e_ = e(df)
-    omega_ = omega(df)
-    Omega_ = Omega(df)
 
-    if any(e_ < 1E-9):
-        return np.zeros_like(df).reshape(-1,1)
-    else:
-        if any(np.isnan(Omega_)):
-            return e_*np.cos(omega_)
+    M, e = np.broadcast_arrays(np.asarray(M,dtype=np.float64),np.asarray(e,dtype=np.float64))
+    shape = M.shape
+    M, e = M.reshape(-1), e.reshape(-1)
+
+    # STARTING VALUE: M + e sin(M) (e < 0.8), pi (e >= 0.8)
+    E_ = np.where(e < 0.8,M + e*np.sin(M),np.pi)
+
+    active = np.arange(M.size) # epochs which have not converged yet
+
+    for _ in range(max_iter):
+        E_k, e_k = E_[active], e[active]
+
+        sin_E, cos_E = np.sin(E_k), np.cos(E_k)
+        f_ = E_k - e_k*sin_E - M[active] # residual of Kepler's equation
+        df_ = 1 - e_k*cos_E # first derivative
+
+        if method == 'newton':
+            dE = f_ / df_
+        elif method == 'halley':
+            dE = 2*f_*df_ / (2*df_**2 - f_*e_k*sin_E) # second derivative: e sin(E)
         else:
-            return e_*np.cos(omega_ + Omega_)
+            raise ValueError(f'Unknown method: {method}')
+
+        E_[active] = E_k - dE
+        active = active[np.abs(dE) > tol]
 
-def g(df):
+        if active.size == 0:
+            break
+
+    return E_.reshape(shape)
+
+def true_anomaly(E:np.array, e:np.array) -> np.array:
     """
-    Computes $g = e \sin(\omega + \Omega)$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Computes the true anomaly $\nu$ from the eccentric anomaly E and the eccentricity e (E in [0, 2 pi] -> nu in [0, 2 pi])
     """
-    e_ = e(df)
-    omega_ = omega(df)
-    Omega_ = Omega(df)
+    return 2*np.arctan2(np.sqrt(1 + e)*np.sin(0.5*E),np.sqrt(1 - e)*np.cos(0.5*E))
 
-    if any(e_ < 1E-9):
-        return np.zeros_like(df).reshape(-1,1)
-    else:
-        if any(np.isnan(Omega_)):
-            return e_*np.sin(omega_)
-        else:
-            return e_*np.sin(omega_ + Omega_)
+def elements_to_states(a, e, i, Omega, omega, nu=None, M=None, out:np.array=None) -> np.array:
+    """
+    Computes positions and velocities from Keplerian elements (inverse of a, e, i, Omega, omega and nu), all epochs at once.
+    The anomaly is given either as true anomaly nu or as mean anomaly M (see solve_kepler).
+    Input: semi-major axis [m], eccentricity, inclination, longitude of the ascending node, argument of periapsis [rad]
+           and true anomaly nu or mean anomaly M [rad] (arrays of shape (N,) or (N,1), or scalars);
+           optional: (N,6) array to write into
+    Output: (N,6) state array [x,y,z,vx,vy,vz] in [m] and [m/s] (see states)
+    """
+
+    if (nu is None) == (M is None):
+        raise ValueError('Give either the true anomaly nu or the mean anomaly M')
+
+    a, e, i, Omega, omega, anomaly = (np.asarray(x,dtype=np.float64).reshape(-1) for x in (a,e,i,Omega,omega,nu if M is None else M))
+    a, e, i, Omega, omega, anomaly = np.broadcast_arrays(a,e,i,Omega,omega,anomaly)
+
+    nu_ = anomaly if M is None else true_anomaly(solve_kepler(anomaly,e),e)
+
+    # PERIFOCAL FRAME: POSITION AND VELOCITY IN THE ORBITAL PLANE
+    p_ = a*(1 - e**2) # semi-latus rectum
+    cos_nu, sin_nu = np.cos(nu_), np.sin(nu_)
+    r_ = p_ / (1 + e*cos_nu)
+    w_ = np.sqrt(mu / p_)
+
+    # ROTATION INTO THE INERTIAL FRAME: UNIT VECTORS P (TOWARDS PERIAPSIS) AND Q (IN PLANE, 90 DEG AHEAD)
+    cos_O, sin_O = np.cos(Omega), np.sin(Omega)
+    cos_o, sin_o = np.cos(omega), np.sin(omega)
+    cos_i, sin_i = np.cos(i), np.sin(i)
+
+    P = (cos_O*cos_o - sin_O*sin_o*cos_i, sin_O*cos_o + cos_O*sin_o*cos_i, sin_o*sin_i)
+    Q = (-cos_O*sin_o - sin_O*cos_o*cos_i, -sin_O*sin_o + cos_O*cos_o*cos_i, cos_o*sin_i)
+
+    out = np.empty((a.size,6)) if out is None else out
+
+    for k in range(3):
+        out[:,k] = r_*(cos_nu*P[k] + sin_nu*Q[k])
+        out[:,3+k] = w_*(-sin_nu*P[k] + (e + cos_nu)*Q[k])
 
-def q1(df):
+    return out
+
+def propagate(X, dt, v_vec:np.array=None) -> np.array:
+    """
+    Propagates states on their osculating Keplerian orbits (two-body problem): the mean anomaly advances by n dt.
+    Input: states (see states); time offsets [s] (scalar or array of shape (N,))
+    Output: (N,6) state array of the predicted states
+    """
+
+    orbit = Orbit(*states(X,v_vec))
+    n_ = np.sqrt(mu / orbit.a**3).reshape(-1) # mean motion
+
+    M_ = (orbit.M.reshape(-1) + n_*dt) % (2*np.pi)
+
+    return elements_to_states(orbit.a,orbit.e,orbit.i,orbit.Omega,orbit.omega,M=M_)
+
+
+# J2 PERTURBATION (OBLATENESS OF THE EARTH)
+
+def j2_rates(a, e, i) -> tuple:
     """
-    Computes $q_1 =  \tan(i / 2) \cos(\Omega)$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Computes the secular drift of the angles due to J2 (first order; e.g. literature/perturbation_celestial_mechanics.pdf).
+    Input: (mean) semi-major axis [m], eccentricity, inclination [rad]
+    Output: rates of Omega, omega and M [rad/s] (M: including the mean motion n)
     """
-    i_ = i(df)
 
-    if any(i_ < 1E-9):
-        return np.zeros_like(df).reshape(-1,1)
-    else:
-        return np.tan( i_ / 2 ) * np.cos(Omega(df))
+    n_ = np.sqrt(mu / a**3) # mean motion
+    k_ = 1.5*J2*n_*(R_earth / (a*(1 - e**2)))**2 # 3/2 J2 n (R/p)^2
+    cos_i = np.cos(i)
 
-def q2(df):
+    Omega_dot = -k_*cos_i
+    omega_dot = 0.5*k_*(5*cos_i**2 - 1)
+    M_dot = n_ + 0.5*k_*np.sqrt(1 - e**2)*(3*cos_i**2 - 1)
+
+    return Omega_dot, omega_dot, M_dot
+
+def j2_short_period(a, i, u) -> dict:
     """
-    Computes $q_1 =  \tan(i / 2) \cos(\Omega)$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Computes the first-order short-period variations of the elements due to J2 for near-circular orbits (e << 1),
+    i.e. osculating - mean element; they oscillate with twice the orbital frequency.
+    Input: semi-major axis [m], inclination [rad], argument of latitude [rad]
+    Output: dict element -> variation ('a' [m], 'i', 'Omega' [rad])
     """
-    i_ = i(df)
 
-    if any(i_ < 1E-9):
-        return np.zeros_like(df).reshape(-1,1)
-    else:
-        return np.tan( i_/ 2 ) * np.sin(Omega(df))
+    k_ = J2*(R_earth / a)**2
+    sin_i, cos_i = np.sin(i), np.cos(i)
+    cos_2u, sin_2u = np.cos(2*u), np.sin(2*u)
+
+    return {'a':1.5*k_*a*sin_i**2*cos_2u,
+            'i':0.375*k_*np.sin(2*i)*cos_2u,
+            'Omega':0.75*k_*cos_i*sin_2u}
 
-def L(df):
+def j2_baseline(sat:pd.DataFrame, elements=('a','i','Omega','u')) -> pd.DataFrame:
     """
-    Computes $L =  \Omega + \omega + nu$ from DataFrame containing position (x,y,z) and velocity (vx,vy,vz)
+    Computes the J2 model of the elements of a single satellite in one pass: mean elements plus secular drift
+    (Omega, omega, M, u, see j2_rates) plus short-period terms (a, i, Omega, see j2_short_period). Only the constant
+    mean elements at the first epoch are estimated from the data (mean of osculating - model), no curve fitting.
+    Input: DataFrame of one satellite with DatetimeIndex and states x..vz [m], [m/s] (as after preprocessing_utils.ConvertUnits);
+           names of elements (a, e, i, Omega, omega, M, u; Default = a, i, Omega, u)
+    Output: DataFrame of the modelled elements (same index; angles in [0, 2 pi)), e.g. to subtract from the osculating elements
+
+    For near-circular orbits (e of the order of J2 (R/a)^2 ~ 1E-3, e.g. DORIS satellites), omega and M are ill-defined
+    on their own (the eccentricity vector oscillates with J2) and only their sum, the argument of latitude u, follows the model.
     """
-    return Omega(df) + omega(df) + nu(df)
 
+    angles = ['Omega','omega','M','u']
+
+    osc = compute_elements(sat,elements=sorted(set(elements) | {'a','e','i','u'}))
+    t = (sat.index - sat.index[0]).total_seconds().to_numpy()
+
+    short = j2_short_period(osc['a'].reshape(-1),osc['i'].reshape(-1),osc['u'].reshape(-1))
+    a_, i_ = osc['a'].reshape(-1) - short['a'], osc['i'].reshape(-1) - short['i'] # mean elements
+
+    rates = dict(zip(angles,j2_rates(a_.mean(),osc['e'].mean(),i_.mean())))
+    rates['u'] = rates['omega'] + rates['M']
+
+    baseline = {}
+    for elem in elements:
+        values = osc[elem].reshape(-1)
+        if elem in angles:
+            values = np.unwrap(values) # continuous drift
+
+        model = rates.get(elem,0.)*t + short.get(elem,0.)
+        model = model + np.nanmean(values - model) # mean element at the first epoch
 
+        baseline[elem] = model % (2*np.pi) if elem in angles else model
 
+    return pd.DataFrame(baseline,index=sat.index)
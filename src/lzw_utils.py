@@ -0,0 +1,209 @@
+# UNZIPPING .Z FILES IMPORTS
+from pathlib import Path
+
+# MULTIPROCESSING IMPORTS
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool
+
+CHUNK_SIZE = 1 << 20 # size of decompressed chunks [bytes]
+MAX_STRING = 1 << 16 # upper bound of the length of a decoded LZW string (size of the code table)
+
+def read_Z(source) -> bytes:
+    """
+    Reads the (compressed) contents of a .Z-file.
+    Input: path to .Z-file (str or pathlib.Path) or bytes-like contents
+    Output: bytes-like contents
+    """
+
+    if isinstance(source, (str, Path)):
+        return Path(source).read_bytes()
+
+    return source
+
+def iter_unlzw(source, chunk_size:int=CHUNK_SIZE):
+    """
+    Incremental decompression of data generated by the Unix compress utility (LZW compression, .Z-files).
+    Adapted from unlzw3.unlzw, but keeps whole strings in the code table and writes the output into a single reusable
+    buffer which is handed out chunk by chunk, such that the decompressed file is never held in memory at once.
+    Input: path to .Z-file or bytes-like contents; size of decompressed chunks (Default = 1 MiB)
+    Output: generator of memoryviews (decompressed chunks of at least *chunk_size* bytes, except the last one)
+
+    This is not a vectorised (NumPy) decoder: every code is still decoded by Python bytecode, so the decompression itself
+    is only slightly faster than unlzw3 (about 1.2x, see scripts/benchmark.py lzw). The gain is in memory: no bytes -> str ->
+    list of lines copies of the decompressed file.
+
+    The yielded memoryviews share the same buffer: each chunk is only valid until the next one is requested,
+    copy it (e.g. bytearray += chunk) to keep it.
+    """
+
+    data = memoryview(read_Z(source)).cast('B')
+    inlen = len(data)
+
+    # PROCESS HEADER
+    if inlen < 3:
+        raise ValueError('Invalid Input: Length of input too short for processing')
+
+    if data[0] != 0x1F or data[1] != 0x9D:
+        raise ValueError('Invalid Header Flags Byte: Incorrect magic bytes')
+
+    flags = data[2]
+
+    if flags & 0x60:
+        raise ValueError('Invalid Header Flags Byte: Flag byte contains invalid data')
+
+    max_ = flags & 0x1F
+    if max_ < 9 or max_ > 16:
+        raise ValueError('Invalid Header Flags Byte: Max code size bits out of range')
+
+    if max_ == 9:
+        max_ = 10 # 9 doesn't really mean 9
+
+    block = flags & 0x80 # true if block compressed
+
+    if inlen == 3:
+        return # zero-length input is permitted
+    if inlen == 4:
+        raise ValueError('Invalid Data: Stream ended in the middle of a code')
+
+    # CODE TABLE: code -> decompressed string
+    table = [bytes([k]) for k in range(256)] + [b''] * (65536 - 256)
+
+    # CLEAR TABLE, START AT NINE BITS PER SYMBOL
+    bits = 9
+    mask = 0x1FF
+    end = 256 if block else 255
+
+    # FIRST 9-BIT CODE IS THE FIRST DECOMPRESSED BYTE
+    buf = data[3] + (data[4] << 8)
+    prev = buf & mask
+    buf >>= bits
+    left = 16 - bits
+    if prev > 255:
+        raise ValueError('Invalid Data: First code must be a literal')
+
+    out = bytearray(chunk_size + MAX_STRING) # room for a full chunk plus the longest possible string
+    out[0] = prev
+    pos = 1
+
+    mark = 3 # start of compressed data
+    nxt = 5 # consumed five bytes so far
+    while nxt < inlen:
+        # IF THE TABLE WILL BE FULL AFTER THIS, INCREMENT THE CODE SIZE
+        if end >= mask and bits < max_:
+            # flush unused input bits and bytes to next 8*bits bit boundary
+            rem = (nxt - mark) % bits
+            if rem:
+                rem = bits - rem
+                if rem >= inlen - nxt:
+                    break
+                nxt += rem
+
+            buf = 0
+            left = 0
+            mark = nxt
+
+            bits += 1
+            mask = (mask << 1) + 1
+
+        # GET A CODE OF *bits* BITS
+        buf += data[nxt] << left
+        nxt += 1
+        left += 8
+        if left < bits:
+            if nxt == inlen:
+                raise ValueError('Invalid Data: Stream ended in the middle of a code')
+            buf += data[nxt] << left
+            nxt += 1
+            left += 8
+        code = buf & mask
+        buf >>= bits
+        left -= bits
+
+        # CLEAR CODE (256)
+        if code == 256 and block:
+            rem = (nxt - mark) % bits
+            if rem:
+                rem = bits - rem
+                if rem > inlen - nxt:
+                    break
+                nxt += rem
+
+            buf = 0
+            left = 0
+            mark = nxt
+
+            bits = 9
+            mask = 0x1FF
+            end = 255
+            continue
+
+        # DECODE
+        if code > end:
+            # special code to reuse last match
+            if code != end + 1 or prev > end:
+                raise ValueError('Invalid Data: Invalid code detected')
+            string = table[prev] + table[prev][:1]
+        else:
+            string = table[code]
+
+        # LINK NEW TABLE ENTRY
+        if end < mask:
+            end += 1
+            table[end] = table[prev] + string[:1]
+
+        prev = code
+
+        # WRITE INTO BUFFER (SAME SIZE SLICE ASSIGNMENT, NO REALLOCATION)
+        n = len(string)
+        out[pos:pos+n] = string
+        pos += n
+
+        if pos >= chunk_size:
+            yield memoryview(out)[:pos]
+            pos = 0
+
+    if pos:
+        yield memoryview(out)[:pos]
+
+def unlzw_into(source, out:bytearray=None) -> memoryview:
+    """
+    Decompresses a .Z-file into a (reusable) bytearray, without creating intermediate bytes, str or list of lines objects.
+    Input: path to .Z-file or bytes-like contents; optional: bytearray to decompress into (grown if too small)
+    Output: memoryview of the decompressed contents (release it, e.g. with a with-statement, before reusing *out*)
+    """
+
+    if out is None:
+        out = bytearray()
+
+    data = read_Z(source)
+
+    pos = 0
+    for chunk in iter_unlzw(data):
+        n = len(chunk)
+        if pos + n > len(out):
+            out.extend(bytes(max(pos + n - len(out), len(out), 4*len(data)))) # grow geometrically
+        out[pos:pos+n] = chunk
+        pos += n
+
+    return memoryview(out)[:pos]
+
+def unlzw_bytes(source) -> bytes:
+    """
+    Worker function for unlzw_many() method
+    Input: path to .Z-file or bytes-like contents
+    Output: decompressed contents (bytes)
+    """
+
+    with unlzw_into(source) as view:
+        return view.tobytes()
+
+def unlzw_many(sources:list, processes:int=None):
+    """
+    Decompresses several .Z-files concurrently in a process pool (the decoder is pure Python and holds the GIL,
+    i.e. threads would not run concurrently).
+    Input: list of paths to .Z-files or bytes-like contents; optional: number of processes (Default = cpu_count())
+    Output: generator of bytes (decompressed contents in order of *sources*)
+    """
+
+    with Pool(processes=processes or cpu_count()) as pool:
+        yield from pool.imap(unlzw_bytes, sources)
@@ -2,6 +2,20 @@
 import time
 import sys
 
+# HASHING IMPORTS
+import hashlib
+
+# METRICS IMPORTS
+import json
+import math
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+HISTOGRAM_BASE = 1E-6 # upper bound of the first bucket of latency histograms [s]
+HISTOGRAM_BUCKETS = 32 # number of buckets (powers of two: 1 us ... ~36 min)
+STAGES = ('http','decompress','parse','write') # stages of the download and ingest pipeline
+
 
 def progress_bar(count,total):
     """
@@ -16,25 +30,252 @@ def progress_bar(count,total):
     if count == total-1:
         print(f"[{'#'*bar_length}] 100.0% ")
 
-def progress_bar_II(total:int):
-    # time.sleep(.1)
-    with lock:
-        shared.value += 1
+def file_digest(path:str, algorithm:str='sha256', chunk_size:int=1 << 20) -> str:
+    """
+    Computes the hex digest of a file, reading it in chunks.
+    Input: path to file; hash algorithm (Default = 'sha256', see hashlib); chunk size
+    Output: hex digest (str)
+    """
 
-    count = shared.value
-    
-    bar_length = 65
-    filled = int(
-        round( bar_length*count / float(total) ))
-    percentage = round( 100*count / float(total), 1 )
-    bar = '#'*filled + ' '*(bar_length-filled)
+    digest = hashlib.new(algorithm)
+
+    with open(path,'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+class Histogram:
+    """
+    Latency histogram with logarithmic buckets (bucket k counts values <= HISTOGRAM_BASE * 2**k).
+    Fixed size, such that histograms of several workers are merged by adding their counts.
+    """
 
-    sys.stdout.write(f'\r[{bar}] {percentage}% ({count}/{total}) ')
-    sys.stdout.flush()
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.total = 0.
+        self.max = 0.
 
-def globalise(t, l):
+    def add(self, seconds:float):
+        k = 0 if seconds <= HISTOGRAM_BASE else min(math.ceil(math.log2(seconds / HISTOGRAM_BASE)), HISTOGRAM_BUCKETS - 1)
+        self.counts[k] += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def __len__(self) -> int:
+        return sum(self.counts)
+
+    def quantile(self, q:float) -> float:
+        """
+        Output: upper bound of the bucket containing the q-quantile [s] (at most the maximum), 0 if empty
+        """
+
+        n = len(self)
+        if n == 0:
+            return 0.
+
+        rank, seen = q * n, 0
+        for k, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(HISTOGRAM_BASE * 2**k, self.max)
+
+        return self.max
+
+    def to_dict(self) -> dict:
+        n = len(self)
+        return {'count':n, 'total':self.total, 'mean':self.total / n if n else 0., 'p50':self.quantile(.5), 'p90':self.quantile(.9),
+                'p99':self.quantile(.99), 'max':self.max, 'buckets':{f'{HISTOGRAM_BASE * 2**k:.6g}':count for k, count in enumerate(self.counts) if count}}
+
+class Metrics:
     """
+    Throughput metrics of the download and ingest pipeline: counters (files, bytes, retries, ...),
+    latency histograms per stage (see STAGES) and sampled queue depths.
+    Every thread records into its own shard (no locks on the hot path); shards are only summed when read.
+    Process workers time their stages themselves and return the timings, which the parent records (see observe).
     """
-    global shared, lock
-    shared = t
-    lock = l
+
+    def __init__(self, total:int=None):
+        self.total = total # number of files expected (for the live display)
+        self.t0 = time.monotonic()
+        self.t1 = None
+        self.queues = {} # name -> queue.Queue (see watch)
+        self.depths = {} # name -> [samples, sum of depths, max depth, maxsize]
+        self._local = threading.local()
+        self._shards = []
+        self._width = 0 # length of the last status line shown live (see log)
+
+    # RECORDING (THREAD-LOCAL)
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = ({}, {}) # counters, histograms
+            self._shards.append(shard) # once per thread (atomic)
+        return shard
+
+    def count(self, name:str, n:int=1):
+        """
+        Increments counter *name* by n.
+        """
+
+        counters = self._shard()[0]
+        counters[name] = counters.get(name, 0) + n
+
+    def observe(self, stage:str, seconds:float):
+        """
+        Records a latency [s] of *stage*.
+        """
+
+        histograms = self._shard()[1]
+        if stage not in histograms:
+            histograms[stage] = Histogram()
+        histograms[stage].add(seconds)
+
+    @contextmanager
+    def timer(self, stage:str):
+        """
+        Records the time spent in the with-block as a latency of *stage*.
+        """
+
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t0)
+
+    def watch(self, name:str, q):
+        """
+        Registers a queue whose depth is sampled (see sample).
+        """
+
+        self.queues[name] = q
+        self.depths[name] = [0, 0, 0, q.maxsize]
+
+    def sample(self):
+        """
+        Samples the depths of the watched queues (called by the live display and the pipeline).
+        """
+
+        for name, q in self.queues.items():
+            depth = self.depths[name]
+            n = q.qsize()
+            depth[0] += 1
+            depth[1] += n
+            depth[2] = max(depth[2], n)
+
+    # READING (SUM OF SHARDS)
+    def counters(self) -> dict:
+        counters = {}
+        for shard in list(self._shards):
+            for name, n in list(shard[0].items()):
+                counters[name] = counters.get(name, 0) + n
+        return counters
+
+    def histograms(self) -> dict:
+        histograms = {}
+        for shard in list(self._shards):
+            for stage, histogram in list(shard[1].items()):
+                histograms.setdefault(stage, Histogram()).merge(histogram)
+        return histograms
+
+    def elapsed(self) -> float:
+        return (self.t1 or time.monotonic()) - self.t0
+
+    def stop(self):
+        """
+        Stops the clock (rates refer to the time until stop).
+        """
+
+        self.t1 = time.monotonic()
+
+    def to_dict(self) -> dict:
+        """
+        Output: JSON-serialisable summary: elapsed time, counters, rates (files/s, bytes/s), latency histograms per stage, queue depths
+        """
+
+        counters, elapsed = self.counters(), self.elapsed()
+
+        return {'elapsed':elapsed, 'total':self.total, 'counters':counters,
+                'files_per_s':counters.get('files', 0) / elapsed if elapsed else 0.,
+                'bytes_per_s':counters.get('bytes', 0) / elapsed if elapsed else 0.,
+                'stages':{stage:histogram.to_dict() for stage, histogram in sorted(self.histograms().items(), key=lambda item: STAGES.index(item[0]) if item[0] in STAGES else len(STAGES))},
+                'queues':{name:{'mean':total / samples if samples else 0., 'max':maximum, 'maxsize':maxsize} for name, (samples, total, maximum, maxsize) in self.depths.items()}}
+
+    def save(self, path:str):
+        """
+        Writes the summary (see to_dict) to a .json-file.
+        """
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path,'w') as file:
+            json.dump(self.to_dict(), file, indent=1)
+
+    # LIVE DISPLAY
+    def status(self) -> str:
+        """
+        Output: one-line status: progress, rates, median latency per stage, queue depths
+        """
+
+        counters, elapsed = self.counters(), self.elapsed()
+        files = counters.get('files', 0)
+
+        if self.total:
+            bar_length = 30
+            filled = int(round(bar_length * min(files, self.total) / self.total))
+            line = f"[{'#'*filled + ' '*(bar_length-filled)}] {100*files/self.total:.1f}% ({files}/{self.total})"
+        else:
+            line = f'{files} file(s)'
+
+        line += f" {files/elapsed if elapsed else 0:.1f} files/s {counters.get('bytes', 0)/1E6/elapsed if elapsed else 0:.2f} MB/s"
+
+        stages = self.histograms()
+        if stages:
+            line += ' | ' + ' '.join(f'{stage} {stages[stage].quantile(.5)*1E3:.0f}ms' for stage in STAGES if stage in stages)
+        if counters.get('retries'):
+            line += f" | {counters['retries']} retries"
+        if self.queues:
+            line += ' | ' + ' '.join(f'{name} {q.qsize()}/{q.maxsize}' for name, q in self.queues.items())
+
+        return line
+
+    def log(self, message:str):
+        """
+        Prints a message on its own line, overwriting the status line shown live (which is redrawn below it).
+        """
+
+        sys.stdout.write('\r' + message.ljust(self._width + 1) + '\n')
+        sys.stdout.flush()
+
+    @contextmanager
+    def live(self, interval:float=.5):
+        """
+        Prints the status line (see status) every *interval* seconds from a background thread while the with-block runs
+        (replaces the lock-based progress bar of the workers), and samples the watched queues.
+        """
+
+        done = threading.Event()
+        self.t1 = None # (re)started
+
+        def display():
+            while not done.wait(interval):
+                self.sample()
+                line = self.status()
+                self._width = len(line)
+                sys.stdout.write('\r' + line + ' ')
+                sys.stdout.flush()
+
+        thread = threading.Thread(target=display, daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            done.set()
+            thread.join()
+            self.stop()
+            sys.stdout.write('\r' + self.status() + ' \n')
+            sys.stdout.flush()
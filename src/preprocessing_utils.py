@@ -14,11 +14,52 @@ cwd = Path(os.getcwd())
 sys.path.append(str(cwd.parent)+'/src/')
 
 import kepler_utils as kutls
+import sp3_utils as sp3
+import store_utils as stu
+
+CSV_CHUNK_ROWS = 1 << 20 # rows per chunk of filtered .csv-reads
+
+def writable(values:np.ndarray) -> bool:
+    """
+    Checks if the memory behind an array (or view) can be written, e.g. False for memory-mapped stores opened read-only
+    """
+    while isinstance(values.base,np.ndarray):
+        values = values.base
+
+    return values.flags.writeable
+
+def sort_by_time(sat:pd.DataFrame) -> pd.DataFrame:
+    """
+    Sorts by the DateTime index, unless it is already sorted (single pass check instead of sort and copy)
+    """
+    if sat.index.is_monotonic_increasing:
+        return sat
+
+    return sat.sort_index()
+
+def read_csv_filtered(path:str, filters:list, columns:list=None, **kwargs) -> pd.DataFrame:
+    """
+    Reads a .csv-file (pd.read_csv(path, **kwargs)), keeping only the rows matching the filters (see store_utils.row_filters).
+    With filters, the file is read in chunks of CSV_CHUNK_ROWS rows which are filtered before they are concatenated,
+    i.e. the whole file is never in memory. Only the requested columns (and the filtered ones) are parsed.
+    Input: path to .csv-file; list of filters; optional: list of columns (Default = all); keyword arguments of pd.read_csv
+    Output: pd.DataFrame
+    """
+    if columns is not None:
+        kwargs['usecols'] = list(dict.fromkeys([kwargs['index_col']] + [col for col, *_ in filters] + columns))
+
+    if not filters:
+        sat_ = pd.read_csv(path,**kwargs)
+    else:
+        with pd.read_csv(path,chunksize=CSV_CHUNK_ROWS,**kwargs) as chunks_:
+            sat_ = pd.concat([stu.filter_rows(chunk,filters) for chunk in chunks_])
+
+    return sat_ if columns is None else sat_[columns]
 
 class ConvertUnits(BaseEstimator, TransformerMixin):
 
-    def __init__(self):
-        pass
+    def __init__(self,copy:bool=True):
+        self.copy = copy
 
     def fit(self, X, y=None):
         return self
@@ -26,7 +67,24 @@ class ConvertUnits(BaseEstimator, TransformerMixin):
     def transform(self, sat):
         """
         Convert units - position: km -> m, velocity: dm/s -> m/s
+        With self.copy = False, sat is converted in place, column by column: writable float64 arrays are scaled directly;
+        pandas with copy-on-write (>= 3.0) only hands out read-only views, which are written back into the same column
+        (one temporary column at a time); read-only data (e.g. a memory-mapped store) or other dtypes are replaced column by column.
         """
+        if not self.copy:
+            for cols_, ufunc_, factor_ in [(['x','y','z'],np.multiply,1_000),(['vx','vy','vz'],np.divide,10)]:
+                for col in cols_:
+                    values_ = sat[col].to_numpy()
+
+                    if values_.dtype == np.float64 and values_.flags.writeable:
+                        ufunc_(values_,factor_,out=values_) # no temporary
+                    elif values_.dtype == np.float64 and writable(values_):
+                        sat.loc[:,col] = ufunc_(values_,factor_) # read-only view of a writable column: written into the column
+                    else:
+                        sat[col] = ufunc_(values_,factor_) # read-only data or other dtype: column replaced
+
+            return sat
+
         sat_ = sat.copy()
 
         # CONVERT POS TO [km]->[m] (MULTIPLY BY 1000) AND VELOCITY TO [dm/s]->[m/s] (DIVIDE BY 10)
@@ -36,8 +94,8 @@ class ConvertUnits(BaseEstimator, TransformerMixin):
         return sat_
 
 class DropDuplIdx(BaseEstimator, TransformerMixin):
-    def __init__(self):
-        pass
+    def __init__(self,copy:bool=True):
+        self.copy = copy
 
     def fit(self, X, y=None):
         return self
@@ -45,7 +103,14 @@ class DropDuplIdx(BaseEstimator, TransformerMixin):
     def transform(self, sat):
         """
         Drop duplicated indices
+        With self.copy = False, duplicates are found on the index alone and sat itself is returned if there are none
+        (otherwise a single copy of the kept rows).
         """
+        if not self.copy:
+            keep_ = ~sat.index.duplicated(keep='last')
+
+            return sat if keep_.all() else sat[keep_]
+
         sat_ = sat.copy()
 
         sat_ = (sat_
@@ -56,8 +121,11 @@ class DropDuplIdx(BaseEstimator, TransformerMixin):
         return sat_
     
 class LoadSingleSat(BaseEstimator, TransformerMixin):
-    def __init__(self,path=None):
+    def __init__(self,path=None,start=None,end=None,columns=None):
         self.path = path
+        self.start = start
+        self.end = end
+        self.columns = columns
 
     def fit(self, X, y=None):
         return self
@@ -65,57 +133,177 @@ class LoadSingleSat(BaseEstimator, TransformerMixin):
     def transform(self,X=None):
         """
         Load and return the DORIS .csv-file in single DataFrame (with DateTime index) with sorted index
+        Only the epochs in [self.start, self.end] (None = unbounded) and the columns in self.columns (None = all) are kept,
+        filtered chunk by chunk while reading (see read_csv_filtered).
         """
 
-        dtypes_ = {'time_stamp':'str','x':'float','y':'float','z':'float','vx':'float','vy':'float','vz':'float'}
-        sat_ = pd.read_csv(self.path,index_col=[0],dtype=dtypes_,parse_dates=['time_stamp'])
+        dtypes_ = {'x':'float','y':'float','z':'float','vx':'float','vy':'float','vz':'float'}
+        filters_ = stu.row_filters(start=self.start,end=self.end)
+        sat_ = read_csv_filtered(self.path,filters_,self.columns,index_col='time_stamp',dtype=dtypes_,parse_dates=['time_stamp'])
     
-        return sat_.sort_index() 
+        return sort_by_time(sat_)
     
 class LoadSats(BaseEstimator, TransformerMixin):
-    def __init__(self,path=None):
+    def __init__(self,path=None,batch_epochs:int=1440,time_system:str=None,ctr_id=None,sat_id=None,start=None,end=None,columns=None):
         self.path = path
+        self.batch_epochs = batch_epochs
+        self.time_system = time_system
+        self.ctr_id = ctr_id
+        self.sat_id = sat_id
+        self.start = start
+        self.end = end
+        self.columns = columns
 
     def fit(self, X, y=None):
         return self
     
     def transform(self,X=None):
         """
-        Load and return the DORIS .csv-file in single DataFrame (with DateTime index) with sorted index
+        Load and return the DORIS .csv-file in single DataFrame (with DateTime index) with sorted index.
+        If path points to a .Z-file (or is a list of .Z-files), the files are decompressed and parsed batch by batch (sp3_utils.iter_sp3_batches),
+        with time stamps in self.time_system ('UTC', 'GPS', ...; None: as given in the file header).
+        Binary columnar files and datasets (see store_utils.read_store) are read as by LoadColumnar.
+        Only the rows of self.ctr_id, self.sat_id (str or list) in [self.start, self.end] and the columns in self.columns are kept
+        (None = all): filters are pushed down into the read (skipped partitions and row groups of binary files, chunk by chunk
+        for .csv-files, batch by batch for .Z-files). The sort is skipped if the epochs are already in order.
+        """
+
+        filters_ = stu.row_filters(self.ctr_id,self.sat_id,self.start,self.end)
+
+        if isinstance(self.path,(list,tuple)) or str(self.path).endswith('.Z'):
+            paths_ = sorted(self.path) if isinstance(self.path,(list,tuple)) else [self.path]
+            batches_ = (stu.filter_rows(batch,filters_) for path in paths_ for batch in sp3.iter_sp3_batches(path,batch_epochs=self.batch_epochs,time_system=self.time_system))
+
+            sat_ = pd.concat(batches_,ignore_index=True).set_index('time_stamp')
+
+            return sort_by_time(sat_ if self.columns is None else sat_[self.columns])
+
+        if Path(self.path).suffix.lstrip('.') in stu.STORE_FORMATS + [stu.DATASET_FORMAT]:
+            return LoadColumnar(self.path,self.columns,self.ctr_id,self.sat_id,self.start,self.end).transform(X)
+
+        dtypes_ = {'ctr_id':'str','sat_id':'str','x':'float','y':'float','z':'float','vx':'float','vy':'float','vz':'float'}
+        columns_ = ['ctr_id','sat_id','time_stamp','x','y','z','vx','vy','vz'] # without the leading (unnamed) row number
+        sat_ = read_csv_filtered(self.path,filters_,self.columns,usecols=columns_,index_col='time_stamp',dtype=dtypes_,parse_dates=['time_stamp'])
+    
+        return sort_by_time(sat_)
+        
+class LoadColumnar(BaseEstimator, TransformerMixin):
+    def __init__(self,path=None,columns=None,ctr_id=None,sat_id=None,start=None,end=None):
+        self.path = path
+        self.columns = columns
+        self.ctr_id = ctr_id
+        self.sat_id = sat_id
+        self.start = start
+        self.end = end
+
+    def fit(self, X, y=None):
+        return self
+    
+    def transform(self,X=None):
+        """
+        Load and return a binary columnar DORIS file (.parquet, .feather or .npz -> see store_utils) in single DataFrame (with DateTime index) with sorted index.
+        Only the columns in self.columns (and the time stamps) are read from disk, and only the rows of self.ctr_id, self.sat_id
+        (str or list) in [self.start, self.end] (None = all; see store_utils.row_filters, pushed down for parquet files and datasets).
         """
 
-        dtypes_ = {'ctr_id':'str','sat_id':'str','time_stamp':'str','x':'float','y':'float','z':'float','vx':'float','vy':'float','vz':'float'}
-        sat_ = pd.read_csv(self.path,usecols=range(1,10),index_col=[2],dtype=dtypes_,parse_dates=['time_stamp'])
+        columns_ = None if self.columns is None else ['time_stamp'] + [col for col in self.columns if col != 'time_stamp']
+        filters_ = stu.row_filters(self.ctr_id,self.sat_id,self.start,self.end)
+        sat_ = stu.read_store(self.path,columns=columns_,filters=filters_).set_index('time_stamp')
     
-        return sat_.sort_index() 
+        return sort_by_time(sat_)
+        
+class LoadEpochStore(BaseEstimator, TransformerMixin):
+    def __init__(self,path=None,ctr_id=None,sat_id=None,start=None,end=None,columns=None):
+        self.path = path
+        self.ctr_id = ctr_id
+        self.sat_id = sat_id
+        self.start = start
+        self.end = end
+        self.columns = columns
+
+    def fit(self, X, y=None):
+        return self
+    
+    def transform(self,X=None):
+        """
+        Load the epochs in [start, end] from a memory-mapped epoch store (see store_utils.EpochStore) in single DataFrame (with DateTime index).
+        ctr_id and sat_id (str or list; None = all, see store_utils.row_filters) select the satellite(s); a single satellite is returned
+        as zero-copy view of the store. Raises ValueError if no satellite of the store is selected.
+        """
+
+        store_ = stu.EpochStore(self.path)
+        sats_ = stu.filter_rows(pd.DataFrame(store_.satellites(),columns=['ctr_id','sat_id']),stu.row_filters(self.ctr_id,self.sat_id))
+        sats_ = list(sats_.itertuples(index=False,name=None))
+
+        if not sats_:
+            raise ValueError(f'No satellite of {self.path} matches ctr_id={self.ctr_id!r}, sat_id={self.sat_id!r}: the store contains {store_.satellites()}')
+
+        sat_ = [store_.frame(ctr,sat,self.start,self.end,self.columns) for ctr,sat in sats_]
+
+        if len(sat_) == 1:
+            return sat_[0] # already sorted
+
+        return pd.concat(sat_).sort_index(kind='stable')
         
 class OrbitalElements(BaseEstimator, TransformerMixin):
-    def __init__(self,type:str='kepler',custom_elements=None):
+    def __init__(self,type:str='kepler',custom_elements=None,chunk_size:int=None,copy:bool=True):
         self.elements_type = type
         self.custom_elements = custom_elements
+        self.chunk_size = chunk_size
+        self.copy = copy
 
     def fit(self, X, y=None):
         return self
 
     def transform(self,sat):
-        sat_ = sat.copy()
-        data_ = {}
+        """
+        Add orbital elements (self.elements_type: 'kepler', 'equinoctial', 'all' or 'custom' -> self.custom_elements) as columns.
+        With self.chunk_size, the elements are computed chunk by chunk into preallocated columns (bounded temporaries,
+        see kepler_utils.compute_elements_chunked). The results are bit-identical in both modes.
+        Only the intermediates the requested elements depend on are computed (see kepler_utils.schedule); custom elements
+        can be added with kepler_utils.register_element.
+        With self.copy = False, the elements are computed chunk by chunk into preallocated arrays which become
+        the new columns of sat (no copy of sat, no concatenation).
+        Custom names which are not elements (see kepler_utils.ELEMENTS) but functions of kepler_utils, e.g. added to the module
+        by the user, are still computed as before by calling them on sat (whole, not chunked); any other name raises ValueError.
+        """
+        if self.elements_type == 'custom':
+            elements_ = list(self.custom_elements)
+        else:
+            elements_ = kutls.ELEMENT_SETS[self.elements_type]
 
-        if self.elements_type == 'kepler':
-            elements_ = ['a','e','i','nu','omega','Omega']
+        # CUSTOM NAMES OUTSIDE THE REGISTRY: FUNCTIONS OF kepler_utils, CALLED ON sat (formerly through eval)
+        requested_ = elements_
+        legacy_ = [elem for elem in elements_ if elem not in kutls.ELEMENTS and callable(getattr(kutls,elem,None))]
+        elements_ = [elem for elem in elements_ if elem not in legacy_]
 
-        elif self.elements_type == 'equinoctial':
-            elements_ = ['p','f','g','q1','q2','L']
+        if not self.copy:
+            values_ = {elem:np.empty(len(sat)) for elem in elements_}
+            if elements_:
+                kutls.compute_elements_chunked(sat,elements=elements_,chunk_size=self.chunk_size or kutls.CHUNK_SIZE,out=values_)
+            for elem in legacy_:
+                values_[elem] = np.asarray(getattr(kutls,elem)(sat)).reshape(-1,)
 
-        elif self.elements_type == 'all':
-            elements_ = ['a','e','i','nu','omega','Omega','p','f','g','q1','q2','L','E','M','n']
+            for elem in requested_:
+                sat[elem] = pd.Series(values_.pop(elem),index=sat.index,copy=False) # column shares the array
 
-        elif self.elements_type == 'custom':
-            elements_ = self.custom_elements
+            return sat
 
+        sat_ = sat.copy()
+        data_ = {}
 
-        for elem in elements_:
-            data_[elem] = eval(f'kutls.{elem}(sat).reshape(-1,)')
+        # STATES ARE EXTRACTED ONCE, SHARED INTERMEDIATES ARE COMPUTED ONCE (see kepler_utils.compute_elements)
+        if not elements_:
+            values_ = {}
+        elif self.chunk_size:
+            values_ = kutls.compute_elements_chunked(sat,elements=elements_,chunk_size=self.chunk_size)
+        else:
+            values_ = kutls.compute_elements(*kutls.states(sat),elements=elements_)
+        for elem in legacy_:
+            values_[elem] = np.asarray(getattr(kutls,elem)(sat))
+
+        for elem in requested_:
+            data_[elem] = values_[elem].reshape(-1,)
 
         orbital_elements_ = pd.DataFrame(data=data_).set_index(sat_.index)
 
@@ -0,0 +1,410 @@
+# PROCESSING DATA IMPORTS
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+# UNZIPPING .Z FILES IMPORTS
+import lzw_utils as lzw
+
+# COLUMNS OF THE DataFrames CREATED FROM SP3 FILES
+SP3_COLUMNS = ['ctr_id','sat_id','time_stamp','x','y','z','vx','vy','vz']
+
+# FIXED SP3 COLUMNS (0-BASED, END EXCLUSIVE) - SEE literature/SP3c_format.pdf
+#   * YYYY MM DD HH MM SS.SSSSSSSS  -> epoch header record
+#   PsssXXXXXXXXXXXXXXYYYYYYYYYYYYYYZZZZZZZZZZZZZZCCCCCCCCCCCCCC -> position and clock record
+#   VsssXXXXXXXXXXXXXXYYYYYYYYYYYYYYZZZZZZZZZZZZZZCCCCCCCCCCCCCC -> velocity and clock-rate record
+EPOCH_FIELDS = {'year':(3,7), 'month':(8,10), 'day':(11,13), 'hour':(14,16), 'minute':(17,19), 'second':(20,22), 'fraction':(23,31)}
+EPOCH_WIDTH = 31
+
+# HEADER FIELDS (0-BASED, END EXCLUSIVE) - SEE literature/SP3c_format.pdf
+#   #cP2016 12 31 23 00 00.00000000    1000 ORBIT ...  -> line 1: version, P/V flag, first epoch (same columns as epoch records), number of epochs
+#   ## 1929 518400.00000000    60.00000000 ...          -> line 2: epoch interval
+#   +    1   L39  0  0 ...                               -> '+ ' lines: number of satellites (first line), 17 satellite ids per line
+#   %c L  cc GPS ccc ...                                 -> first '%c' line: time system (blank means GPS)
+HEADER_FIELDS = {'version':(1,2), 'pv_flag':(2,3), 'n_epochs':(32,39), 'interval':(24,38), 'n_sats':(3,6), 'sats':(9,60), 'time_system':(9,12)}
+SAT_ID_WIDTH = 3
+DEFAULT_TIME_SYSTEM = 'GPS'
+
+# OFFSETS TO TAI [s]: TAI = t + offset
+TAI_OFFSETS = {'TAI':0, 'GPS':19, 'GAL':19}
+
+# LEAP SECONDS: (DATE [UTC] FROM WHICH ON TAI-UTC APPLIES, TAI-UTC [s])
+LEAP_SECONDS = [
+    ('1972-01-01',10), ('1972-07-01',11), ('1973-01-01',12), ('1974-01-01',13), ('1975-01-01',14), ('1976-01-01',15),
+    ('1977-01-01',16), ('1978-01-01',17), ('1979-01-01',18), ('1980-01-01',19), ('1981-07-01',20), ('1982-07-01',21),
+    ('1983-07-01',22), ('1985-07-01',23), ('1988-01-01',24), ('1990-01-01',25), ('1991-01-01',26), ('1992-07-01',27),
+    ('1993-07-01',28), ('1994-07-01',29), ('1996-01-01',30), ('1997-07-01',31), ('1999-01-01',32), ('2006-01-01',33),
+    ('2009-01-01',34), ('2012-07-01',35), ('2015-07-01',36), ('2017-01-01',37)
+    ]
+
+NS = 10**9 # nanoseconds per second
+
+RECORD_ID = (1,4) # satellite id of P/V records (e.g. 'L39')
+RECORD_START = 4 # data fields of P/V records start after the 4 character record id (e.g. 'PL39')
+RECORD_FIELD_WIDTH = 14 # each data field (x, y, z, clock) is 14 characters wide, no separator required (e.g. VL39-64263.5220048-3451.15...)
+RECORD_FIELDS = 3 # only x, y, z are used
+
+# BYTE VALUES
+HEADER = ord('#')
+NEWLINE = ord('\n')
+CARRIAGE_RETURN = ord('\r')
+SPACE = ord(' ')
+EPOCH = ord('*')
+POSITION = ord('P')
+VELOCITY = ord('V')
+
+def line_bounds(buffer:np.ndarray):
+    """
+    Computes start and end offsets of all non-empty lines of a byte buffer.
+    Input: np.uint8 array (buffer)
+    Output: np.array of line starts, np.array of line ends (exclusive, without newline)
+    """
+
+    newlines = np.flatnonzero(buffer == NEWLINE)
+
+    starts = np.concatenate(([0], newlines + 1))
+    ends = np.concatenate((newlines, [len(buffer)]))
+
+    non_empty = starts < ends # drops empty lines and the empty 'line' after a trailing newline
+
+    return starts[non_empty], ends[non_empty]
+
+def fixed_columns(buffer:np.ndarray, starts:np.ndarray, ends:np.ndarray, first:int, last:int) -> np.ndarray:
+    """
+    Slices the fixed columns [first, last) of several lines into a 2d character array.
+    Characters beyond the end of a (short) line are filled with spaces.
+    Input: np.uint8 array (buffer), line starts, line ends, first and last column
+    Output: np.uint8 array of shape (number of lines, last - first)
+    """
+
+    idx = starts.reshape(-1,1) + np.arange(first,last)
+    inside = idx < ends.reshape(-1,1) # mask characters belonging to the next line
+
+    chars = buffer[np.minimum(idx, len(buffer)-1)]
+    chars[~inside | (chars == CARRIAGE_RETURN)] = SPACE # treat '\r\n' line endings like '\n'
+
+    return chars
+
+def to_float(chars:np.ndarray, width:int) -> np.ndarray:
+    """
+    Converts a 2d character array of glued fixed-width fields into floats.
+    Input: np.uint8 array of shape (N, k*width), width of a single field
+    Output: np.float64 array of shape (N, k)
+    """
+
+    n = chars.shape[0]
+
+    return np.ascontiguousarray(chars).view(f'S{width}').reshape(n,-1).astype(np.float64)
+
+def to_int(chars:np.ndarray) -> np.ndarray:
+    """
+    Converts a 2d character array of (space padded) digits into integers.
+    Input: np.uint8 array of shape (N, width)
+    Output: np.int64 array of shape (N,)
+    """
+
+    digits = chars.astype(np.int64) - ord('0')
+    digits[chars == SPACE] = 0 # leading blanks
+
+    powers = 10 ** np.arange(chars.shape[1]-1,-1,-1)
+
+    return digits @ powers
+
+def leap_seconds(t:np.ndarray, utc:bool=True) -> np.ndarray:
+    """
+    Looks up TAI-UTC for an array of epochs (leap second table LEAP_SECONDS).
+    Input: np.int64 array of epochs [ns since 1970-01-01]; flag if epochs are given in UTC (True) or TAI (False)
+    Output: np.int64 array of TAI-UTC [s]
+    """
+
+    dates = np.array([date for date,_ in LEAP_SECONDS], dtype='datetime64[ns]').astype(np.int64)
+    offsets = np.array([0] + [offset for _,offset in LEAP_SECONDS], dtype=np.int64)
+
+    if not utc:
+        dates = dates + offsets[1:]*NS # instants of the leap seconds in TAI
+
+    return offsets[np.searchsorted(dates, t, side='right')]
+
+def convert_time_system(t:np.ndarray, source:str, target:str) -> np.ndarray:
+    """
+    Converts epochs between the time systems TAI, GPS, GAL (Galileo system time) and UTC.
+    Input: np.int64 array of epochs [ns since 1970-01-01]; time system of t; target time system
+    Output: np.int64 array of epochs [ns since 1970-01-01] in target time system
+    """
+
+    if source == target:
+        return t
+
+    for system in (source, target):
+        if system != 'UTC' and system not in TAI_OFFSETS:
+            raise ValueError(f'Unknown time system {system}: expected UTC or one of {list(TAI_OFFSETS)}')
+
+    # TO TAI
+    if source == 'UTC':
+        tai = t + leap_seconds(t, utc=True)*NS
+    else:
+        tai = t + TAI_OFFSETS[source]*NS
+
+    # FROM TAI
+    if target == 'UTC':
+        return tai - leap_seconds(tai, utc=False)*NS
+
+    return tai - TAI_OFFSETS[target]*NS
+
+def epochs_to_datetime64(year, month, day, hour, minute, second, nanosecond=0) -> np.ndarray:
+    """
+    (Vectorised) conversion of calendar fields into time stamps in one NumPy expression (integer arithmetic, no rounding).
+    Input: integer arrays (or scalars) of year, month, day, hour, minute, (whole) second and nanosecond
+    Output: np.array of datetime64[ns]
+    """
+
+    months = (np.asarray(year, dtype=np.int64) - 1970)*12 + np.asarray(month, dtype=np.int64) - 1
+    days = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + day - 1 # days since 1970-01-01
+
+    t = ((days*24 + hour)*60 + minute)*60 + second
+
+    return (t*NS + nanosecond).astype('datetime64[ns]')
+
+def read_header(buffer:np.ndarray, starts:np.ndarray, ends:np.ndarray) -> dict:
+    """
+    Parses the SP3 header, i.e. all lines before the first epoch record.
+    Input: np.uint8 array (buffer), line starts, line ends
+    Output: dict with version, pv_flag ('P': positions only, 'V': positions and velocities), start (first epoch), n_epochs,
+            interval [s], sats (list of satellite ids), time_system and n_lines (number of header lines);
+            None if the buffer does not start with a header (e.g. a later batch of a file)
+    """
+
+    if len(starts) == 0 or buffer[starts[0]] != HEADER:
+        return None
+
+    is_epoch = buffer[starts] == EPOCH
+    n_lines = int(np.argmax(is_epoch)) if is_epoch.any() else len(starts)
+
+    lines = [bytes(buffer[first:last]).decode('ascii', errors='replace').rstrip('\r') for first, last in zip(starts[:n_lines], ends[:n_lines])]
+
+    def field(line, name):
+        first, last = HEADER_FIELDS[name]
+        return line[first:last].strip()
+
+    header = {
+        'version':field(lines[0],'version'), 'pv_flag':field(lines[0],'pv_flag'),
+        'start':parse_epochs(buffer, starts[:1], ends[:1])[0], 'n_epochs':int(field(lines[0],'n_epochs') or 0),
+        'interval':float(field(lines[1],'interval') or 'nan') if n_lines > 1 and lines[1].startswith('##') else np.nan,
+        'sats':[], 'time_system':DEFAULT_TIME_SYSTEM, 'n_lines':n_lines
+        }
+
+    # SATELLITE IDS: CONSECUTIVE 3 CHARACTER FIELDS OF ALL '+ ' LINES (UNUSED FIELDS ARE '  0')
+    sat_lines = [line for line in lines if line.startswith('+ ')]
+    if sat_lines:
+        n_sats = int(field(sat_lines[0],'n_sats') or 0)
+        first, last = HEADER_FIELDS['sats']
+        ids = ''.join(line[first:last].ljust(last - first) for line in sat_lines)
+        header['sats'] = [ids[k:k+SAT_ID_WIDTH].strip() for k in range(0, n_sats*SAT_ID_WIDTH, SAT_ID_WIDTH)]
+
+    time_lines = [line for line in lines if line.startswith('%c')]
+    if time_lines:
+        header['time_system'] = field(time_lines[0],'time_system') or DEFAULT_TIME_SYSTEM
+
+    return header
+
+def parse_header(data) -> dict:
+    """
+    Parses the header of (decompressed) SP3 contents (see read_header).
+    Input: bytes-like SP3 contents (at least the complete header)
+    Output: dict (see read_header) or None
+    """
+
+    buffer = np.frombuffer(data, dtype=np.uint8)
+
+    return read_header(buffer, *line_bounds(buffer))
+
+def sat_codes(chars:np.ndarray) -> np.ndarray:
+    """
+    Packs 3 character satellite ids into integers (for vectorised lookups).
+    Input: np.uint8 array of shape (N, 3)
+    Output: np.int64 array of shape (N,)
+    """
+
+    return chars.astype(np.int64) @ np.array([1 << 16, 1 << 8, 1])
+
+def parse_epochs(buffer:np.ndarray, starts:np.ndarray, ends:np.ndarray, source:str=DEFAULT_TIME_SYSTEM, target:str=None) -> np.ndarray:
+    """
+    Decodes all epoch header records ('*' lines) at once, including fractional seconds.
+    Input: np.uint8 array (buffer), starts and ends of the epoch lines;
+           time system of the file (source); optional: time system to convert to (target, Default = None, i.e. keep source)
+    Output: np.array of datetime64[ns]
+    """
+
+    chars = fixed_columns(buffer, starts, ends, 0, EPOCH_WIDTH)
+
+    fields = {name:to_int(chars[:,first:last]) for name, (first, last) in EPOCH_FIELDS.items()}
+
+    first, last = EPOCH_FIELDS['fraction']
+    nanosecond = fields.pop('fraction') * 10**(9 - (last - first)) # 8 decimals -> ns
+
+    t = epochs_to_datetime64(**fields, nanosecond=nanosecond)
+
+    if target is not None:
+        t = convert_time_system(t.astype(np.int64), source, target).astype('datetime64[ns]')
+
+    return t
+
+def parse_sp3(data, filename:str, time_system:str=None, header:dict=None, sat_ids:dict=None) -> pd.DataFrame:
+    """
+    Vectorised parser for a complete (decompressed) SP3 buffer.
+    The records are assigned to (satellite, epoch) by the satellite id of each P/V line and the preceding epoch record,
+    such that comment lines, several satellites per epoch and missing velocity records (P files) are handled in one pass.
+    Input: bytes-like SP3 contents; filename of .Z-file (cccsss...) -> used for center and satellite id
+    Optional: time system of the time stamps (time_system: 'UTC', 'GPS', 'TAI', 'GAL'; Default = None, i.e. time system of the file);
+              header of the file (header; Default = None, i.e. read from data -> required for later batches of a file, see iter_sp3_batches);
+              dict SP3 record id (e.g. 'L39') -> satellite id of the .Z-filenames (e.g. 's6a') for multi satellite files (sat_ids, see learn_sat_ids;
+              Default = None, i.e. record ids)
+    Output: pd.DataFrame with columns ctr_id | sat_id | time_stamp | x | y | z | vx | vy | vz, ordered by time (and sat_id within an epoch).
+            sat_id is taken from the filename for single satellite files; for multi satellite files it is mapped from the record id
+            by *sat_ids*, record ids without an entry are kept as they are; velocities are NaN if not given.
+    """
+
+    buffer = np.frombuffer(data, dtype=np.uint8)
+
+    starts, ends = line_bounds(buffer)
+    record = buffer[starts] # first character of each line identifies the record
+
+    if header is None:
+        header = read_header(buffer, starts, ends)
+
+    # EPOCHS
+    is_epoch = record == EPOCH
+    time = parse_epochs(buffer, starts[is_epoch], ends[is_epoch], header['time_system'] if header else DEFAULT_TIME_SYSTEM, time_system)
+
+    n_epochs = len(time)
+    epoch = np.cumsum(is_epoch) - 1 # epoch of each line (-1: header)
+
+    # SATELLITES: HEADER LIST, EXTENDED BY IDS ONLY FOUND IN THE RECORDS
+    is_rec = ((record == POSITION) | (record == VELOCITY)) & (epoch >= 0)
+    codes = sat_codes(fixed_columns(buffer, starts[is_rec], ends[is_rec], *RECORD_ID))
+
+    sats = header['sats'] if header else []
+    known = sat_codes(np.array([list(sat.rjust(SAT_ID_WIDTH).encode('ascii')) for sat in sats], dtype=np.uint8).reshape(-1, SAT_ID_WIDTH))
+    known = np.concatenate((known, np.setdiff1d(codes, known)))
+    order = np.argsort(known, kind='stable')
+    slot = order[np.searchsorted(known[order], codes)] # satellite index of each record
+
+    n_sats = len(known)
+    ids = [int(code).to_bytes(SAT_ID_WIDTH, 'big').decode('ascii').strip() for code in known]
+
+    if n_sats == 1:
+        ids = [filename[3:6]]
+    else:
+        # SATELLITES IN ORDER OF THEIR IDS
+        sat_ids = sat_ids or {}
+        ids = [sat_ids.get(sat, sat) for sat in ids]
+        rank = np.argsort(np.argsort(ids, kind='stable'), kind='stable')
+        slot, ids = rank[slot], sorted(ids)
+
+    # POSITIONS AND VELOCITIES: PRE-ALLOCATED (SATELLITE, EPOCH, XYZ) ARRAYS
+    last = RECORD_START + RECORD_FIELDS*RECORD_FIELD_WIDTH
+    rec_record, rec_epoch, rec_starts, rec_ends = record[is_rec], epoch[is_rec], starts[is_rec], ends[is_rec]
+
+    pos = np.full((n_sats, n_epochs, RECORD_FIELDS), np.nan)
+    vel = np.full((n_sats, n_epochs, RECORD_FIELDS), np.nan)
+    has_pos = np.zeros((n_sats, n_epochs), dtype=bool)
+
+    for values, letter in [(pos, POSITION), (vel, VELOCITY)]:
+        k = rec_record == letter
+        if not k.any():
+            continue # e.g. no velocity records
+        values[slot[k], rec_epoch[k]] = to_float(fixed_columns(buffer, rec_starts[k], rec_ends[k], RECORD_START, last), RECORD_FIELD_WIDTH)
+        if letter == POSITION:
+            has_pos[slot[k], rec_epoch[k]] = True
+
+    # ROWS: ALL (EPOCH, SATELLITE) PAIRS WITH A POSITION RECORD, TIME MAJOR (NO COPY FOR SINGLE SATELLITE FILES)
+    pos, vel = pos.transpose(1, 0, 2).reshape(-1, RECORD_FIELDS), vel.transpose(1, 0, 2).reshape(-1, RECORD_FIELDS)
+    time = np.repeat(time, n_sats)
+
+    rows = has_pos.T.ravel()
+    if not rows.all():
+        pos, vel, time = pos[rows], vel[rows], time[rows]
+
+    n = len(pos)
+
+    if n_sats == 1:
+        sat_id = [ids[0]]*n
+    else:
+        sat_id = np.tile(np.array(ids, dtype=object), n_epochs)[rows]
+
+    return pd.DataFrame({
+        'ctr_id':[filename[:3]]*n, 'sat_id':sat_id, 'time_stamp':time,
+        'x':pos[:,0], 'y':pos[:,1], 'z':pos[:,2],
+        'vx':vel[:,0], 'vy':vel[:,1], 'vz':vel[:,2]
+        })
+
+def learn_sat_ids(Z_files:list) -> dict:
+    """
+    Learns the mapping of SP3 record ids to the satellite ids of the .Z-filenames from single satellite files:
+    the only satellite in the header of cccsss... is sss. Only the header (first decompressed chunk) of every file is read.
+    Input: list of paths to .Z-files
+    Output: dict record id -> satellite id (sat_ids of parse_sp3)
+    """
+
+    sat_ids = {}
+
+    for Z_file in Z_files:
+        chunk = next(lzw.iter_unlzw(Z_file), None)
+        header = parse_header(bytes(chunk)) if chunk is not None else None
+
+        if header and len(header['sats']) == 1:
+            sat_ids[header['sats'][0]] = Path(Z_file).name[3:6]
+
+    return sat_ids
+
+def iter_sp3_batches(source, batch_epochs:int=1440, filename:str='', chunk_size:int=lzw.CHUNK_SIZE, time_system:str=None, sat_ids:dict=None):
+    """
+    Decompresses and parses a .Z-file incrementally, batch by batch.
+    Only the current decompressed chunk and the lines of the current batch are held in memory.
+    Input: path to .Z-file or bytes-like contents; number of epochs per batch (Default = 1440, i.e. one day of 1-minute orbits);
+           filename of .Z-file (required for bytes-like contents, taken from path otherwise); size of decompressed chunks;
+           time system of the time stamps and satellite ids of multi satellite files (see parse_sp3)
+    Output: generator of pd.DataFrames (same columns as parse_sp3) with *batch_epochs* epochs each, except the last one
+    """
+
+    if batch_epochs < 1:
+        raise ValueError(f'batch_epochs must be at least 1, got {batch_epochs}')
+
+    if isinstance(source, (str, Path)):
+        filename = Path(source).name
+
+    pending = bytearray() # decompressed lines not yet parsed
+    epochs = [] # offsets of epoch records ('*' lines) in pending
+    scanned = 0 # number of bytes of pending already searched for epoch records
+    first = True
+    header = None # read from the first batch, passed on to later batches
+
+    for chunk in lzw.iter_unlzw(source, chunk_size=chunk_size):
+        pending += chunk
+
+        # FIND NEW EPOCH RECORDS: '*' AT THE BEGINNING OF A LINE
+        buffer = np.frombuffer(pending, dtype=np.uint8)
+        new = np.flatnonzero((buffer[scanned:-1] == NEWLINE) & (buffer[scanned+1:] == EPOCH)) + scanned + 1
+        if first and buffer[0] == EPOCH:
+            new = np.concatenate(([0], new)) # stream without header
+        epochs += new.tolist()
+        first = False
+        scanned = max(len(buffer) - 1, 0)
+        del buffer # release export of pending before resizing it
+
+        # CUT OFF COMPLETE BATCHES: A BATCH ENDS WHERE THE NEXT BATCH'S FIRST EPOCH STARTS
+        while len(epochs) > batch_epochs:
+            cut = epochs[batch_epochs]
+            batch = bytes(pending[:cut])
+
+            if header is None:
+                header = parse_header(batch) # only the first batch contains the header
+
+            yield parse_sp3(batch, filename, time_system, header, sat_ids)
+
+            del pending[:cut]
+            epochs = [offset - cut for offset in epochs[batch_epochs:]]
+            scanned -= cut
+
+    if epochs:
+        yield parse_sp3(bytes(pending), filename, time_system, header, sat_ids)
@@ -0,0 +1,378 @@
+# PROCESSING DATA IMPORTS
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+# BINARY COLUMNAR FORMATS IMPORTS
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# BINARY COLUMNAR FORMATS (FILE EXTENSIONS)
+STORE_FORMATS = ['parquet','feather','npz']
+
+# PARTITIONED PARQUET DATASET (DIRECTORY EXTENSION): <root>.dataset/ctr_id=<ctr_id>/sat_id=<sat_id>/<part>.parquet
+DATASET_FORMAT = 'dataset'
+
+# MEMORY-MAPPED EPOCH STORE (DIRECTORY EXTENSION): <root>.epochs/<ctr_id>/<sat_id>/<column>.npy
+EPOCH_STORE_FORMAT = 'epochs'
+
+# COLUMN TYPES
+CATEGORICAL_COLUMNS = ['ctr_id','sat_id']
+TIME_COLUMN = 'time_stamp'
+FLOAT_COLUMNS = ['x','y','z','vx','vy','vz']
+
+def store_format(path:str) -> str:
+    """
+    Infers the store format from the file extension.
+    Input: path to file
+    Output: 'csv', DATASET_FORMAT, EPOCH_STORE_FORMAT or one of STORE_FORMATS
+    """
+
+    fmt = Path(path).suffix.lstrip('.')
+
+    if fmt not in ['csv', DATASET_FORMAT, EPOCH_STORE_FORMAT] + STORE_FORMATS:
+        raise ValueError(f'Unknown format {fmt}: expected csv, {DATASET_FORMAT}, {EPOCH_STORE_FORMAT} or one of {STORE_FORMATS}')
+
+    return fmt
+
+def row_filters(ctr_id=None, sat_id=None, start=None, end=None) -> list:
+    """
+    Predicates selecting center(s), satellite(s) and the epochs in [start, end] (both inclusive), in the filters format of
+    pyarrow.parquet.read_table (see read_store, filter_rows).
+    Input: center id(s), satellite id(s) (str or list), start and end (anything accepted by pd.Timestamp); None = all
+    Output: list of (column, operator, value), empty if nothing is filtered
+    """
+
+    filters_ = []
+    for col, value in [('ctr_id', ctr_id), ('sat_id', sat_id)]:
+        if value is not None:
+            filters_.append((col, 'in', list(value)) if isinstance(value, (list, tuple, set)) else (col, '==', value))
+
+    if start is not None:
+        filters_.append((TIME_COLUMN, '>=', pd.Timestamp(start)))
+    if end is not None:
+        filters_.append((TIME_COLUMN, '<=', pd.Timestamp(end)))
+
+    return filters_
+
+def filter_rows(df:pd.DataFrame, filters:list) -> pd.DataFrame:
+    """
+    Applies predicates of row_filters to a DataFrame (for formats without predicate pushdown).
+    Input: pd.DataFrame (time stamps as column or index); list of (column, operator, value)
+    Output: pd.DataFrame of the selected rows (df itself if all rows are selected)
+    """
+
+    mask_ = np.ones(len(df), dtype=bool)
+
+    for col, op, value in filters:
+        values_ = df.index if col not in df.columns and df.index.name == col else df[col]
+
+        if op == 'in':
+            mask_ &= np.asarray(values_.isin(value))
+        elif op == '==':
+            mask_ &= np.asarray(values_ == value)
+        elif op == '>=':
+            mask_ &= np.asarray(values_ >= value)
+        elif op == '<=':
+            mask_ &= np.asarray(values_ <= value)
+        else:
+            raise ValueError(f'Unknown operator {op}')
+
+    return df if mask_.all() else df[mask_]
+
+def typed(df:pd.DataFrame) -> pd.DataFrame:
+    """
+    Casts the columns of a satellite DataFrame to their storage types:
+    categorical center/satellite ids, datetime64[ns] time stamps and float64 positions/velocities.
+    Input: pd.DataFrame
+    Output: pd.DataFrame (new frame, same index)
+    """
+
+    types_ = {}
+    for col in df.columns:
+        if col in CATEGORICAL_COLUMNS:
+            types_[col] = 'category'
+        elif col == TIME_COLUMN:
+            types_[col] = 'datetime64[ns]'
+        elif col in FLOAT_COLUMNS:
+            types_[col] = 'float64'
+
+    return df.astype(types_)
+
+def to_npz(df:pd.DataFrame, path:str):
+    """
+    Writes a DataFrame to an (uncompressed) .npz-file, one array per column.
+    Categorical columns are stored as int codes (col) and categories (col.categories), time stamps as int64 [ns].
+    Input: pd.DataFrame; path to .npz-file
+    """
+
+    arrays_ = {}
+    for col in df.columns:
+        values_ = df[col]
+        if isinstance(values_.dtype, pd.CategoricalDtype):
+            arrays_[col] = values_.cat.codes.values
+            arrays_[col+'.categories'] = np.asarray(values_.cat.categories, dtype=str)
+        elif col == TIME_COLUMN:
+            arrays_[col] = values_.values.astype('datetime64[ns]').view(np.int64)
+        else:
+            arrays_[col] = values_.values
+
+    arrays_['.columns'] = np.array(df.columns, dtype=str) # preserve column order
+
+    with open(path,'wb') as file:
+        np.savez(file, **arrays_)
+
+def read_npz(path:str, columns:list=None) -> pd.DataFrame:
+    """
+    Reads a DataFrame written by to_npz. Only the arrays of the requested columns are read from disk.
+    Input: path to .npz-file; optional: list of columns
+    Output: pd.DataFrame
+    """
+
+    data_ = {}
+    with np.load(path) as npz:
+        for col in (columns if columns is not None else npz['.columns']):
+            values_ = npz[col]
+            if col+'.categories' in npz.files:
+                values_ = pd.Categorical.from_codes(values_, categories=npz[col+'.categories'])
+            elif col == TIME_COLUMN:
+                values_ = values_.view('datetime64[ns]')
+            data_[col] = values_
+
+    return pd.DataFrame(data_)
+
+def to_store(df:pd.DataFrame, path:str):
+    """
+    Writes a satellite DataFrame in a binary columnar format (parquet, feather or npz; inferred from the file extension).
+    Input: pd.DataFrame with columns ctr_id | sat_id | time_stamp | x | y | z | vx | vy | vz; path to file
+    """
+
+    fmt = store_format(path)
+    df_ = typed(df).reset_index(drop=True)
+
+    if fmt == 'parquet':
+        df_.to_parquet(path, index=False)
+    elif fmt == 'feather':
+        df_.to_feather(path)
+    elif fmt == 'npz':
+        to_npz(df_, path)
+    else:
+        raise ValueError(f'Use DataFrame.to_csv to write {path}')
+
+def read_store(path:str, columns:list=None, filters:list=None) -> pd.DataFrame:
+    """
+    Reads a file written by to_store. Only the requested columns are read (column projection).
+    Filters (see row_filters) are pushed down into the read for parquet files (row groups whose statistics exclude them are skipped)
+    and datasets (partitions of other centers/satellites are not opened, see read_dataset); feather and npz files are filtered after reading.
+    Input: path to file; optional: list of columns, list of filters
+    Output: pd.DataFrame
+    """
+
+    fmt = store_format(path)
+
+    if fmt == 'parquet':
+        return pd.read_parquet(path, columns=columns, filters=filters or None)
+    elif fmt == DATASET_FORMAT:
+        return read_dataset(path, columns, filters)
+
+    # NO PUSHDOWN: READ THE FILTERED COLUMNS AS WELL, DROP THEM AFTERWARDS
+    columns_ = columns if columns is None or not filters else list(dict.fromkeys(columns + [col for col, *_ in filters]))
+
+    if fmt == 'feather':
+        df_ = pd.read_feather(path, columns=columns_)
+    elif fmt == 'npz':
+        df_ = read_npz(path, columns_)
+    else:
+        raise ValueError(f'Use pandas.read_csv to read {path}')
+
+    if filters:
+        df_ = filter_rows(df_, filters).reset_index(drop=True)
+
+    return df_ if columns_ is columns else df_[columns]
+
+def save_df(df:pd.DataFrame, path:str):
+    """
+    Writes a satellite DataFrame as .csv-file or in a binary columnar format, depending on the file extension.
+    Input: pd.DataFrame; path to file
+    """
+
+    fmt = store_format(path)
+
+    if fmt == 'csv':
+        df.to_csv(path)
+    elif fmt == DATASET_FORMAT:
+        write_partition(df, path, 'part-0')
+    elif fmt == EPOCH_STORE_FORMAT:
+        write_epoch_store(df, path)
+    else:
+        to_store(df, path)
+
+def batches_to_store(batches, path:str) -> int:
+    """
+    Writes DataFrame batches (e.g. from sp3_utils.iter_sp3_batches) to a single binary columnar file.
+    Parquet files are written batch by batch (one row group per batch) with bounded memory;
+    feather, npz files and epoch stores require the concatenated DataFrame.
+    Input: iterable of pd.DataFrames; path to file
+    Output: number of written rows
+    """
+
+    if store_format(path) != 'parquet':
+        df_ = pd.concat(batches, ignore_index=True)
+        save_df(df_, path)
+        return len(df_)
+
+    rows = 0
+    writer = None
+    try:
+        for batch in batches:
+            table = pa.Table.from_pandas(typed(batch), preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+            rows += len(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return rows
+
+def partition_dir(root:str, ctr_id:str, sat_id:str) -> Path:
+    """
+    Output: directory of the (center, satellite) partition of a dataset
+    """
+
+    return Path(root) / f'ctr_id={ctr_id}' / f'sat_id={sat_id}'
+
+def write_partition(df:pd.DataFrame, root:str, part:str) -> int:
+    """
+    Writes a satellite DataFrame as part file into a dataset partitioned by center and satellite:
+    root/ctr_id=<ctr_id>/sat_id=<sat_id>/<part>.parquet (the ids are stored in the directory names only).
+    An existing part with the same name is overwritten, other parts are kept, i.e. datasets are appended to part by part.
+    Input: pd.DataFrame with columns ctr_id | sat_id | time_stamp | x | y | z | vx | vy | vz (or time_stamp as index); path to dataset directory; name of the part (e.g. .Z-filename)
+    Output: number of written rows
+    """
+
+    df_ = df if TIME_COLUMN in df.columns else df.reset_index()
+
+    for (ctr_id, sat_id), sat_ in df_.groupby(CATEGORICAL_COLUMNS, observed=True):
+        directory = partition_dir(root, ctr_id, sat_id)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        part_ = typed(sat_.drop(columns=CATEGORICAL_COLUMNS)).reset_index(drop=True)
+        part_.to_parquet(directory / f'{part}.parquet', index=False)
+
+    return len(df_)
+
+def read_dataset(root:str, columns:list=None, filters:list=None) -> pd.DataFrame:
+    """
+    Reads a dataset written by write_partition. Only the requested columns are read (column projection),
+    and only the partitions and row groups which may contain rows matching the filters (predicate pushdown, see row_filters).
+    Files starting with '_' or '.' (e.g. the ingest manifest) are ignored.
+    Input: path to dataset directory; optional: list of columns, list of filters
+    Output: pd.DataFrame (ctr_id and sat_id as categorical columns)
+    """
+
+    table = pq.read_table(root, columns=columns, filters=filters or None, partitioning='hive')
+
+    return table.to_pandas()
+
+def write_epoch_store(df:pd.DataFrame, root:str):
+    """
+    Writes a satellite DataFrame to a memory-mappable epoch store: one contiguous .npy-file per (center, satellite, column)
+    at root/ctr_id/sat_id/column.npy, sorted by time. The time stamps are stored as int64 [ns] (time_stamp.npy) and serve as index.
+    Existing (center, satellite) entries are overwritten.
+    Input: pd.DataFrame with columns ctr_id | sat_id | time_stamp | x | y | z | vx | vy | vz (or time_stamp as index); path to store directory
+    """
+
+    df_ = df if TIME_COLUMN in df.columns else df.reset_index()
+
+    for (ctr_id, sat_id), sat_ in df_.groupby(CATEGORICAL_COLUMNS, observed=True):
+        directory = Path(root) / str(ctr_id) / str(sat_id)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        sat_ = sat_.sort_values(TIME_COLUMN, kind='stable')
+
+        np.save(directory / f'{TIME_COLUMN}.npy', sat_[TIME_COLUMN].values.astype('datetime64[ns]').view(np.int64))
+        for col in FLOAT_COLUMNS:
+            np.save(directory / f'{col}.npy', np.ascontiguousarray(sat_[col].values, dtype=np.float64))
+
+class EpochStore:
+    """
+    Read access to an epoch store written by write_epoch_store.
+    All arrays are memory-mapped read-only: range reads binary-search the sorted time index and return zero-copy views,
+    and several processes opening the same store share the same (page cache) pages.
+    """
+
+    def __init__(self, root:str):
+        self.root = Path(root)
+        self._arrays = {} # opened memory maps: (ctr_id, sat_id, column) -> np.memmap
+
+    def __getstate__(self):
+        return {'root':self.root, '_arrays':{}} # memory maps are re-opened (not pickled) in worker processes
+
+    def satellites(self) -> list:
+        """
+        Output: sorted list of (ctr_id, sat_id) in the store
+        """
+
+        return sorted((path.parent.parent.name, path.parent.name) for path in self.root.glob(f'*/*/{TIME_COLUMN}.npy'))
+
+    def array(self, ctr_id:str, sat_id:str, column:str) -> np.ndarray:
+        """
+        Input: center id, satellite id, column name
+        Output: read-only memory map of the full column
+        """
+
+        key = (ctr_id, sat_id, column)
+        if key not in self._arrays:
+            self._arrays[key] = np.load(self.root / ctr_id / sat_id / f'{column}.npy', mmap_mode='r')
+
+        return self._arrays[key]
+
+    def span(self, ctr_id:str, sat_id:str, start=None, end=None) -> slice:
+        """
+        Binary search of the time index for the epochs in [start, end] (both inclusive, None = unbounded).
+        Input: center id, satellite id, start and end (anything accepted by pd.Timestamp)
+        Output: slice of row positions
+        """
+
+        time_ = self.array(ctr_id, sat_id, TIME_COLUMN)
+
+        lo = 0 if start is None else np.searchsorted(time_, pd.Timestamp(start).value, side='left')
+        hi = len(time_) if end is None else np.searchsorted(time_, pd.Timestamp(end).value, side='right')
+
+        return slice(int(lo), int(hi))
+
+    def window(self, ctr_id:str, sat_id:str, start=None, end=None, columns:list=None) -> dict:
+        """
+        Range read of the epochs in [start, end].
+        Input: center id, satellite id, start and end; optional: list of columns (Default = all float columns)
+        Output: dict column -> zero-copy np.ndarray view (time stamps as datetime64[ns])
+        """
+
+        rows = self.span(ctr_id, sat_id, start, end)
+
+        views_ = {TIME_COLUMN: self.array(ctr_id, sat_id, TIME_COLUMN)[rows].view('datetime64[ns]')}
+        for col in (FLOAT_COLUMNS if columns is None else columns):
+            if col != TIME_COLUMN:
+                views_[col] = self.array(ctr_id, sat_id, col)[rows]
+
+        return views_
+
+    def frame(self, ctr_id:str, sat_id:str, start=None, end=None, columns:list=None) -> pd.DataFrame:
+        """
+        Range read of the epochs in [start, end] as DataFrame (with DateTime index) wrapping the memory-mapped views without copying them.
+        Input: center id, satellite id, start and end; optional: list of columns (Default = all float columns)
+        Output: pd.DataFrame with columns ctr_id | sat_id | requested columns
+        """
+
+        views_ = self.window(ctr_id, sat_id, start, end, columns)
+        index_ = pd.DatetimeIndex(views_.pop(TIME_COLUMN), name=TIME_COLUMN)
+
+        n = len(index_)
+        ids_ = {
+            'ctr_id':pd.Categorical.from_codes(np.zeros(n, dtype=np.int8), categories=[ctr_id]),
+            'sat_id':pd.Categorical.from_codes(np.zeros(n, dtype=np.int8), categories=[sat_id])
+            }
+
+        return pd.DataFrame({**ids_, **views_}, index=index_, copy=False)